@@ -0,0 +1,167 @@
+"""Micro-benchmark of the masked partial-label losses against a naive gather-based version.
+
+The naive version loops over the examples of a batch with tf.map_fn, gathers
+the logit columns of each example's labeled classes, and computes the loss on
+them. The batched version in `partial_data.losses` multiplies the dense
+per-class loss by the labeled-class mask instead.
+
+Each implementation runs in its own process, so peak memory is measured
+independently. The loss and its gradients are built once as a graph and run
+with a Session, so the benchmark runs on Tensorflow 1.x and, through
+tf.compat.v1, on 2.x. Reports forward + backward steps per second, anchors per
+second, and the increase in peak RSS (and peak GPU memory when available).
+
+Usage, from the repository root:
+    python -m benchmarks.loss_benchmark --batch-size 24 --num-anchors 1917 --num-classes 91
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import time
+
+
+def naive_masked_sigmoid_cross_entropy(logits, targets, labeled_class_mask, normalization='none'):
+    """Per-example masked sigmoid cross-entropy, summed over anchors and labeled classes."""
+    import tensorflow as tf
+
+    def example_loss(inputs):
+        example_logits, example_targets, example_mask = inputs
+        labeled_class_ids = tf.reshape(tf.where(example_mask), [-1])
+        labeled_logits = tf.gather(example_logits, labeled_class_ids, axis=-1)
+        labeled_targets = tf.gather(example_targets, labeled_class_ids, axis=-1)
+        loss = tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(labels=labeled_targets, logits=labeled_logits))
+        if normalization == 'num_labeled':
+            num_classes = tf.cast(tf.size(example_mask), tf.float32)
+            loss *= tf.math.divide_no_nan(num_classes, tf.cast(tf.size(labeled_class_ids), tf.float32))
+        return loss
+
+    return tf.map_fn(example_loss, (logits, targets, labeled_class_mask), dtype=tf.float32)
+
+
+def batched_masked_sigmoid_cross_entropy(logits, targets, labeled_class_mask, normalization='none'):
+    """`partial_data.losses.masked_sigmoid_cross_entropy`, summed per example."""
+    import tensorflow as tf
+    from partial_data.losses import masked_sigmoid_cross_entropy
+
+    loss = masked_sigmoid_cross_entropy(logits, targets, labeled_class_mask, normalization=normalization)
+    return tf.reduce_sum(loss, axis=[1, 2])
+
+
+IMPLEMENTATIONS = {
+    'naive_gather': naive_masked_sigmoid_cross_entropy,
+    'batched_mask': batched_masked_sigmoid_cross_entropy,
+}
+
+
+def make_inputs(batch_size, num_anchors, num_classes, label_fraction, seed=0):
+    """Creates random logits, one-hot targets, and labeled-class masks."""
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    logits = rng.normal(size=(batch_size, num_anchors, num_classes)).astype(np.float32)
+    target_classes = rng.randint(0, num_classes, size=(batch_size, num_anchors))
+    targets = np.eye(num_classes, dtype=np.float32)[target_classes]
+    labeled_class_mask = rng.rand(batch_size, num_classes) < label_fraction
+    return logits, targets, labeled_class_mask
+
+
+def run_implementation(name, args, result_queue):
+    """Times forward and backward passes of one implementation, and reports its peak memory."""
+    import numpy as np
+    import tensorflow as tf
+
+    try:
+        from tensorflow.compat.v1 import Session, Variable, global_variables_initializer
+    except (AttributeError, ModuleNotFoundError):
+        from tensorflow import Session, Variable, global_variables_initializer
+
+    start_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    loss_fn = IMPLEMENTATIONS[name]
+    with tf.Graph().as_default():
+        # Inputs are variables rather than constants, so the loss is not constant folded away
+        logits, targets, labeled_class_mask = (
+            Variable(value, trainable=False) for value in
+            make_inputs(args.batch_size, args.num_anchors, args.num_classes, args.label_fraction)
+        )
+        loss = loss_fn(logits, targets, labeled_class_mask, normalization=args.normalization)
+        grads, = tf.gradients(tf.reduce_sum(loss), [logits])
+        # Fetch reductions of the loss and gradients, since grouping them lets grappler prune the computation
+        step = [tf.reduce_sum(loss), tf.reduce_sum(grads)]
+
+        with Session() as session:
+            session.run(global_variables_initializer())
+            # Warm up
+            for _ in range(3):
+                session.run(step)
+
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                session.run(step)
+            elapsed = time.perf_counter() - start
+            loss_value = session.run(loss)
+
+    gpu_peak_mb = None
+    if tf.test.is_gpu_available() and hasattr(tf.config.experimental, 'get_memory_info'):
+        gpu_peak_mb = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2 ** 20
+
+    result_queue.put({
+        'implementation': name,
+        'steps_per_sec': args.iterations / elapsed,
+        'anchors_per_sec': args.iterations * args.batch_size * args.num_anchors / elapsed,
+        'peak_rss_increase_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss_kb) / 1024,
+        'gpu_peak_mb': gpu_peak_mb,
+        'loss': np.asarray(loss_value).tolist(),
+    })
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--batch-size', type=int, default=24)
+    parser.add_argument('--num-anchors', type=int, default=1917, help='1917 for SSD300 with Mobilenet-v1')
+    parser.add_argument('--num-classes', type=int, default=91)
+    parser.add_argument('--label-fraction', type=float, default=0.5,
+                        help='The fraction of classes labeled in each example')
+    parser.add_argument('--normalization', default='none', choices=('none', 'num_labeled'))
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--output', help='If provided, write the results to this json file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv if argv is not None else sys.argv[1:])
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in IMPLEMENTATIONS:
+        result_queue = context.Queue()
+        process = context.Process(target=run_implementation, args=(name, args, result_queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f'Benchmark of {name} failed with exit code {process.exitcode}')
+        results.append(result_queue.get())
+
+    # Both implementations must compute the same loss, up to float32 summation order
+    import numpy as np
+    naive_loss, batched_loss = (np.asarray(result.pop('loss')) for result in results)
+    max_rel_diff = float(np.max(np.abs(naive_loss - batched_loss) / np.maximum(np.abs(naive_loss), 1)))
+
+    print(f'batch_size={args.batch_size} num_anchors={args.num_anchors} num_classes={args.num_classes} '
+          f'label_fraction={args.label_fraction} normalization={args.normalization}')
+    for result in results:
+        gpu_peak = f", gpu peak {result['gpu_peak_mb']:.1f} MB" if result['gpu_peak_mb'] is not None else ''
+        print(f"{result['implementation']:>14}: {result['steps_per_sec']:8.2f} steps/s, "
+              f"{result['anchors_per_sec']:12.0f} anchors/s, "
+              f"peak RSS +{result['peak_rss_increase_mb']:.1f} MB{gpu_peak}")
+    print(f'speedup: {results[1]["steps_per_sec"] / results[0]["steps_per_sec"]:.2f}x, '
+          f'max relative loss difference: {max_rel_diff:.2e}')
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'args': vars(args), 'results': results, 'max_rel_loss_diff': max_rel_diff}, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""End-to-end benchmark of the dataset building pipeline on a synthetic COCO style dataset.
+
+Times each stage of building and reading a TFRecord dataset, from loading the
+annotations json to drawing boxes on images, and reports its throughput
+(images/s and MB/s of input) and peak RSS. Each run is appended to a results
+file together with the git commit it ran on, and compared with the previous
+run with the same settings, so regressions show up across commits.
+
+Usage, from the repository root:
+    python -m benchmarks.pipeline_benchmark --num-images 500 --num-workers 4
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from PIL import Image
+
+from benchmarks.synthetic_coco import make_synthetic_coco
+from partial_data.coco import load_coco_annotations_as_dataframe
+from partial_data.examples import group_examples_by_image
+from partial_data.tfrecord import (decode_object_detection_tf_example, encode_object_detection_tf_example,
+                                   read_examples_from_tfrecord, write_examples_as_tfrecord)
+from partial_data.visualization import draw_bounding_boxes_on_image, draw_boxes_on_array
+
+
+STAGES = ('load_annotations', 'group_examples', 'encode_examples', 'write_tfrecord', 'read_tfrecord', 'draw_boxes',
+          'draw_detections_pil', 'draw_detections')
+DEFAULT_RESULTS_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'pipeline.jsonl')
+
+
+class PeakRssSampler:
+    """Samples the resident set size of this process in a background thread, tracking its peak.
+
+    Falls back to the lifetime peak from `resource.getrusage` where
+    /proc/self/statm is not available.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def get_rss_bytes():
+        try:
+            with open('/proc/self/statm', 'r') as fp:
+                return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, self.get_rss_bytes())
+
+    def __enter__(self):
+        self.peak_bytes = self.get_rss_bytes()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self.get_rss_bytes())
+
+
+def get_file_bytes(filepaths):
+    return sum(os.path.getsize(filepath) for filepath in filepaths)
+
+
+def run_stage(name, func, num_images, num_bytes_func):
+    """Runs one stage, timing it and sampling its peak RSS.
+
+    Returns the stage output and its metrics. `num_bytes_func` is called
+    after the stage, so it can measure the stage's output files.
+    """
+    with PeakRssSampler() as rss_sampler:
+        start = time.perf_counter()
+        output = func()
+        seconds = time.perf_counter() - start
+    num_bytes = num_bytes_func()
+    metrics = {
+        'seconds': seconds,
+        'num_images': num_images,
+        'num_bytes': num_bytes,
+        'images_per_sec': num_images / seconds,
+        'mb_per_sec': num_bytes / 2 ** 20 / seconds,
+        'peak_rss_mb': rss_sampler.peak_bytes / 2 ** 20,
+    }
+    print(f"{name:>20}: {seconds:8.3f} s {metrics['images_per_sec']:10.1f} images/s "
+          f"{metrics['mb_per_sec']:8.1f} MB/s  peak RSS {metrics['peak_rss_mb']:8.1f} MB")
+    return output, metrics
+
+
+def _draw_examples(examples):
+    for example in examples:
+        img = Image.open(example['image_filepath'])
+        img.load()
+        boxes = np.stack([example['hmin'], example['wmin'], example['hmax'], example['wmax']], axis=1)
+        draw_bounding_boxes_on_image(
+            img, boxes, display_str_list_list=[(name,) for name in example['category_name']])
+
+
+def _make_detections(examples, detections_per_image):
+    # Random detection outputs for each image, as from infer_detections.py
+    rng = np.random.RandomState(0)
+    detections = []
+    for example in examples:
+        mins = rng.uniform(0, 0.8, size=(detections_per_image, 2))
+        boxes = np.concatenate([mins, mins + rng.uniform(0.02, 0.2, size=(detections_per_image, 2))], axis=1)
+        detections.append((example['image_filepath'], boxes.astype(np.float32),
+                           rng.randint(1, 91, size=detections_per_image),
+                           rng.uniform(size=detections_per_image).astype(np.float32)))
+    return detections
+
+
+def _draw_detections_with_pil(detections):
+    # The per-box PIL drawing path, labeling every box
+    for image_filepath, boxes, classes, scores in detections:
+        img = Image.open(image_filepath).convert('RGB')
+        draw_bounding_boxes_on_image(
+            img, boxes, color={(str(class_id),): 'red' for class_id in classes},
+            display_str_list_list=[(str(class_id),) for class_id in classes])
+
+
+def _draw_detections(detections):
+    for image_filepath, boxes, classes, scores in detections:
+        img_array = np.asarray(Image.open(image_filepath).convert('RGB')).copy()
+        draw_boxes_on_array(img_array, boxes, classes, scores)
+
+
+def run_pipeline(args):
+    """Runs the selected stages, returning the metrics of each one."""
+    annotations_filepath, image_dir = make_synthetic_coco(
+        os.path.join(args.work_dir, 'data'), num_images=args.num_images, image_size=tuple(args.image_size),
+        num_categories=args.num_categories, instances_per_image=args.instances_per_image)
+    image_filepaths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')))
+    image_bytes = get_file_bytes(image_filepaths)
+    tfrecord_filebase = os.path.join(args.work_dir, 'tfrecord', 'synthetic.record')
+    os.makedirs(os.path.dirname(tfrecord_filebase), exist_ok=True)
+    tfrecord_pattern = tfrecord_filebase + '-?????-of-?????' if args.num_shards > 1 else tfrecord_filebase
+
+    stage_metrics = {}
+
+    # Every stage needs the examples, so the first two stages always run
+    df, stage_metrics['load_annotations'] = run_stage(
+        'load_annotations', lambda: load_coco_annotations_as_dataframe(annotations_filepath, image_dir),
+        args.num_images, lambda: os.path.getsize(annotations_filepath))
+    examples, stage_metrics['group_examples'] = run_stage(
+        'group_examples', lambda: group_examples_by_image(df), args.num_images, lambda: 0)
+
+    if 'encode_examples' in args.stages:
+        _, stage_metrics['encode_examples'] = run_stage(
+            'encode_examples',
+            lambda: [encode_object_detection_tf_example(example).SerializeToString() for example in examples],
+            len(examples), lambda: image_bytes)
+    if 'write_tfrecord' in args.stages or 'read_tfrecord' in args.stages:
+        _, stage_metrics['write_tfrecord'] = run_stage(
+            'write_tfrecord',
+            lambda: write_examples_as_tfrecord(
+                examples, tfrecord_filebase, encode_object_detection_tf_example, num_shards=args.num_shards,
+                num_workers=args.num_workers),
+            len(examples), lambda: image_bytes)
+    if 'read_tfrecord' in args.stages:
+        _, stage_metrics['read_tfrecord'] = run_stage(
+            'read_tfrecord',
+            lambda: read_examples_from_tfrecord(tfrecord_pattern, decode_object_detection_tf_example),
+            len(examples), lambda: get_file_bytes(glob.glob(tfrecord_pattern)))
+    if 'draw_boxes' in args.stages:
+        _, stage_metrics['draw_boxes'] = run_stage(
+            'draw_boxes', lambda: _draw_examples(examples), len(examples), lambda: image_bytes)
+
+    if 'draw_detections_pil' in args.stages or 'draw_detections' in args.stages:
+        detections = _make_detections(examples, args.detections_per_image)
+        for name, draw_detections in (('draw_detections_pil', _draw_detections_with_pil),
+                                      ('draw_detections', _draw_detections)):
+            if name in args.stages:
+                _, stage_metrics[name] = run_stage(
+                    name, lambda: draw_detections(detections), len(detections), lambda: image_bytes)
+
+    return stage_metrics
+
+
+def get_git_commit():
+    """Gets the current git commit of the repository, and whether the working tree has changes."""
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+            stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def load_results(results_filepath):
+    if not os.path.exists(results_filepath):
+        return []
+    with open(results_filepath, 'r') as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def compare_results(result, previous_result):
+    """Prints the throughput of each stage relative to a previous run."""
+    print(f"\nCompared with {previous_result['git_commit'] or 'unknown commit'} "
+          f"({previous_result['timestamp']}):")
+    for name, metrics in result['stages'].items():
+        previous_metrics = previous_result['stages'].get(name, None)
+        if previous_metrics is None:
+            continue
+        speedup = metrics['images_per_sec'] / previous_metrics['images_per_sec']
+        rss_change = metrics['peak_rss_mb'] - previous_metrics['peak_rss_mb']
+        print(f'{name:>20}: {speedup:6.2f}x images/s, peak RSS {rss_change:+8.1f} MB')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--num-images', type=int, default=200)
+    parser.add_argument('--image-size', type=int, nargs=2, default=(640, 480), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--num-categories', type=int, default=80)
+    parser.add_argument('--instances-per-image', type=int, default=7)
+    parser.add_argument('--detections-per-image', type=int, default=100,
+                        help='Number of boxes drawn on each image by the draw_detections stages')
+    parser.add_argument('--num-shards', type=int, default=3)
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'partial_data_benchmark'),
+                        help='Directory for the synthetic dataset and TFRecords, reused across runs')
+    parser.add_argument('--results-file', default=DEFAULT_RESULTS_FILEPATH,
+                        help='Jsonl file that each run is appended to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv if argv is not None else sys.argv[1:])
+    settings = {
+        'num_images': args.num_images,
+        'image_size': list(args.image_size),
+        'num_categories': args.num_categories,
+        'instances_per_image': args.instances_per_image,
+        'detections_per_image': args.detections_per_image,
+        'num_shards': args.num_shards,
+        'num_workers': args.num_workers,
+    }
+
+    stage_metrics = run_pipeline(args)
+
+    git_commit, git_dirty = get_git_commit()
+    result = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit,
+        'git_dirty': git_dirty,
+        'python': sys.version.split()[0],
+        'settings': settings,
+        'stages': stage_metrics,
+    }
+
+    previous_results = [
+        previous_result for previous_result in load_results(args.results_file)
+        if previous_result['settings'] == settings
+    ]
+    if previous_results:
+        compare_results(result, previous_results[-1])
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results_file)), exist_ok=True)
+    with open(args.results_file, 'a') as fp:
+        fp.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Generation of synthetic COCO style datasets for benchmarks.
+"""
+import json
+import os
+
+import numpy as np
+
+from PIL import Image
+
+
+def _make_image(rng, width, height, boxes, colors):
+    # A smooth gradient background with filled boxes and mild noise, so JPEG sizes are close to those of photos
+    x_ramp = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    y_ramp = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    start_color, end_color = rng.randint(0, 256, (2, 3)).astype(np.float32)
+    img = start_color * (1 - x_ramp) * (1 - y_ramp) + end_color * (x_ramp + y_ramp) / 2
+    for (x, y, box_width, box_height), color in zip(boxes, colors):
+        img[int(y):int(y + box_height), int(x):int(x + box_width)] = color
+    img += rng.normal(0, 12, img.shape).astype(np.float32)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+def make_synthetic_coco(output_dir, num_images=200, image_size=(640, 480), num_categories=80,
+                        instances_per_image=7, seed=0):
+    """Writes a synthetic COCO instances json file and matching JPEG images.
+
+    Each image has a random number of boxes, around `instances_per_image`,
+    each with a polygon segmentation so the json file has a realistic size. A
+    dataset already generated with the same settings in `output_dir` is
+    reused.
+
+    Parameters
+    ----------
+    output_dir: str
+        Directory where the annotations file and an 'images' directory are
+        written.
+    num_images: int
+        The number of images.
+    image_size: tuple(int, int)
+        The (width, height) of every image.
+    num_categories: int
+        The number of categories.
+    instances_per_image: int
+        The mean number of instances per image.
+    seed: int
+        Seed of the random dataset.
+
+    Returns
+    -------
+    annotations_filepath: str
+        Filepath of the instances json file.
+    image_dir: str
+        Directory holding the images.
+    """
+    settings = {
+        'num_images': num_images,
+        'image_size': list(image_size),
+        'num_categories': num_categories,
+        'instances_per_image': instances_per_image,
+        'seed': seed,
+    }
+    annotations_filepath = os.path.join(output_dir, 'instances_synthetic.json')
+    image_dir = os.path.join(output_dir, 'images')
+    settings_filepath = os.path.join(output_dir, 'settings.json')
+    if os.path.exists(settings_filepath) and os.path.exists(annotations_filepath):
+        with open(settings_filepath, 'r') as fp:
+            if json.load(fp) == settings:
+                return annotations_filepath, image_dir
+
+    os.makedirs(image_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    width, height = image_size
+    categories = [
+        {'id': category_id, 'name': f'category {category_id}', 'supercategory': 'synthetic'}
+        for category_id in range(1, num_categories + 1)
+    ]
+    images = []
+    annotations = []
+    for image_id in range(1, num_images + 1):
+        file_name = f'{image_id:012d}.jpg'
+        num_instances = max(1, rng.poisson(instances_per_image))
+        box_widths = rng.uniform(0.05, 0.5, num_instances) * width
+        box_heights = rng.uniform(0.05, 0.5, num_instances) * height
+        boxes = np.stack([
+            rng.uniform(0, 1, num_instances) * (width - box_widths),
+            rng.uniform(0, 1, num_instances) * (height - box_heights),
+            box_widths,
+            box_heights,
+        ], axis=1).round(2)
+        _make_image(rng, width, height, boxes, rng.randint(0, 256, (num_instances, 3))).save(
+            os.path.join(image_dir, file_name), quality=90)
+
+        images.append({
+            'id': image_id,
+            'file_name': file_name,
+            'width': width,
+            'height': height,
+            'coco_url': f'http://images.cocodataset.org/synthetic/{file_name}',
+            'license': 1,
+            'date_captured': '2020-01-01 00:00:00',
+            'flickr_url': '',
+        })
+        for x, y, box_width, box_height in boxes.tolist():
+            # A 16 point polygon inscribed in the box
+            angles = np.linspace(0, 2 * np.pi, 16, endpoint=False)
+            polygon = np.stack([
+                x + box_width * (1 + np.cos(angles)) / 2,
+                y + box_height * (1 + np.sin(angles)) / 2,
+            ], axis=1).round(2).reshape(-1).tolist()
+            annotations.append({
+                'id': len(annotations) + 1,
+                'image_id': image_id,
+                'category_id': int(rng.randint(1, num_categories + 1)),
+                'bbox': [x, y, box_width, box_height],
+                'area': round(box_width * box_height, 2),
+                'iscrowd': 0,
+                'segmentation': [polygon],
+            })
+
+    with open(annotations_filepath, 'w') as fp:
+        json.dump({
+            'info': {'description': 'Synthetic COCO style dataset'},
+            'licenses': [{'id': 1, 'name': 'synthetic', 'url': ''}],
+            'images': images,
+            'annotations': annotations,
+            'categories': categories,
+        }, fp)
+    with open(settings_filepath, 'w') as fp:
+        json.dump(settings, fp)
+
+    return annotations_filepath, image_dir
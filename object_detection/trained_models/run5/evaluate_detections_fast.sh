@@ -0,0 +1,12 @@
+# Faster alternative to evaluate_detections.sh, using the evaluator in partial_data.evaluation instead of the object
+# detection API. Writes metrics.csv in the same layout, to a separate directory.
+EVAL_DIR=./evaluate_fast
+NUM_WORKERS=4
+
+mkdir -p ${EVAL_DIR}
+
+# Run evaluation script, add --ignore-unlabeled-classes to evaluate on partially labeled records
+PYTHONPATH=../../..:${PYTHONPATH} python -m partial_data.evaluation \
+  --input './test/test_detections.tfrecord-*' \
+  --eval-dir=${EVAL_DIR} \
+  --num-workers=${NUM_WORKERS}
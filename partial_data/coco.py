@@ -1,44 +1,383 @@
+import array
 import json
 import os
 
+import numpy as np
+
 import pandas as pd
 
+from partial_data.json_stream import JsonStreamParser
 
-def load_coco_annotations_as_dataframe(annotations_filepath, local_image_dir):
-    # Load raw data from disk
-    with open(annotations_filepath, 'r') as fp:
-        instances = json.load(fp)
-
-    # Load annotation info into dataframe
-    df_ann = (
-        pd.DataFrame(instances['annotations'])
-        .drop(columns=['segmentation', 'area'])
-        .rename(columns={'id': 'instance_id'})
-    )
-
-    # Load category info into dataframe
-    df_cat = (
-        pd.DataFrame(instances['categories'])
-        .drop(columns=['supercategory'])
-        .rename(columns={'id': 'category_id', 'name': 'category_name'})
-    )
-    df_cat['category_name_orig'] = df_cat['category_name']
-    df_cat['category_name'] = df_cat['category_name'].str.lower().str.replace(' ', '_')
-
-    # Load image info
-    df_image = pd.DataFrame(instances['images']).rename(columns={'id': 'image_id'})
-    df_image['image_filepath'] = df_image['file_name'].apply(lambda x: os.path.join(local_image_dir, x))
-    df_image.drop(columns=['license', 'file_name', 'date_captured', 'flickr_url'], inplace=True)
 
-    # Combine all info into single dataframe
-    df_comb = pd.merge(df_ann, df_cat, on='category_id', how='left')
-    df_comb = pd.merge(df_comb, df_image, on='image_id', how='left')
+# Bump when the columns produced by load_coco_annotations_as_dataframe change, to invalidate caches
+DATAFRAME_CACHE_VERSION = 3
+# Columns holding the original COCO [x, y, width, height] pixel boxes
+BBOX_COLUMNS = ('bbox_x', 'bbox_y', 'bbox_width', 'bbox_height')
+# Fields kept from each COCO annotation, image, and category, mapped to their array typecode (None for strings)
+# and default value
+COCO_FIELDS = {
+    'annotations': {
+        'id': ('q', None),
+        'image_id': ('q', None),
+        'category_id': ('q', None),
+        'iscrowd': ('b', 0),
+        'bbox': ('d', None),
+    },
+    'images': {
+        'id': ('q', None),
+        'width': ('l', None),
+        'height': ('l', None),
+        'file_name': (None, None),
+        'coco_url': (None, ''),
+    },
+    'categories': {
+        'id': ('q', None),
+        'name': (None, None),
+    },
+}
+
+
+def _drop_segmentation(pairs):
+    # Polygon segmentations are by far the largest part of COCO annotation files and are never used,
+    # so drop them as each annotation object is decoded instead of keeping them in the decoded tree
+    return {key: value for key, value in pairs if key != 'segmentation'}
+
+
+def _get_lookup_inds(ids, lookup_ids, name):
+    # Vectorized equivalent of a left merge on unique ids, returning the row in `ids` of each lookup id
+    if len(ids) == 0:
+        if len(lookup_ids):
+            raise ValueError(f'Annotations reference {name} ids that are not defined')
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    inds = order[np.searchsorted(ids, lookup_ids, sorter=order).clip(max=len(ids) - 1)]
+    if not np.array_equal(ids[inds], lookup_ids):
+        raise ValueError(f'Annotations reference {name} ids that are not defined')
+    return inds
+
+
+def _lookup_strings(inds, values, categorical):
+    # Builds a column holding values[inds], as a categorical or as python strings, without assuming the values
+    # are unique
+    codes, categories = pd.factorize(np.asarray(values, dtype=object))
+    if categorical:
+        return pd.Categorical.from_codes(codes[inds], categories=categories)
+    return np.asarray(categories, dtype=object)[codes[inds]]
+
+
+def init_coco_columns():
+    """Creates empty columns to collect the COCO fields listed in `COCO_FIELDS`.
+
+    Numeric fields are collected in compact typed arrays, and string fields
+    in lists.
+    """
+    return {
+        array_key: {
+            field: array.array(typecode) if typecode is not None else []
+            for field, (typecode, _) in fields.items()
+        }
+        for array_key, fields in COCO_FIELDS.items()
+    }
+
+
+def append_coco_item(columns, array_key, item):
+    """Appends the retained fields of a COCO annotation, image, or category to columns.
 
-    # Convert bounding boxes to normalized coordinates
+    Parameters
+    ----------
+    columns: dict
+        Columns created by `init_coco_columns`.
+    array_key: str
+        The COCO array the item belongs to, one of 'annotations', 'images',
+        or 'categories'.
+    item: dict
+        A decoded COCO annotation, image, or category.
+    """
+    array_columns = columns[array_key]
+    for field, (_, default) in COCO_FIELDS[array_key].items():
+        if field == 'bbox':
+            array_columns[field].extend(item[field])
+        else:
+            array_columns[field].append(item.get(field, default))
+
+
+def coco_instances_to_columns(instances):
+    """Converts decoded COCO instance annotations to columns, see `init_coco_columns`."""
+    columns = init_coco_columns()
+    for array_key in COCO_FIELDS:
+        for item in instances[array_key]:
+            append_coco_item(columns, array_key, item)
+    return columns
+
+
+def get_bbox_array(df):
+    """Gets the original COCO [x, y, width, height] pixel boxes of a dataframe as a float32 array of shape [N, 4]."""
+    return df[list(BBOX_COLUMNS)].to_numpy(dtype=np.float32)
+
+
+def coco_columns_to_dataframe(columns, local_image_dir, categorical=False, bbox_lists=False):
+    """Converts COCO instance annotation columns to a dataframe with one row per instance.
+
+    Parameters
+    ----------
+    columns: dict
+        COCO annotation, image, and category columns, see `init_coco_columns`.
+    local_image_dir: str
+        Local directory where the COCO images are stored.
+    categorical: bool
+        If True, the string columns are categorical, which takes much less
+        memory for large datasets. Note that grouping by a categorical column
+        with pandas < 1.1 includes unobserved categories unless
+        `observed=True` is passed.
+    bbox_lists: bool
+        If True, also add the original boxes as a 'bbox' column of
+        [x, y, width, height] lists, as in earlier versions. Building it is
+        slow and memory hungry for large datasets.
+
+    Returns
+    -------
+    df: pd.DataFrame
+        The instance annotations joined with their image and category info,
+        with the original boxes as float32 `BBOX_COLUMNS`, see
+        `get_bbox_array`, and converted to normalized coordinates.
+    """
+    annotations = columns['annotations']
+    images = columns['images']
+    categories = columns['categories']
+
+    # Load annotation info into arrays
     # Original box coordinates are [x,y,width,height], measured from the top left image corner, and 0-indexed
-    df_comb['wmin'] = df_comb['bbox'].str[0] / df_comb['width']
-    df_comb['hmin'] = df_comb['bbox'].str[1] / df_comb['height']
-    df_comb['wmax'] = (df_comb['bbox'].str[0] + df_comb['bbox'].str[2]) / df_comb['width']
-    df_comb['hmax'] = (df_comb['bbox'].str[1] + df_comb['bbox'].str[3]) / df_comb['height']
+    bboxes = np.asarray(annotations['bbox'], dtype=np.float64).reshape(-1, 4)
+    ann_image_ids = np.asarray(annotations['image_id'], dtype=np.int64)
+    ann_category_ids = np.asarray(annotations['category_id'], dtype=np.int64)
+
+    # Load category info into arrays
+    category_ids = np.asarray(categories['id'], dtype=np.int64)
+    category_names_orig = categories['name']
+    category_names = [name.lower().replace(' ', '_') for name in category_names_orig]
+
+    # Load image info into arrays
+    image_ids = np.asarray(images['id'], dtype=np.int64)
+    image_widths = np.asarray(images['width'], dtype=np.int64)
+    image_heights = np.asarray(images['height'], dtype=np.int64)
+    image_filepaths = [os.path.join(local_image_dir, file_name) for file_name in images['file_name']]
+
+    # Combine all info into single dataframe
+    category_inds = _get_lookup_inds(category_ids, ann_category_ids, 'category')
+    image_inds = _get_lookup_inds(image_ids, ann_image_ids, 'image')
+    widths = image_widths[image_inds]
+    heights = image_heights[image_inds]
+    bboxes_float32 = bboxes.astype(np.float32)
+    df_comb = pd.DataFrame({
+        'iscrowd': np.asarray(annotations['iscrowd'], dtype=np.int64),
+        'image_id': ann_image_ids,
+        **({'bbox': bboxes.tolist()} if bbox_lists else {}),
+        **{name: bboxes_float32[:, ind] for ind, name in enumerate(BBOX_COLUMNS)},
+        'category_id': ann_category_ids,
+        'instance_id': np.asarray(annotations['id'], dtype=np.int64),
+        'category_name': _lookup_strings(category_inds, category_names, categorical),
+        'category_name_orig': _lookup_strings(category_inds, category_names_orig, categorical),
+        'coco_url': _lookup_strings(image_inds, images['coco_url'], categorical),
+        'height': heights,
+        'width': widths,
+        'image_filepath': _lookup_strings(image_inds, image_filepaths, categorical),
+        # Convert bounding boxes to normalized coordinates, from the full precision boxes
+        'wmin': bboxes[:, 0] / widths,
+        'hmin': bboxes[:, 1] / heights,
+        'wmax': (bboxes[:, 0] + bboxes[:, 2]) / widths,
+        'hmax': (bboxes[:, 1] + bboxes[:, 3]) / heights,
+    })
+
+    return df_comb
+
+
+def coco_instances_to_dataframe(instances, local_image_dir, categorical=False, bbox_lists=False):
+    """Converts decoded COCO instance annotations to a dataframe with one row per instance.
+
+    Parameters
+    ----------
+    instances: dict
+        Decoded COCO instance annotations, with 'annotations', 'images', and
+        'categories' lists.
+    local_image_dir: str
+        Local directory where the COCO images are stored.
+    categorical: bool
+        If True, the string columns are categorical, see
+        `coco_columns_to_dataframe`.
+    bbox_lists: bool
+        If True, also add a 'bbox' column of lists, see
+        `coco_columns_to_dataframe`.
+
+    Returns
+    -------
+    df: pd.DataFrame
+        The instance annotations joined with their image and category info,
+        see `coco_columns_to_dataframe`.
+    """
+    return coco_columns_to_dataframe(
+        coco_instances_to_columns(instances), local_image_dir, categorical=categorical, bbox_lists=bbox_lists)
+
+
+def stream_coco_columns(annotations_filepath, chunk_size=2 ** 20):
+    """Incrementally parses a COCO instances json file into columns.
+
+    Each annotation, image, and category is decoded one at a time and only its
+    fields listed in `COCO_FIELDS` are kept, so peak memory scales with the
+    retained columns rather than the size of the file.
+
+    Parameters
+    ----------
+    annotations_filepath: str
+        Filepath of a COCO style instances json file.
+    chunk_size: int
+        The number of characters read from the file at a time.
+
+    Returns
+    -------
+    columns: dict
+        The retained COCO annotation, image, and category columns, see
+        `init_coco_columns`.
+    """
+    columns = init_coco_columns()
+    with open(annotations_filepath, 'r') as fp:
+        parser = JsonStreamParser(fp, chunk_size=chunk_size, object_pairs_hook=_drop_segmentation)
+        for array_key, item in parser.iter_items(array_keys=COCO_FIELDS):
+            if array_key in COCO_FIELDS:
+                append_coco_item(columns, array_key, item)
+    return columns
+
+
+def save_dataframe_cache(df, cache_filepath, metadata):
+    """Saves a dataframe of numeric, string, categorical, and fixed length list columns to an uncompressed .npz file.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        The dataframe to save.
+    cache_filepath: str
+        Filepath of the cache file.
+    metadata: dict
+        JSON serializable info stored with the dataframe, used to check if
+        the cache is still valid.
+    """
+    arrays = {
+        '__columns__': np.array(df.columns, dtype=str),
+        '__metadata__': np.array(json.dumps(metadata)),
+    }
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            arrays[col + '__codes'] = df[col].cat.codes.values
+            arrays[col + '__categories'] = np.array(df[col].cat.categories, dtype=str)
+        elif df[col].dtype == object and len(df) and isinstance(df[col].iloc[0], list):
+            arrays[col + '__lists'] = np.array(df[col].tolist())
+        elif pd.api.types.is_string_dtype(df[col].dtype):
+            arrays[col + '__strings'] = np.array(df[col].values, dtype=str)
+        else:
+            arrays[col] = df[col].values
+
+    # Write to a temporary file first so an interrupted write never leaves a corrupt cache
+    tmp_filepath = cache_filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as fp:
+        np.savez(fp, **arrays)
+    os.replace(tmp_filepath, cache_filepath)
+
+
+def load_dataframe_cache(cache_filepath, metadata=None):
+    """Loads a dataframe saved by `save_dataframe_cache`.
+
+    Parameters
+    ----------
+    cache_filepath: str
+        Filepath of the cache file.
+    metadata: dict
+        If provided, the cache is only loaded if it was saved with the same
+        metadata.
+
+    Returns
+    -------
+    df: pd.DataFrame or None
+        The loaded dataframe, or None if the cache does not exist or its
+        metadata does not match.
+    """
+    if not os.path.exists(cache_filepath):
+        return None
+
+    with np.load(cache_filepath, allow_pickle=False) as arrays:
+        if metadata is not None and json.loads(str(arrays['__metadata__'])) != metadata:
+            return None
+        columns = {}
+        for col in arrays['__columns__'].tolist():
+            if col + '__codes' in arrays:
+                columns[col] = pd.Categorical.from_codes(
+                    arrays[col + '__codes'], categories=arrays[col + '__categories'].tolist())
+            elif col + '__lists' in arrays:
+                columns[col] = arrays[col + '__lists'].tolist()
+            elif col + '__strings' in arrays:
+                columns[col] = arrays[col + '__strings'].astype(object)
+            else:
+                columns[col] = arrays[col]
+    return pd.DataFrame(columns)
+
+
+def load_coco_annotations_as_dataframe(annotations_filepath, local_image_dir, cache_filepath=None,
+                                       streaming=False, categorical=False, bbox_lists=False):
+    """Loads COCO instance annotations as a dataframe with one row per instance.
+
+    Parameters
+    ----------
+    annotations_filepath: str
+        Filepath of a COCO instances json file, e.g. instances_train2017.json.
+    local_image_dir: str
+        Local directory where the COCO images are stored.
+    cache_filepath: str
+        If provided, the parsed dataframe is saved to this .npz file, and is
+        reloaded from it on later calls as long as the annotations file and
+        image directory are unchanged.
+    streaming: bool
+        If True, parse the annotations file incrementally, see
+        `stream_coco_columns`. This is slower, but avoids holding the full
+        decoded file in memory, which matters for very large annotation files.
+    categorical: bool
+        If True, the string columns are categorical, see
+        `coco_columns_to_dataframe`.
+    bbox_lists: bool
+        If True, also add a 'bbox' column of lists, see
+        `coco_columns_to_dataframe`.
+
+    Returns
+    -------
+    df: pd.DataFrame
+        The instance annotations joined with their image and category info,
+        with the original boxes as float32 `BBOX_COLUMNS`, and converted to
+        normalized coordinates (wmin, hmin, wmax, hmax).
+    """
+    if cache_filepath is not None:
+        stat = os.stat(annotations_filepath)
+        cache_metadata = {
+            'version': DATAFRAME_CACHE_VERSION,
+            'annotations_filepath': os.path.abspath(annotations_filepath),
+            'annotations_mtime_ns': stat.st_mtime_ns,
+            'annotations_size': stat.st_size,
+            'local_image_dir': local_image_dir,
+            'categorical': categorical,
+            'bbox_lists': bbox_lists,
+        }
+        df_comb = load_dataframe_cache(cache_filepath, metadata=cache_metadata)
+        if df_comb is not None:
+            return df_comb
+
+    # Load raw data from disk
+    if streaming:
+        columns = stream_coco_columns(annotations_filepath)
+    else:
+        with open(annotations_filepath, 'r') as fp:
+            instances = json.load(fp, object_pairs_hook=_drop_segmentation)
+        columns = coco_instances_to_columns(instances)
+        del instances
+
+    df_comb = coco_columns_to_dataframe(columns, local_image_dir, categorical=categorical, bbox_lists=bbox_lists)
+
+    if cache_filepath is not None:
+        save_dataframe_cache(df_comb, cache_filepath, cache_metadata)
 
     return df_comb
@@ -0,0 +1,471 @@
+"""Offline COCO style evaluation of object detections stored in TFRecords.
+
+Reads the records written by the Tensorflow object detection API's
+`infer_detections.py`, which hold the ground truth features of each example
+together with its 'image/detection/*' features, and computes the COCO box
+metrics mAP@[.5:.95], mAP@.5, mAP@.75, mAP and AR@100 by box area, and AR@1,
+AR@10, AR@100. Records are parsed without Tensorflow, see
+`partial_data.tfrecord_scanner`, IoU matrices are computed with vectorized
+numpy ops, detections are matched at every IoU threshold and area range at
+once, and categories can be evaluated in parallel worker processes.
+
+Matching, interpolation, and averaging follow pycocotools' COCOeval, so
+metrics are the same as those of the object detection API's
+`offline_eval_map_corloc.py` with 'coco_detection_metrics', and
+`write_metrics_csv` writes them in the same metrics.csv layout.
+
+For models trained on partially labeled data, `evaluate_detections` can
+ignore the detections of classes that are not labeled in an image, so they
+are not counted as false positives.
+
+Usage, from the repository root:
+    python -m partial_data.evaluation --input 'test_detections.tfrecord-*' --eval-dir ./evaluate --num-workers 4
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from partial_data.label_mask import LABELED_CLASSES_FEATURE, LABELED_MASK_FEATURE, get_labeled_class_ids
+from partial_data.tfrecord_scanner import iter_examples
+
+
+# Names of the metrics, in the order they are written to metrics.csv by the object detection API
+METRIC_NAMES = (
+    'DetectionBoxes_Precision/mAP',
+    'DetectionBoxes_Precision/mAP@.50IOU',
+    'DetectionBoxes_Precision/mAP@.75IOU',
+    'DetectionBoxes_Precision/mAP (small)',
+    'DetectionBoxes_Precision/mAP (medium)',
+    'DetectionBoxes_Precision/mAP (large)',
+    'DetectionBoxes_Recall/AR@1',
+    'DetectionBoxes_Recall/AR@10',
+    'DetectionBoxes_Recall/AR@100',
+    'DetectionBoxes_Recall/AR@100 (small)',
+    'DetectionBoxes_Recall/AR@100 (medium)',
+    'DetectionBoxes_Recall/AR@100 (large)',
+)
+# The evaluation parameters of pycocotools' COCOeval for boxes
+IOU_THRESHOLDS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+RECALL_THRESHOLDS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+MAX_DETECTIONS = (1, 10, 100)
+AREA_RANGES = OrderedDict([
+    ('all', (0 ** 2, 1e5 ** 2)),
+    ('small', (0 ** 2, 32 ** 2)),
+    ('medium', (32 ** 2, 96 ** 2)),
+    ('large', (96 ** 2, 1e5 ** 2)),
+])
+
+GROUNDTRUTH_BOX_FEATURES = (
+    'image/object/bbox/ymin',
+    'image/object/bbox/xmin',
+    'image/object/bbox/ymax',
+    'image/object/bbox/xmax',
+)
+DETECTION_BOX_FEATURES = (
+    'image/detection/bbox/ymin',
+    'image/detection/bbox/xmin',
+    'image/detection/bbox/ymax',
+    'image/detection/bbox/xmax',
+)
+EVALUATION_FEATURES = GROUNDTRUTH_BOX_FEATURES + DETECTION_BOX_FEATURES + (
+    'image/height',
+    'image/width',
+    'image/object/class/label',
+    'image/object/is_crowd',
+    'image/detection/label',
+    'image/detection/score',
+    LABELED_CLASSES_FEATURE,
+    LABELED_MASK_FEATURE,
+)
+
+
+def compute_iou_matrix(boxes1, boxes2, is_crowd=None):
+    """Computes the intersection over union of every pair of boxes.
+
+    Parameters
+    ----------
+    boxes1: np.ndarray
+        A float array of shape [N, 4] of (ymin, xmin, ymax, xmax) boxes, e.g.
+        detections.
+    boxes2: np.ndarray
+        A float array of shape [M, 4] of (ymin, xmin, ymax, xmax) boxes, e.g.
+        ground truth.
+    is_crowd: np.ndarray
+        An optional boolean array of shape [M]. As in COCO, the overlap with
+        a crowd box is the intersection over the area of the box in `boxes1`.
+
+    Returns
+    -------
+    iou: np.ndarray
+        A float array of shape [N, M].
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    heights = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2]) - np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    widths = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3]) - np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    intersection = np.clip(heights, 0, None) * np.clip(widths, 0, None)
+    areas1 = get_box_areas(boxes1)
+    union = areas1[:, None] + get_box_areas(boxes2)[None, :] - intersection
+    if is_crowd is not None:
+        union = np.where(np.asarray(is_crowd, dtype=bool)[None, :], areas1[:, None], union)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, intersection / union, 0.0)
+
+
+def get_box_areas(boxes):
+    """Computes the areas of (ymin, xmin, ymax, xmax) boxes."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def _stack_boxes(features, box_features):
+    if any(features.get(name, None) is None for name in box_features):
+        return np.zeros((0, 4), dtype=np.float64)
+    return np.stack([features[name] for name in box_features], axis=1).astype(np.float64)
+
+
+def parse_detection_example(features, ignore_unlabeled_classes=False, absolute_box_areas=False):
+    """Extracts the ground truth and detections of one image from its parsed features.
+
+    Parameters
+    ----------
+    features: dict
+        Features parsed with `partial_data.tfrecord_scanner.parse_example`,
+        including `EVALUATION_FEATURES`.
+    ignore_unlabeled_classes: bool
+        If True, detections of classes that are not labeled in the image are
+        dropped. Images with no labeled classes feature keep all detections.
+    absolute_box_areas: bool
+        If True, box areas are in pixels, using 'image/height' and
+        'image/width', so the small, medium, and large area ranges are those of
+        COCO. Otherwise they are computed from the normalized boxes, as the
+        object detection API does, which puts every box in the small range.
+
+    Returns
+    -------
+    image: dict
+        The 'groundtruth_boxes', 'groundtruth_classes', 'groundtruth_is_crowd',
+        'groundtruth_areas', 'detection_boxes', 'detection_classes',
+        'detection_scores', and 'detection_areas' of the image.
+    """
+    groundtruth_boxes = _stack_boxes(features, GROUNDTRUTH_BOX_FEATURES)
+    detection_boxes = _stack_boxes(features, DETECTION_BOX_FEATURES)
+    groundtruth_classes = features.get('image/object/class/label', None)
+    groundtruth_classes = groundtruth_classes if groundtruth_classes is not None else np.zeros(0, dtype=np.int64)
+    is_crowd = features.get('image/object/is_crowd', None)
+    is_crowd = is_crowd.astype(bool) if is_crowd is not None and len(is_crowd) else np.zeros(
+        len(groundtruth_classes), dtype=bool)
+    detection_classes = features.get('image/detection/label', None)
+    detection_classes = detection_classes if detection_classes is not None else np.zeros(0, dtype=np.int64)
+    detection_scores = features.get('image/detection/score', None)
+    detection_scores = detection_scores if detection_scores is not None else np.zeros(0, dtype=np.float32)
+
+    if ignore_unlabeled_classes:
+        labeled_classes = get_labeled_class_ids(features)
+        if labeled_classes is not None:
+            keep = np.isin(detection_classes, labeled_classes)
+            detection_boxes = detection_boxes[keep]
+            detection_classes = detection_classes[keep]
+            detection_scores = detection_scores[keep]
+
+    area_scale = 1.0
+    if absolute_box_areas:
+        area_scale = float(features['image/height'][0]) * float(features['image/width'][0])
+    return {
+        'groundtruth_boxes': groundtruth_boxes,
+        'groundtruth_classes': groundtruth_classes,
+        'groundtruth_is_crowd': is_crowd,
+        'groundtruth_areas': get_box_areas(groundtruth_boxes) * area_scale,
+        'detection_boxes': detection_boxes,
+        'detection_classes': detection_classes,
+        'detection_scores': detection_scores.astype(np.float64),
+        'detection_areas': get_box_areas(detection_boxes) * area_scale,
+    }
+
+
+def _match_detections(ious, groundtruth_ignore, groundtruth_is_crowd, iou_thresholds):
+    # Greedily matches detections, sorted by decreasing score, to ground truth at every area range and IoU
+    # threshold at once, as in COCOeval.evaluateImg. Each detection is matched to the unmatched ground truth with
+    # the highest IoU above the threshold, preferring ground truth that is not ignored, and crowd ground truth can
+    # be matched repeatedly. Returns whether each detection is matched, and whether its match is ignored, as
+    # boolean arrays of shape [num_area_ranges, num_iou_thresholds, num_detections].
+    num_areas, num_groundtruth = groundtruth_ignore.shape
+    num_thresholds = len(iou_thresholds)
+    num_detections = ious.shape[0]
+    num_rows = num_areas * num_thresholds
+    ignore = np.repeat(groundtruth_ignore, num_thresholds, axis=0)
+    thresholds = np.tile(iou_thresholds, num_areas)[:, None]
+    rows = np.arange(num_rows)
+
+    groundtruth_taken = np.zeros((num_rows, num_groundtruth), dtype=bool)
+    detection_matched = np.zeros((num_rows, num_detections), dtype=bool)
+    detection_ignore = np.zeros((num_rows, num_detections), dtype=bool)
+    if num_groundtruth:
+        # Detections that overlap no ground truth enough at any threshold stay unmatched
+        for detection_ind in np.nonzero(ious.max(axis=1) >= iou_thresholds.min())[0]:
+            detection_ious = ious[detection_ind]
+            scores = np.where((detection_ious >= thresholds) & ~groundtruth_taken, detection_ious, -1.0)
+            kept_scores = np.where(ignore, -1.0, scores)
+            scores = np.where(kept_scores.max(axis=1, keepdims=True) >= 0, kept_scores, np.where(ignore, scores, -1.0))
+            # Ties go to the last ground truth, as in COCOeval
+            best = num_groundtruth - 1 - np.argmax(scores[:, ::-1], axis=1)
+            matched = scores[rows, best] >= 0
+            matched_rows = rows[matched]
+            matched_groundtruth = best[matched]
+            groundtruth_taken[matched_rows, matched_groundtruth] = ~groundtruth_is_crowd[matched_groundtruth]
+            detection_matched[matched_rows, detection_ind] = True
+            detection_ignore[matched_rows, detection_ind] = ignore[matched_rows, matched_groundtruth]
+
+    shape = (num_areas, num_thresholds, num_detections)
+    return detection_matched.reshape(shape), detection_ignore.reshape(shape)
+
+
+def _evaluate_image_category(groundtruth_boxes, groundtruth_is_crowd, groundtruth_areas, detection_boxes,
+                             detection_scores, detection_areas, area_ranges, max_detections):
+    # Evaluates the detections of one category in one image at every area range, see COCOeval.evaluateImg
+    order = np.argsort(-detection_scores, kind='mergesort')[:max_detections]
+    detection_boxes = detection_boxes[order]
+    detection_scores = detection_scores[order]
+    detection_areas = detection_areas[order]
+
+    area_min = area_ranges[:, :1]
+    area_max = area_ranges[:, 1:]
+    groundtruth_ignore = (groundtruth_is_crowd[None, :] | (groundtruth_areas[None, :] < area_min)
+                          | (groundtruth_areas[None, :] > area_max))
+    detection_out_of_range = (detection_areas[None, :] < area_min) | (detection_areas[None, :] > area_max)
+
+    ious = compute_iou_matrix(detection_boxes, groundtruth_boxes, is_crowd=groundtruth_is_crowd)
+    matched, ignore = _match_detections(ious, groundtruth_ignore, groundtruth_is_crowd, IOU_THRESHOLDS)
+    # Unmatched detections outside of the area range are ignored
+    ignore |= ~matched & detection_out_of_range[:, None, :]
+    return detection_scores, matched, ignore, np.count_nonzero(~groundtruth_ignore, axis=1)
+
+
+def _accumulate(image_results, num_areas):
+    # Computes the interpolated precision, of shape [num_iou_thresholds, num_recall_thresholds, num_area_ranges,
+    # num_max_detections], and recall, of shape [num_iou_thresholds, num_area_ranges, num_max_detections], of one
+    # category, see COCOeval.accumulate. Both are -1 where there is no ground truth that is not ignored.
+    num_thresholds = len(IOU_THRESHOLDS)
+    precision = -np.ones((num_thresholds, len(RECALL_THRESHOLDS), num_areas, len(MAX_DETECTIONS)))
+    recall = -np.ones((num_thresholds, num_areas, len(MAX_DETECTIONS)))
+    if not image_results:
+        return precision, recall
+
+    num_kept_groundtruth = np.sum([result[3] for result in image_results], axis=0)
+    for max_det_ind, max_detections in enumerate(MAX_DETECTIONS):
+        scores = np.concatenate([result[0][:max_detections] for result in image_results])
+        order = np.argsort(-scores, kind='mergesort')
+        matched = np.concatenate([result[1][:, :, :max_detections] for result in image_results], axis=2)[:, :, order]
+        ignore = np.concatenate([result[2][:, :, :max_detections] for result in image_results], axis=2)[:, :, order]
+        true_positives = np.cumsum(matched & ~ignore, axis=2).astype(np.float64)
+        false_positives = np.cumsum(~matched & ~ignore, axis=2).astype(np.float64)
+        num_detections = len(scores)
+
+        for area_ind in range(num_areas):
+            num_groundtruth = num_kept_groundtruth[area_ind]
+            if num_groundtruth == 0:
+                continue
+            for threshold_ind in range(num_thresholds):
+                tp = true_positives[area_ind, threshold_ind]
+                fp = false_positives[area_ind, threshold_ind]
+                rc = tp / num_groundtruth
+                pr = tp / (fp + tp + np.spacing(1))
+                recall[threshold_ind, area_ind, max_det_ind] = rc[-1] if num_detections else 0
+                # Make precision monotonically decreasing, then sample it at the recall thresholds
+                pr = np.maximum.accumulate(pr[::-1])[::-1]
+                inds = np.searchsorted(rc, RECALL_THRESHOLDS, side='left')
+                valid = inds < num_detections
+                q = np.zeros(len(RECALL_THRESHOLDS))
+                q[valid] = pr[inds[valid]]
+                precision[threshold_ind, :, area_ind, max_det_ind] = q
+    return precision, recall
+
+
+def _evaluate_category(category_images, area_ranges):
+    # Evaluates one category over all images that have ground truth or detections of it
+    image_results = [
+        _evaluate_image_category(*image, area_ranges=area_ranges, max_detections=MAX_DETECTIONS[-1])
+        for image in category_images
+    ]
+    return _accumulate(image_results, len(area_ranges))
+
+
+def _group_by_category(images):
+    # Splits the ground truth and detections of every image by category
+    category_images = defaultdict(list)
+    for image in images:
+        groundtruth_classes = image['groundtruth_classes']
+        detection_classes = image['detection_classes']
+        for category in np.unique(groundtruth_classes):
+            groundtruth_mask = groundtruth_classes == category
+            detection_mask = detection_classes == category
+            category_images[int(category)].append((
+                image['groundtruth_boxes'][groundtruth_mask],
+                image['groundtruth_is_crowd'][groundtruth_mask],
+                image['groundtruth_areas'][groundtruth_mask],
+                image['detection_boxes'][detection_mask],
+                image['detection_scores'][detection_mask],
+                image['detection_areas'][detection_mask],
+            ))
+        # Detections of categories with no ground truth in the image are all false positives
+        for category in np.setdiff1d(detection_classes, groundtruth_classes):
+            detection_mask = detection_classes == category
+            category_images[int(category)].append((
+                np.zeros((0, 4)),
+                np.zeros(0, dtype=bool),
+                np.zeros(0),
+                image['detection_boxes'][detection_mask],
+                image['detection_scores'][detection_mask],
+                image['detection_areas'][detection_mask],
+            ))
+    return category_images
+
+
+def _summarize(values, iou_threshold_ind=None, area_ind=0, max_det_ind=-1):
+    # Averages precision or recall over the categories and thresholds with ground truth, see COCOeval.summarize
+    values = values[iou_threshold_ind] if iou_threshold_ind is not None else values
+    values = values[..., area_ind, max_det_ind]
+    values = values[values > -1]
+    return float(np.mean(values)) if values.size else -1.0
+
+
+def evaluate_detections(images, num_workers=1, return_per_category=False):
+    """Computes the COCO box metrics of detections.
+
+    Parameters
+    ----------
+    images: iterable(dict)
+        The ground truth and detections of each image, see
+        `parse_detection_example`.
+    num_workers: int
+        The number of worker processes evaluating categories in parallel.
+    return_per_category: bool
+        If True, also return the mAP@[.5:.95] of every category.
+
+    Returns
+    -------
+    metrics: OrderedDict
+        A map from each of `METRIC_NAMES` to its value, which is -1 if there
+        is no ground truth to compute it from.
+    per_category_ap: dict
+        Returned if `return_per_category` is True. A map from category id to
+        its mAP@[.5:.95], only for categories with ground truth.
+    """
+    category_images = _group_by_category(images)
+    # Only categories with ground truth count towards the metrics
+    category_ids = sorted(
+        category for category, category_image in category_images.items()
+        if any(len(image[0]) for image in category_image)
+    )
+    area_ranges = np.array(list(AREA_RANGES.values()))
+    if num_workers <= 1:
+        results = [_evaluate_category(category_images[category], area_ranges) for category in category_ids]
+    else:
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            results = pool.starmap(
+                _evaluate_category, [(category_images[category], area_ranges) for category in category_ids])
+
+    num_thresholds = len(IOU_THRESHOLDS)
+    num_recall_thresholds = len(RECALL_THRESHOLDS)
+    precision = np.stack([result[0] for result in results], axis=2) if results else -np.ones(
+        (num_thresholds, num_recall_thresholds, 0, len(AREA_RANGES), len(MAX_DETECTIONS)))
+    recall = np.stack([result[1] for result in results], axis=1) if results else -np.ones(
+        (num_thresholds, 0, len(AREA_RANGES), len(MAX_DETECTIONS)))
+
+    area_inds = {name: ind for ind, name in enumerate(AREA_RANGES)}
+    threshold_50 = int(np.argwhere(np.isclose(IOU_THRESHOLDS, .5))[0, 0])
+    threshold_75 = int(np.argwhere(np.isclose(IOU_THRESHOLDS, .75))[0, 0])
+    values = (
+        _summarize(precision),
+        _summarize(precision, iou_threshold_ind=threshold_50),
+        _summarize(precision, iou_threshold_ind=threshold_75),
+        _summarize(precision, area_ind=area_inds['small']),
+        _summarize(precision, area_ind=area_inds['medium']),
+        _summarize(precision, area_ind=area_inds['large']),
+        _summarize(recall, max_det_ind=0),
+        _summarize(recall, max_det_ind=1),
+        _summarize(recall, max_det_ind=2),
+        _summarize(recall, area_ind=area_inds['small']),
+        _summarize(recall, area_ind=area_inds['medium']),
+        _summarize(recall, area_ind=area_inds['large']),
+    )
+    metrics = OrderedDict(zip(METRIC_NAMES, values))
+    if not return_per_category:
+        return metrics
+    per_category_ap = {
+        category: _summarize(precision[:, :, [ind]]) for ind, category in enumerate(category_ids)
+    }
+    return metrics, per_category_ap
+
+
+def evaluate_detection_tfrecords(filepaths, num_workers=1, ignore_unlabeled_classes=False, absolute_box_areas=False,
+                                 return_per_category=False):
+    """Computes the COCO box metrics of detections stored in TFRecords.
+
+    Parameters
+    ----------
+    filepaths: str or list(str)
+        One or more filepaths or glob patterns of TFRecords with ground truth
+        and detection features, as written by the object detection API's
+        `infer_detections.py`.
+    num_workers: int
+        The number of worker processes evaluating categories in parallel.
+    ignore_unlabeled_classes: bool
+        If True, detections of classes that are not labeled in an image are
+        dropped, see `parse_detection_example`.
+    absolute_box_areas: bool
+        If True, box areas are in pixels, see `parse_detection_example`.
+    return_per_category: bool
+        If True, also return the mAP@[.5:.95] of every category.
+
+    Returns
+    -------
+    See `evaluate_detections`.
+    """
+    images = (
+        parse_detection_example(features, ignore_unlabeled_classes=ignore_unlabeled_classes,
+                                absolute_box_areas=absolute_box_areas)
+        for features in iter_examples(filepaths, feature_names=EVALUATION_FEATURES)
+    )
+    return evaluate_detections(images, num_workers=num_workers, return_per_category=return_per_category)
+
+
+def write_metrics_csv(metrics, filepath):
+    """Writes metrics as 'name,value' rows with no header, like the object detection API's metrics.csv."""
+    with open(filepath, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        for name, value in metrics.items():
+            writer.writerow([name, float(value)])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--input', nargs='+', required=True,
+                        help='Filepaths or glob patterns of TFRecords with ground truth and detections')
+    parser.add_argument('--eval-dir', required=True, help='Directory metrics.csv is written to')
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--ignore-unlabeled-classes', action='store_true',
+                        help='Ignore detections of classes that are not labeled in an image')
+    parser.add_argument('--absolute-box-areas', action='store_true',
+                        help='Compute box areas in pixels, so the small, medium, and large metrics are those of COCO')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv if argv is not None else sys.argv[1:])
+    metrics = evaluate_detection_tfrecords(
+        args.input, num_workers=args.num_workers, ignore_unlabeled_classes=args.ignore_unlabeled_classes,
+        absolute_box_areas=args.absolute_box_areas)
+    os.makedirs(args.eval_dir, exist_ok=True)
+    write_metrics_csv(metrics, os.path.join(args.eval_dir, 'metrics.csv'))
+    for name, value in metrics.items():
+        print(f'{name}: {value:.4f}')
+
+
+if __name__ == '__main__':
+    main()
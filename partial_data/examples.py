@@ -0,0 +1,101 @@
+"""Utils for grouping per-instance annotations into per-image examples.
+"""
+from collections.abc import Sequence
+
+import numpy as np
+
+
+DEFAULT_LIST_COLS = ('wmin', 'wmax', 'hmin', 'hmax', 'category_name', 'category_id')
+DEFAULT_FIRST_COLS = ('image_filepath', 'width', 'height', 'labeled_cat_ids')
+
+
+class ImageExamples(Sequence):
+    """A sequence of per-image examples backed by instance columns sorted by image.
+
+    Each example is a dict holding the image id, the per-image values, and
+    views (not copies) of the per-instance values for the image, so examples
+    are cheap to create and can be passed directly to
+    `partial_data.tfrecord.write_examples_as_tfrecord`.
+
+    Parameters
+    ----------
+    image_ids: np.array
+        The id of each image.
+    offsets: np.array
+        Instance offsets of each image, of length len(image_ids) + 1. The
+        instances of image i are rows offsets[i]:offsets[i+1] of `list_arrays`.
+    list_arrays: dict
+        A map from column name to per-instance values, sorted by image.
+    first_arrays: dict
+        A map from column name to per-image values.
+    image_id_col: str
+        The example key holding the image id.
+    """
+
+    def __init__(self, image_ids, offsets, list_arrays, first_arrays, image_id_col='image_id'):
+        self.image_ids = image_ids
+        self.offsets = offsets
+        self.list_arrays = list_arrays
+        self.first_arrays = first_arrays
+        self.image_id_col = image_id_col
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(len(self)))]
+        if ind < 0:
+            ind += len(self)
+        if not 0 <= ind < len(self):
+            raise IndexError('ImageExamples index out of range')
+        start, end = self.offsets[ind], self.offsets[ind + 1]
+        example = {self.image_id_col: self.image_ids[ind].item()}
+        for col, values in self.first_arrays.items():
+            example[col] = values[ind]
+        for col, values in self.list_arrays.items():
+            example[col] = values[start:end]
+        return example
+
+
+def group_examples_by_image(df, list_cols=DEFAULT_LIST_COLS, first_cols=DEFAULT_FIRST_COLS,
+                            image_id_col='image_id'):
+    """Groups per-instance annotations into per-image examples.
+
+    This is a fast replacement for grouping with
+    `df.groupby('image_id').agg(...)` and iterating over the rows: instances are
+    sorted by image once, and each example holds slices of the sorted columns.
+    Examples are ordered by image id.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Annotations with one row per instance, e.g. from
+        `partial_data.coco.load_coco_annotations_as_dataframe`.
+    list_cols: iterable(str)
+        Columns whose per-instance values are collected for each image.
+    first_cols: iterable(str)
+        Columns with one value per image, which is taken from the image's first
+        instance. Columns missing from `df` are skipped.
+    image_id_col: str
+        The column holding image ids.
+
+    Returns
+    -------
+    examples: ImageExamples
+        A sequence of per-image examples.
+    """
+    image_ids = df[image_id_col].values
+    order = np.argsort(image_ids, kind='stable')
+    sorted_image_ids = image_ids[order]
+
+    # Find where each image's instances start in the sorted order
+    is_start = np.ones(len(sorted_image_ids), dtype=bool)
+    is_start[1:] = sorted_image_ids[1:] != sorted_image_ids[:-1]
+    starts = np.flatnonzero(is_start)
+    offsets = np.append(starts, len(sorted_image_ids))
+
+    list_arrays = {col: np.asarray(df[col].values)[order] for col in list_cols}
+    first_arrays = {col: np.asarray(df[col].values)[order[starts]] for col in first_cols if col in df.columns}
+
+    return ImageExamples(sorted_image_ids[starts], offsets, list_arrays, first_arrays, image_id_col=image_id_col)
@@ -0,0 +1,224 @@
+"""On-disk cache of per-image metadata used when encoding tf.Examples.
+
+Dataset versions built from the same images (e.g. different partial-label
+variants) only differ in their annotation fields, so the image hash, size,
+and format computed for an image can be reused as long as the image file
+has not changed.
+"""
+import os
+import sqlite3
+import time
+from multiprocessing.util import Finalize
+
+from partial_data.instrumentation import count
+
+
+def _flush_touches(conn, touches):
+    # Writes the pending last used times of cache hits in a single transaction
+    if not touches:
+        return
+    conn.execute('BEGIN')
+    try:
+        conn.executemany('UPDATE image_metadata SET last_used = ? WHERE filepath = ?',
+                         [(last_used, filepath) for filepath, last_used in touches.items()])
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    touches.clear()
+
+
+def _flush_and_close(conn, touches):
+    try:
+        _flush_touches(conn, touches)
+    finally:
+        conn.close()
+
+
+class ImageMetadataCache:
+    """A size-bounded, on-disk cache of image metadata backed by SQLite.
+
+    Entries are keyed by the absolute image filepath and are only valid while
+    the file's modification time and size are unchanged. When the number of
+    entries exceeds `max_entries`, the least recently used entries are evicted.
+
+    Cache hits only update the last used time of their entry in memory, and
+    the times are written in batches of `touch_batch_size`, before evicting,
+    and on `close`, so lookups do not take the database write lock.
+
+    The cache can be pickled, e.g. bound to the encoder passed to
+    `write_examples_as_tfrecord`, which sends it to each worker process once.
+    Each copy opens its own connection, closed when the copy is garbage
+    collected or its process exits, and keeps its own hit/miss counters. Hits
+    and misses are also counted as 'image_cache/hits' and 'image_cache/misses'
+    by the active `partial_data.instrumentation.Instrumentation`, which
+    gathers the counts of all worker processes.
+
+    Parameters
+    ----------
+    cache_filepath: str
+        Filepath of the SQLite database holding the cache.
+    max_entries: int
+        The maximum number of images to keep metadata for.
+    touch_batch_size: int
+        The number of cache hits whose last used times are written at once.
+    """
+    _evict_frac = 0.1
+
+    def __init__(self, cache_filepath, max_entries=1000000, touch_batch_size=1000):
+        self.cache_filepath = cache_filepath
+        self.max_entries = max_entries
+        self.touch_batch_size = touch_batch_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = None
+        self._finalizer = None
+        # Pending last used times of cache hits, by filepath
+        self._touches = {}
+        # The number of entries, only counted once entries are added
+        self._num_entries = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update({'_conn': None, '_finalizer': None, '_touches': {}, '_num_entries': None})
+        return state
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.cache_filepath, timeout=60, isolation_level=None)
+            has_table = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'image_metadata'").fetchone()
+            if has_table is None:
+                # WAL mode is persistent, so the schema and journal mode are only set up by the first connection
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS image_metadata ('
+                    'filepath TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, key TEXT, '
+                    'width INTEGER, height INTEGER, format TEXT, last_used REAL)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS last_used_idx ON image_metadata (last_used)')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._conn = conn
+            # Pool workers exit without running atexit handlers, but do run multiprocessing finalizers
+            self._finalizer = Finalize(self, _flush_and_close, args=(conn, self._touches), exitpriority=0)
+        return self._conn
+
+    def get(self, image_filepath):
+        """Looks up the cached metadata of an image.
+
+        Parameters
+        ----------
+        image_filepath: str
+            Filepath of the image.
+
+        Returns
+        -------
+        metadata: dict or None
+            A map with the image `key` (SHA-256 hex digest), `width`, `height`,
+            and `format`, or None if the image is not cached or has changed
+            since it was cached.
+        """
+        filepath = os.path.abspath(image_filepath)
+        stat = os.stat(filepath)
+        row = self.conn.execute(
+            'SELECT key, width, height, format FROM image_metadata '
+            'WHERE filepath = ? AND mtime_ns = ? AND size = ?',
+            (filepath, stat.st_mtime_ns, stat.st_size)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            count('image_cache/misses')
+            return None
+
+        self.hits += 1
+        count('image_cache/hits')
+        self._touches[filepath] = time.time()
+        if len(self._touches) >= self.touch_batch_size:
+            _flush_touches(self.conn, self._touches)
+        key, width, height, image_format = row
+        return {'key': key, 'width': width, 'height': height, 'format': image_format}
+
+    def put(self, image_filepath, key, width, height, image_format):
+        """Stores the metadata of an image, evicting old entries if the cache is full.
+
+        Parameters
+        ----------
+        image_filepath: str
+            Filepath of the image.
+        key: str
+            SHA-256 hex digest of the encoded image.
+        width: int
+            The image width.
+        height: int
+            The image height.
+        image_format: str
+            The PIL format name of the image.
+        """
+        filepath = os.path.abspath(image_filepath)
+        stat = os.stat(filepath)
+        conn = self.conn
+        values = (stat.st_mtime_ns, stat.st_size, key, width, height, image_format, time.time(), filepath)
+        # Only count new entries, not updates of the entries of changed images
+        updated = conn.execute(
+            'UPDATE image_metadata SET mtime_ns = ?, size = ?, key = ?, width = ?, height = ?, format = ?, '
+            'last_used = ? WHERE filepath = ?',
+            values
+        ).rowcount
+        if updated:
+            return
+        # Another process may have added the entry since the update, in which case it is replaced
+        conn.execute(
+            'INSERT OR REPLACE INTO image_metadata '
+            '(mtime_ns, size, key, width, height, format, last_used, filepath) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            values
+        )
+        if self._num_entries is None:
+            self._num_entries = self._count_entries()
+        else:
+            self._num_entries += 1
+        if self._num_entries > self.max_entries:
+            self._evict()
+
+    def _count_entries(self):
+        return self.conn.execute('SELECT COUNT(*) FROM image_metadata').fetchone()[0]
+
+    def _evict(self):
+        # Evict down to below the limit so eviction does not run on every put. Other processes may have added or
+        # evicted entries, so recount them first.
+        _flush_touches(self.conn, self._touches)
+        self._num_entries = self._count_entries()
+        num_evict = self._num_entries - int(self.max_entries * (1 - self._evict_frac))
+        if num_evict <= 0 or self._num_entries <= self.max_entries:
+            return
+        self.conn.execute(
+            'DELETE FROM image_metadata WHERE filepath IN '
+            '(SELECT filepath FROM image_metadata ORDER BY last_used LIMIT ?)',
+            (num_evict,)
+        )
+        self._num_entries -= num_evict
+        self.evictions += num_evict
+
+    def stats(self):
+        """Returns the hit, miss, and eviction counts of this cache instance."""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        self._touches.clear()
+        self.conn.execute('DELETE FROM image_metadata')
+        self._num_entries = 0
+
+    def close(self):
+        """Writes the pending last used times of cache hits and closes the connection."""
+        if self._conn is not None:
+            self._finalizer()
+            self._conn = None
+            self._finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,4 +1,8 @@
 import os
+import struct
+import tempfile
+import threading
+import time
 import requests
 from multiprocessing.dummy import Pool
 from functools import partial
@@ -14,7 +18,7 @@ def download_image(image_url, output_dir):
             img_data = requests.get(image_url).content
             with open(output_filepath, 'wb') as fp:
                 fp.write(img_data)
-    except:
+    except (requests.RequestException, OSError):
         return image_url
     else:
         return None
@@ -27,3 +31,249 @@ def download_images(image_urls, output_dir, num_parallel=1):
             total=len(image_urls)
         ))
     return res
+
+
+# HTTP status codes worth retrying, as they usually indicate a temporary server side problem
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class ImageDownloader:
+    """Downloads images with pooled connections, retries, and throughput stats.
+
+    Each download thread keeps its own requests.Session, so connections to
+    the image host are reused across downloads. Response bodies are streamed to
+    a temporary file in the output directory, which is renamed to its final
+    name once complete, so an interrupted download never leaves a partial image
+    behind. Failed requests are retried with exponential backoff.
+
+    Parameters
+    ----------
+    num_parallel: int
+        The number of downloads in flight at once.
+    timeout: float
+        Timeout in seconds for connecting and for each read from the server.
+    max_retries: int
+        The number of times a failed download is retried.
+    backoff_factor: float
+        Retry i waits backoff_factor * 2 ** i seconds before starting.
+    chunk_size: int
+        The number of bytes written to disk at a time.
+    """
+
+    def __init__(self, num_parallel=8, timeout=30, max_retries=3, backoff_factor=0.5, chunk_size=2 ** 16):
+        self.num_parallel = num_parallel
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def _download(self, image_url, output_filepath):
+        # Returns the number of bytes downloaded, raises on failure
+        with self.session.get(image_url, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(output_filepath) or '.', suffix='.part')
+            num_bytes = 0
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                        fp.write(chunk)
+                        num_bytes += len(chunk)
+                os.replace(tmp_filepath, output_filepath)
+            except BaseException:
+                os.remove(tmp_filepath)
+                raise
+        return num_bytes
+
+    def download_image(self, image_url, output_dir):
+        """Downloads a single image, unless it already exists in the output directory.
+
+        Parameters
+        ----------
+        image_url: str
+            URL of the image.
+        output_dir: str
+            Directory to save the image to, named after the last part of the URL.
+
+        Returns
+        -------
+        result: dict
+            The image URL, the `status` ('downloaded', 'skipped', or 'failed'),
+            the number of `bytes` downloaded, the number of `attempts`, and the
+            failure `reason`, if any. Images that cannot be written to the
+            output directory fail without retries.
+        """
+        img_name = os.path.split(image_url)[-1]
+        output_filepath = os.path.join(output_dir, img_name)
+        result = {'url': image_url, 'status': 'skipped', 'bytes': 0, 'attempts': 0, 'reason': None}
+        if os.path.exists(output_filepath):
+            return result
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff_factor * 2 ** (attempt - 1))
+            result['attempts'] = attempt + 1
+            try:
+                result['bytes'] = self._download(image_url, output_filepath)
+            except requests.HTTPError as exc:
+                result['reason'] = f'HTTP {exc.response.status_code}'
+                if exc.response.status_code not in RETRY_STATUS_CODES:
+                    break
+            except requests.RequestException as exc:
+                result['reason'] = type(exc).__name__
+            except OSError as exc:
+                # Local errors, e.g. a full disk, are not retried
+                result['reason'] = type(exc).__name__
+                break
+            else:
+                result['status'] = 'downloaded'
+                result['reason'] = None
+                return result
+
+        result['status'] = 'failed'
+        return result
+
+    def download_images(self, image_urls, output_dir):
+        """Downloads images in parallel.
+
+        Parameters
+        ----------
+        image_urls: list(str)
+            URLs of the images.
+        output_dir: str
+            Directory to save the images to.
+
+        Returns
+        -------
+        stats: dict
+            Download, skip, and failure counts, total bytes, elapsed seconds,
+            bytes per second, and a map from each failed URL to the reason of
+            its last failed attempt.
+        """
+        start_time = time.time()
+        stats = {'num_downloaded': 0, 'num_skipped': 0, 'num_failed': 0, 'bytes': 0, 'failures': {}}
+        try:
+            with Pool(processes=self.num_parallel) as pool:
+                results = pool.imap_unordered(partial(self.download_image, output_dir=output_dir), image_urls)
+                for result in tqdm.tqdm(results, total=len(image_urls)):
+                    stats['num_' + result['status']] += 1
+                    stats['bytes'] += result['bytes']
+                    if result['status'] == 'failed':
+                        stats['failures'][result['url']] = result['reason']
+        finally:
+            self.close()
+
+        stats['seconds'] = time.time() - start_time
+        stats['bytes_per_sec'] = stats['bytes'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+        return stats
+
+    def close(self):
+        """Closes the connections of all download threads."""
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+        self._local = threading.local()
+
+
+JPEG_SIGNATURE = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# JPEG start-of-frame markers, which hold the image dimensions (excludes DHT, JPG, and DAC markers)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# JPEG markers that are not followed by a segment length
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9}
+
+
+def get_image_format(encoded_img):
+    """Identifies the format of an encoded image from its leading signature bytes.
+
+    Parameters
+    ----------
+    encoded_img: bytes
+        An encoded image.
+
+    Returns
+    -------
+    image_format: str or None
+        The PIL format name of the image ('JPEG' or 'PNG'), or None if the
+        format is not recognized.
+    """
+    if encoded_img.startswith(JPEG_SIGNATURE):
+        return 'JPEG'
+    if encoded_img.startswith(PNG_SIGNATURE):
+        return 'PNG'
+    return None
+
+
+def _get_jpeg_size(encoded_img):
+    offset = len(JPEG_SIGNATURE)
+    num_bytes = len(encoded_img)
+    while offset + 4 <= num_bytes:
+        if encoded_img[offset] != 0xFF:
+            return None
+        marker = encoded_img[offset + 1]
+        if marker == 0xFF:
+            # Fill byte preceding a marker
+            offset += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+        segment_length, = struct.unpack('>H', encoded_img[offset + 2:offset + 4])
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > num_bytes:
+                return None
+            height, width = struct.unpack('>HH', encoded_img[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + segment_length
+    return None
+
+
+def _get_png_size(encoded_img):
+    # The IHDR chunk is required to come first, directly after the signature
+    if len(encoded_img) < 24 or encoded_img[12:16] != b'IHDR':
+        return None
+    width, height = struct.unpack('>II', encoded_img[16:24])
+    return width, height
+
+
+def get_image_metadata_from_header(encoded_img):
+    """Reads the size and format of an encoded image by parsing only its header.
+
+    This avoids decoding the image with PIL, and supports JPEG and PNG images.
+
+    Parameters
+    ----------
+    encoded_img: bytes
+        An encoded image.
+
+    Returns
+    -------
+    metadata: tuple(int, int, str) or None
+        The image width, height, and PIL format name, or None if the header
+        could not be parsed.
+    """
+    image_format = get_image_format(encoded_img)
+    if image_format == 'JPEG':
+        size = _get_jpeg_size(encoded_img)
+    elif image_format == 'PNG':
+        size = _get_png_size(encoded_img)
+    else:
+        size = None
+
+    if size is None or not all(size):
+        return None
+    width, height = size
+    return width, height, image_format
@@ -0,0 +1,274 @@
+"""Optional instrumentation of the TFRecord writing and reading pipelines.
+
+An `Instrumentation` collects per-stage timers with byte counts, counters,
+and gauges (e.g. queue depths), and can profile the pipeline with cProfile.
+Pass one to `partial_data.tfrecord.write_examples_as_tfrecord` or
+`partial_data.tfrecord.iter_examples_from_tfrecord`, then read
+`summary()` or write it with `save_summary`.
+
+Example encoders record their stages through the module level `timer`,
+which reports to the instrumentation activated by the writer, including in
+worker processes. When no instrumentation is active, `timer` returns a shared
+no-op object, so instrumented code costs a function call per stage.
+"""
+import contextlib
+import cProfile
+import json
+import pstats
+import time
+
+
+class _StageTimer:
+    """Times one run of a stage, see `Instrumentation.timer`."""
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.num_bytes = 0
+
+    def add_bytes(self, num_bytes):
+        """Adds to the number of bytes processed by this run of the stage."""
+        self.num_bytes += num_bytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start, num_bytes=self.num_bytes)
+
+
+class _NullTimer:
+    # Stands in for _StageTimer when instrumentation is disabled
+
+    def add_bytes(self, num_bytes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+    """Collects stage timings, counters, and gauges of a pipeline.
+
+    Parameters
+    ----------
+    profile: bool
+        If True, the pipelines this is passed to are also profiled with
+        cProfile, in the main process only. See `get_profile_stats` and
+        `save_profile`.
+    """
+
+    enabled = True
+
+    def __init__(self, profile=False):
+        self.profiler = cProfile.Profile() if profile else None
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.start_time = time.perf_counter()
+
+    def timer(self, name):
+        """Creates a context manager timing one run of a stage.
+
+        The bytes processed by the run can be recorded with `add_bytes` on the
+        object returned when entering the context.
+        """
+        return _StageTimer(self, name)
+
+    def add_time(self, name, seconds, num_bytes=0, count=1):
+        """Records `count` runs of a stage taking `seconds` in total."""
+        stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+        stage['count'] += count
+        stage['seconds'] += seconds
+        stage['bytes'] += num_bytes
+
+    def count(self, name, value=1):
+        """Increments a counter."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """Records a sample of a gauge, e.g. the current depth of a queue."""
+        gauge = self.gauges.setdefault(name, {'count': 0, 'sum': 0, 'max': value, 'last': value})
+        gauge['count'] += 1
+        gauge['sum'] += value
+        gauge['max'] = max(gauge['max'], value)
+        gauge['last'] = value
+
+    def get_state(self):
+        """Gets the raw collected values, e.g. to send from a worker process to `merge`."""
+        return {'stages': self.stages, 'counters': self.counters, 'gauges': self.gauges}
+
+    def merge(self, state):
+        """Merges values collected by another instrumentation, see `get_state`."""
+        for name, stage in state['stages'].items():
+            self.add_time(name, stage['seconds'], num_bytes=stage['bytes'], count=stage['count'])
+        for name, value in state['counters'].items():
+            self.count(name, value)
+        for name, gauge in state['gauges'].items():
+            own_gauge = self.gauges.setdefault(
+                name, {'count': 0, 'sum': 0, 'max': gauge['max'], 'last': gauge['last']})
+            own_gauge['count'] += gauge['count']
+            own_gauge['sum'] += gauge['sum']
+            own_gauge['max'] = max(own_gauge['max'], gauge['max'])
+            own_gauge['last'] = gauge['last']
+
+    @contextlib.contextmanager
+    def profiling(self):
+        """Profiles the code run in this context, if profiling is enabled.
+
+        Can be entered repeatedly, e.g. once per batch, to only profile the
+        pipeline and not the code consuming its output.
+        """
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def get_profile_stats(self, sort_by='cumulative'):
+        """Gets the collected profile as a `pstats.Stats`, or None if profiling is disabled."""
+        if self.profiler is None:
+            return None
+        return pstats.Stats(self.profiler).sort_stats(sort_by)
+
+    def save_profile(self, filepath):
+        """Saves the collected profile to a file readable with `pstats.Stats` or e.g. snakeviz."""
+        self.profiler.dump_stats(filepath)
+
+    def _get_top_functions(self, num_functions):
+        # Summarizes the functions with the highest cumulative time in the profile
+        stats = self.get_profile_stats()
+        top_functions = []
+        for func in stats.fcn_list[:num_functions]:
+            _, num_calls, total_time, cumulative_time, _ = stats.stats[func]
+            filename, line, name = func
+            top_functions.append({
+                'function': f'{filename}:{line}({name})',
+                'num_calls': num_calls,
+                'total_seconds': total_time,
+                'cumulative_seconds': cumulative_time,
+            })
+        return top_functions
+
+    def summary(self, num_profile_functions=20):
+        """Summarizes the collected values.
+
+        Parameters
+        ----------
+        num_profile_functions: int
+            The number of functions with the highest cumulative time listed
+            from the profile, if profiling is enabled.
+
+        Returns
+        -------
+        summary: dict
+            The elapsed wall time, and per-stage run counts, total and mean
+            times, bytes, and throughput, counters, per-gauge sample counts,
+            means, maxima, and last values, and the top profiled functions.
+        """
+        stages = {}
+        for name, stage in sorted(self.stages.items()):
+            stages[name] = {
+                'count': stage['count'],
+                'seconds': stage['seconds'],
+                'mean_ms': 1000 * stage['seconds'] / stage['count'] if stage['count'] else 0.0,
+                'bytes': stage['bytes'],
+                'mb_per_sec': stage['bytes'] / 2 ** 20 / stage['seconds'] if stage['seconds'] > 0 else 0.0,
+            }
+        gauges = {
+            name: {
+                'count': gauge['count'],
+                'mean': gauge['sum'] / gauge['count'],
+                'max': gauge['max'],
+                'last': gauge['last'],
+            }
+            for name, gauge in sorted(self.gauges.items())
+        }
+        return {
+            'wall_seconds': time.perf_counter() - self.start_time,
+            'stages': stages,
+            'counters': dict(sorted(self.counters.items())),
+            'gauges': gauges,
+            'profile': self._get_top_functions(num_profile_functions) if self.profiler is not None else None,
+        }
+
+    def save_summary(self, filepath):
+        """Writes the summary to a json file."""
+        with open(filepath, 'w') as fp:
+            json.dump(self.summary(), fp, indent=2)
+
+
+class _NullInstrumentation:
+    # Stands in for Instrumentation when instrumentation is disabled
+
+    enabled = False
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def add_time(self, name, seconds, num_bytes=0, count=1):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def merge(self, state):
+        pass
+
+    @contextlib.contextmanager
+    def profiling(self):
+        yield
+
+
+NULL_INSTRUMENTATION = _NullInstrumentation()
+_active_instrumentation = NULL_INSTRUMENTATION
+
+
+def get_instrumentation(instrumentation=None):
+    """Gets `instrumentation`, or a no-op stand in if it is None."""
+    return instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+
+
+def get_active_instrumentation():
+    """Gets the instrumentation activated with `activate`, or a no-op stand in if there is none."""
+    return _active_instrumentation
+
+
+@contextlib.contextmanager
+def activate(instrumentation):
+    """Makes `instrumentation` the target of `timer` and the other module level functions in this context."""
+    global _active_instrumentation
+    previous_instrumentation = _active_instrumentation
+    _active_instrumentation = get_instrumentation(instrumentation)
+    try:
+        yield _active_instrumentation
+    finally:
+        _active_instrumentation = previous_instrumentation
+
+
+def timer(name):
+    """Times one run of a stage with the active instrumentation, see `Instrumentation.timer`."""
+    return _active_instrumentation.timer(name)
+
+
+def count(name, value=1):
+    """Increments a counter of the active instrumentation."""
+    _active_instrumentation.count(name, value)
+
+
+def gauge(name, value):
+    """Records a gauge sample with the active instrumentation."""
+    _active_instrumentation.gauge(name, value)
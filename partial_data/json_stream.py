@@ -0,0 +1,120 @@
+"""Incremental parsing of large json files.
+
+Only the top level object of a file is parsed incrementally: each element of
+its array values is decoded and handed to the caller one at a time, so the
+full decoded tree of e.g. a COCO annotations file is never held in memory.
+"""
+import json
+
+
+WHITESPACE = ' \t\n\r'
+# Characters that continue a json number after its integer or fraction part
+NUMBER_CONTINUATION = '.eE'
+
+
+class JsonStreamParser:
+    """Incrementally parses a json file whose top level value is an object.
+
+    Parameters
+    ----------
+    fp: file-like
+        A json file opened in text mode.
+    chunk_size: int
+        The number of characters read from the file at a time.
+    object_pairs_hook: func
+        Passed to json.JSONDecoder, called with the key/value pairs of every
+        decoded object.
+    """
+
+    def __init__(self, fp, chunk_size=2 ** 20, object_pairs_hook=None):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder(object_pairs_hook=object_pairs_hook)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_chunk(self):
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop already parsed text so the buffer only holds the value currently being decoded
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        # Returns the next non-whitespace character, without consuming it
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read_chunk():
+                raise ValueError('Unexpected end of json file')
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError(f'Expected one of {chars!r} in json file, found {char!r}')
+        self.pos += 1
+        return char
+
+    def _decode_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # The value may just be cut off at the end of the buffer
+                if not self._read_chunk():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk, also when the buffer only
+            # holds its integer part, or its fraction without the exponent
+            if (end == len(self.buf) or self.buf[end] in NUMBER_CONTINUATION) and self._read_chunk():
+                continue
+            self.pos = end
+            return value
+
+    def iter_items(self, array_keys=()):
+        """Iterates over the top level object of the file.
+
+        Parameters
+        ----------
+        array_keys: iterable(str)
+            Keys whose array values are iterated over element by element,
+            rather than decoded as a whole.
+
+        Yields
+        ------
+        key: str
+            A key of the top level object.
+        value: object
+            An element of the key's value if it is in `array_keys`, otherwise
+            the full decoded value.
+        """
+        array_keys = set(array_keys)
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._decode_value()
+            self._expect(':')
+            if key in array_keys and self._peek() == '[':
+                self.pos += 1
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield key, self._decode_value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                yield key, self._decode_value()
+            if self._expect(',}') == '}':
+                return
@@ -0,0 +1,87 @@
+"""Packed bitmask representation of the labeled classes of partially labeled examples.
+
+The classes labeled in an image can be stored in a tf.Example either as a
+list of class ids under 'image/class/labeled_classes', or as a fixed width
+bitmask under 'image/class/labeled_mask', where bit k (little endian bit
+order within each byte) is set if class id k is labeled. The bitmask costs
+num_classes / 8 bytes per example regardless of how many classes are labeled,
+and decodes straight into a dense boolean mask. This module does not depend
+on Tensorflow.
+"""
+import numpy as np
+
+
+LABELED_CLASSES_FEATURE = 'image/class/labeled_classes'
+LABELED_MASK_FEATURE = 'image/class/labeled_mask'
+LABELED_CLASSES_FORMATS = ('ids', 'mask', 'both')
+
+
+def get_num_mask_bytes(num_classes):
+    """Gets the size in bytes of a packed mask over `num_classes` class ids."""
+    return (num_classes + 7) // 8
+
+
+def pack_labeled_class_mask(class_ids, num_classes):
+    """Packs labeled class ids into a fixed width bitmask.
+
+    Parameters
+    ----------
+    class_ids: iterable(int)
+        The labeled class ids.
+    num_classes: int
+        The number of bits in the mask, i.e. one more than the largest
+        possible class id.
+
+    Returns
+    -------
+    packed_mask: bytes
+        The packed mask, of `get_num_mask_bytes(num_classes)` bytes.
+    """
+    class_ids = np.asarray(class_ids, dtype=np.int64).reshape(-1)
+    if len(class_ids) and (class_ids.min() < 0 or class_ids.max() >= num_classes):
+        raise ValueError(f'Labeled class ids must be in [0, {num_classes}), got {class_ids.tolist()}')
+    mask = np.zeros(get_num_mask_bytes(num_classes) * 8, dtype=bool)
+    mask[class_ids] = True
+    return np.packbits(mask, bitorder='little').tobytes()
+
+
+def unpack_labeled_class_mask(packed_mask, num_classes=None):
+    """Unpacks a bitmask created by `pack_labeled_class_mask`.
+
+    Parameters
+    ----------
+    packed_mask: bytes-like
+        The packed mask.
+    num_classes: int
+        The number of bits in the mask. If None, all bits of the packed bytes
+        are returned.
+
+    Returns
+    -------
+    mask: np.array
+        A boolean array, True at each labeled class id.
+    """
+    return np.unpackbits(np.frombuffer(packed_mask, dtype=np.uint8), count=num_classes, bitorder='little').astype(bool)
+
+
+def get_labeled_class_ids(features):
+    """Gets the labeled class ids of an example, from whichever labeled-class field it has.
+
+    Parameters
+    ----------
+    features: dict
+        Features parsed with `partial_data.tfrecord_scanner.parse_example`.
+
+    Returns
+    -------
+    class_ids: np.array or None
+        The sorted, unique int64 labeled class ids, or None if the example has no
+        labeled-class field, i.e. all its classes are labeled.
+    """
+    class_ids = features.get(LABELED_CLASSES_FEATURE, None)
+    if class_ids is not None:
+        return np.unique(class_ids)
+    packed_mask = features.get(LABELED_MASK_FEATURE, None)
+    if packed_mask is not None:
+        return np.flatnonzero(unpack_labeled_class_mask(packed_mask[0] if packed_mask else b''))
+    return None
@@ -0,0 +1,210 @@
+"""Classification losses for object detection with partial labels.
+
+In a partially labeled example only some classes are annotated, so a box with
+no matching ground truth of an unlabeled class is not evidence that the class
+is absent. These losses take a dense boolean mask of the labeled classes of
+each example, e.g. 'labeled_class_mask' from
+`partial_data.tfrecord.decode_object_detection_tf_example`, and exclude the
+unlabeled classes of each example from its loss.
+
+Logits and targets have shape [batch_size, num_anchors, num_classes] and the
+mask has shape [batch_size, num_classes], with mask column k matching logit
+column k. For models with a background column, such as SSD in the
+Tensorflow object detection API, decode the mask with one more class than the
+model predicts so class ids line up with logit columns, and set the
+background column of the mask if it should always be trained.
+
+All ops are batched over examples, anchors, and classes, with no per-example
+loops.
+"""
+import tensorflow as tf
+
+
+NORMALIZATIONS = ('none', 'num_labeled', 'proportion')
+
+
+def get_label_proportion_weights(labeled_class_mask, normalization='proportion', gamma=1.0,
+                                 anchor_proportion=0.1, anchor_weight=5.0):
+    """Computes per-example loss weights from the proportion of labeled classes.
+
+    Implements the normalization strategies of Durand et al. 2019, "Learning a
+    Deep ConvNet for Multi-label Classification with Partial Labels". Without
+    normalization, examples with few labeled classes have a smaller loss, and
+    smaller gradients, than fully labeled examples.
+
+    Parameters
+    ----------
+    labeled_class_mask: tf.Tensor
+        A boolean tensor of shape [batch_size, num_classes].
+    normalization: str
+        'none' gives every example a weight of 1. 'num_labeled' weights each
+        example by num_classes / num_labeled_classes, so the loss is the mean
+        over labeled classes, scaled to match a fully labeled example.
+        'proportion' weights each example by g(p) = alpha * p^gamma + beta,
+        where p is the proportion of labeled classes, with alpha and beta set
+        so that g(1) = 1 and g(anchor_proportion) = anchor_weight.
+    gamma: float
+        The exponent of g for the 'proportion' normalization.
+    anchor_proportion: float
+        The label proportion at which g is pinned to `anchor_weight`.
+    anchor_weight: float
+        The weight of examples with `anchor_proportion` of classes labeled.
+
+    Returns
+    -------
+    weights: tf.Tensor
+        A float32 tensor of shape [batch_size].
+    """
+    if normalization not in NORMALIZATIONS:
+        raise ValueError(f'Unknown normalization {normalization}, must be one of {NORMALIZATIONS}')
+
+    mask = tf.cast(labeled_class_mask, tf.float32)
+    num_classes = tf.cast(tf.shape(mask)[-1], tf.float32)
+    num_labeled = tf.reduce_sum(mask, axis=-1)
+    if normalization == 'none':
+        return tf.ones_like(num_labeled)
+    if normalization == 'num_labeled':
+        return tf.math.divide_no_nan(num_classes, num_labeled)
+
+    alpha = (anchor_weight - 1) / (anchor_proportion ** gamma - 1)
+    beta = 1 - alpha
+    proportion = num_labeled / num_classes
+    # Examples with no labeled classes contribute nothing, so keep their weight finite for negative gamma
+    safe_proportion = tf.where(proportion > 0, proportion, tf.ones_like(proportion))
+    return tf.where(proportion > 0, alpha * tf.pow(safe_proportion, gamma) + beta, tf.zeros_like(proportion))
+
+
+def _get_class_weights(labeled_class_mask, anchor_weights, normalization, **normalization_kwargs):
+    # Combines the class mask, per-example normalization, and per-anchor weights into weights broadcastable to
+    # [batch_size, num_anchors, num_classes]
+    example_weights = get_label_proportion_weights(labeled_class_mask, normalization, **normalization_kwargs)
+    class_weights = tf.cast(labeled_class_mask, tf.float32) * tf.expand_dims(example_weights, -1)
+    class_weights = tf.expand_dims(class_weights, 1)
+    if anchor_weights is not None:
+        class_weights *= tf.expand_dims(tf.cast(anchor_weights, tf.float32), -1)
+    return class_weights
+
+
+def masked_sigmoid_cross_entropy(logits, targets, labeled_class_mask, anchor_weights=None, normalization='none',
+                                 **normalization_kwargs):
+    """Computes sigmoid cross-entropy, ignoring the unlabeled classes of each example.
+
+    Parameters
+    ----------
+    logits: tf.Tensor
+        A float tensor of shape [batch_size, num_anchors, num_classes].
+    targets: tf.Tensor
+        A float tensor of one-hot (or multi-hot) targets, with the same shape
+        as `logits`.
+    labeled_class_mask: tf.Tensor
+        A boolean tensor of shape [batch_size, num_classes].
+    anchor_weights: tf.Tensor
+        An optional float tensor of shape [batch_size, num_anchors].
+    normalization: str
+        The per-example normalization, see `get_label_proportion_weights`.
+    **normalization_kwargs
+        Passed to `get_label_proportion_weights`.
+
+    Returns
+    -------
+    loss: tf.Tensor
+        A float tensor of shape [batch_size, num_anchors, num_classes], zero
+        for unlabeled classes.
+    """
+    class_weights = _get_class_weights(labeled_class_mask, anchor_weights, normalization, **normalization_kwargs)
+    loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=targets, logits=logits)
+    return loss * class_weights
+
+
+def masked_sigmoid_focal_loss(logits, targets, labeled_class_mask, anchor_weights=None, gamma=2.0, alpha=0.25,
+                              normalization='none', **normalization_kwargs):
+    """Computes sigmoid focal loss, ignoring the unlabeled classes of each example.
+
+    Focal loss is from Lin et al. 2017, "Focal Loss for Dense Object
+    Detection". Takes the same arguments and returns the same shape as
+    `masked_sigmoid_cross_entropy`, plus:
+
+    Parameters
+    ----------
+    gamma: float
+        The focusing parameter, down-weighting well classified anchors.
+    alpha: float
+        The weight of positive targets, with negatives weighted 1 - alpha. If
+        None, positives and negatives are weighted equally.
+    """
+    class_weights = _get_class_weights(labeled_class_mask, anchor_weights, normalization, **normalization_kwargs)
+    loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=targets, logits=logits)
+    probs = tf.sigmoid(logits)
+    p_t = targets * probs + (1 - targets) * (1 - probs)
+    loss *= tf.pow(1 - p_t, gamma)
+    if alpha is not None:
+        loss *= targets * alpha + (1 - targets) * (1 - alpha)
+    return loss * class_weights
+
+
+def _masked_log_softmax(logits, labeled_class_mask):
+    # Log softmax over the labeled classes of each example only, so unlabeled classes neither compete with the
+    # target class nor receive gradients
+    mask = tf.broadcast_to(tf.expand_dims(tf.cast(labeled_class_mask, tf.bool), 1), tf.shape(logits))
+    masked_logits = tf.where(mask, logits, tf.fill(tf.shape(logits), tf.constant(-1e9, dtype=logits.dtype)))
+    return tf.nn.log_softmax(masked_logits, axis=-1), mask
+
+
+def _weight_anchor_loss(loss, labeled_class_mask, anchor_weights, normalization, **normalization_kwargs):
+    example_weights = get_label_proportion_weights(labeled_class_mask, normalization, **normalization_kwargs)
+    loss *= tf.expand_dims(example_weights, -1)
+    if anchor_weights is not None:
+        loss *= tf.cast(anchor_weights, tf.float32)
+    return loss
+
+
+def masked_softmax_cross_entropy(logits, targets, labeled_class_mask, anchor_weights=None, normalization='none',
+                                 **normalization_kwargs):
+    """Computes softmax cross-entropy over the labeled classes of each example.
+
+    The softmax of each anchor is taken over the example's labeled classes
+    only. Targets on unlabeled classes are ignored.
+
+    Parameters
+    ----------
+    logits: tf.Tensor
+        A float tensor of shape [batch_size, num_anchors, num_classes].
+    targets: tf.Tensor
+        A float tensor of one-hot targets, with the same shape as `logits`.
+    labeled_class_mask: tf.Tensor
+        A boolean tensor of shape [batch_size, num_classes].
+    anchor_weights: tf.Tensor
+        An optional float tensor of shape [batch_size, num_anchors].
+    normalization: str
+        The per-example normalization, see `get_label_proportion_weights`.
+    **normalization_kwargs
+        Passed to `get_label_proportion_weights`.
+
+    Returns
+    -------
+    loss: tf.Tensor
+        A float tensor of shape [batch_size, num_anchors].
+    """
+    log_probs, mask = _masked_log_softmax(logits, labeled_class_mask)
+    targets = tf.where(mask, targets, tf.zeros_like(targets))
+    loss = -tf.reduce_sum(targets * log_probs, axis=-1)
+    return _weight_anchor_loss(loss, labeled_class_mask, anchor_weights, normalization, **normalization_kwargs)
+
+
+def masked_softmax_focal_loss(logits, targets, labeled_class_mask, anchor_weights=None, gamma=2.0,
+                              normalization='none', **normalization_kwargs):
+    """Computes softmax focal loss over the labeled classes of each example.
+
+    Takes the same arguments and returns the same shape as
+    `masked_softmax_cross_entropy`, plus:
+
+    Parameters
+    ----------
+    gamma: float
+        The focusing parameter, down-weighting well classified anchors.
+    """
+    log_probs, mask = _masked_log_softmax(logits, labeled_class_mask)
+    targets = tf.where(mask, targets, tf.zeros_like(targets))
+    loss = -tf.reduce_sum(targets * tf.pow(1 - tf.exp(log_probs), gamma) * log_probs, axis=-1)
+    return _weight_anchor_loss(loss, labeled_class_mask, anchor_weights, normalization, **normalization_kwargs)
+
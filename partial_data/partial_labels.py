@@ -0,0 +1,176 @@
+"""Generation of object detection datasets with partial labels.
+
+A partial dataset is built from a fully labeled one by choosing, for each of
+several subsets of images, the set of categories whose instances are kept.
+Every other category is unlabeled in those images: its instances are dropped,
+even though they are present. A matching complete dataset keeps the instances
+of all chosen categories in the same images, as a fully labeled reference.
+
+All membership tests are done on integer image and category codes, with a
+boolean image x category matrix marking which categories are labeled in
+which images, so all datasets and splits are produced from a single set of
+vectorized masks rather than repeated dataframe filters and joins.
+"""
+import numpy as np
+
+import pandas as pd
+
+
+DEFAULT_SPLIT_FRACS = (('train', 0.7), ('val', 0.1), ('test', 0.2))
+
+
+def assign_images_to_subsets(image_ids, num_subsets=2, seed=0):
+    """Randomly assigns images to disjoint subsets.
+
+    Parameters
+    ----------
+    image_ids: iterable
+        The ids of the images to assign.
+    num_subsets: int
+        The number of subsets.
+    seed: int
+        Seed of the random assignment.
+
+    Returns
+    -------
+    subset_image_ids: list(np.array)
+        The ids of the images in each subset.
+    """
+    image_ids = np.unique(np.asarray(image_ids))
+    subset_inds = np.random.RandomState(seed).randint(0, num_subsets, len(image_ids))
+    return [image_ids[subset_inds == ind] for ind in range(num_subsets)]
+
+
+def _get_split_codes(num_images, split_fracs, seed):
+    # Assigns each image code to a split index, with split sizes rounded from their fractions and the last split
+    # taking the remaining images
+    split_codes = np.empty(num_images, dtype=np.int64)
+    image_order = np.random.RandomState(seed).permutation(num_images)
+    start = 0
+    for ind, (_, frac) in enumerate(split_fracs):
+        end = num_images if ind == len(split_fracs) - 1 else min(start + round(num_images * frac), num_images)
+        split_codes[image_order[start:end]] = ind
+        start = end
+    return split_codes
+
+
+def get_labeled_class_matrix(image_ids, category_names, specs):
+    """Builds the boolean matrix of which categories are labeled in which images.
+
+    Parameters
+    ----------
+    image_ids: np.array
+        The unique image ids, defining the matrix rows.
+    category_names: np.array
+        The unique category names, defining the matrix columns.
+    specs: list(dict)
+        The partial datasets, each with the 'image_ids' of an image subset and
+        the 'cats' (category names) labeled in that subset.
+
+    Returns
+    -------
+    labeled: np.array
+        A boolean matrix of shape [len(image_ids), len(category_names)].
+    """
+    labeled = np.zeros((len(image_ids), len(category_names)), dtype=bool)
+    for spec in specs:
+        is_spec_cat = np.isin(category_names, list(spec['cats']))
+        missing_cats = set(spec['cats']) - set(np.asarray(category_names)[is_spec_cat].tolist())
+        if missing_cats:
+            raise ValueError(f'Partial dataset categories {sorted(missing_cats)} are not in the annotations')
+        is_spec_image = np.isin(image_ids, np.asarray(list(spec['image_ids'])))
+        labeled[np.ix_(is_spec_image, is_spec_cat)] = True
+    return labeled
+
+
+def generate_partial_datasets(df, specs, split_fracs=DEFAULT_SPLIT_FRACS, seed=0, category_col='category_name',
+                              image_id_col='image_id'):
+    """Generates partially and completely labeled datasets, split into train/val/test.
+
+    The partial dataset keeps the instances of each spec's categories in the
+    spec's images, and adds the ids of the labeled categories of each image
+    as `labeled_cat_ids`. The complete dataset keeps the instances of all
+    spec categories in every image of the partial dataset. Both datasets are
+    split by image, with the same images in the same split.
+
+    Category ids are renumbered sequentially from 1 over the sorted union of
+    spec categories, and the original ids are kept in `category_id_orig`.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Annotations with one row per instance, e.g. from
+        `partial_data.coco.load_coco_annotations_as_dataframe`.
+    specs: list(dict)
+        The partial datasets, each with the 'image_ids' of an image subset and
+        the 'cats' (category names) labeled in that subset, e.g. with image
+        subsets from `assign_images_to_subsets`.
+    split_fracs: iterable(tuple(str, float))
+        The name and fraction of images of each split. The last split takes
+        all remaining images.
+    seed: int
+        Seed of the random assignment of images to splits.
+    category_col: str
+        The column holding category names.
+    image_id_col: str
+        The column holding image ids.
+
+    Returns
+    -------
+    datasets: dict
+        Maps 'partial' and 'complete' to dicts from split name to the
+        dataframe of that split.
+    category_id_map: dict
+        Maps each retained category name to its new category id.
+    """
+    split_fracs = list(split_fracs.items() if isinstance(split_fracs, dict) else split_fracs)
+
+    # Convert images and categories to integer codes
+    image_ids, image_codes = np.unique(df[image_id_col].values, return_inverse=True)
+    category_codes, category_names = pd.factorize(df[category_col])
+    category_names = np.asarray(category_names, dtype=object)
+
+    # Mark the labeled categories of each image, and the categories kept in the complete dataset
+    labeled = get_labeled_class_matrix(image_ids, category_names, specs)
+    is_kept_cat = labeled.any(axis=0)
+    if not is_kept_cat.any():
+        raise ValueError('Partial dataset specs do not label any category of any annotated image')
+
+    # Renumber kept categories sequentially by name
+    kept_cat_codes = np.flatnonzero(is_kept_cat)
+    kept_cat_codes = kept_cat_codes[np.argsort(category_names[kept_cat_codes].astype(str), kind='stable')]
+    new_category_ids = np.zeros(len(category_names), dtype=np.int64)
+    new_category_ids[kept_cat_codes] = np.arange(1, len(kept_cat_codes) + 1)
+    category_id_map = {category_names[code]: int(new_category_ids[code]) for code in kept_cat_codes}
+
+    # Find the instances of each dataset
+    is_partial_instance = labeled[image_codes, category_codes]
+    is_partial_image = np.zeros(len(image_ids), dtype=bool)
+    is_partial_image[image_codes[is_partial_instance]] = True
+    is_complete_instance = is_partial_image[image_codes] & is_kept_cat[category_codes]
+
+    # Build the labeled category ids of each image once per distinct labeled mask, shared by all its instances.
+    # Masks are packed into bytes and compared as opaque values, which is much faster than np.unique(axis=0)
+    packed_labeled = np.ascontiguousarray(np.packbits(labeled[:, kept_cat_codes], axis=1))
+    packed_labeled = packed_labeled.view(np.dtype((np.void, packed_labeled.shape[1]))).reshape(-1)
+    _, pattern_image_codes, pattern_inds = np.unique(packed_labeled, return_index=True, return_inverse=True)
+    pattern_inds = pattern_inds.reshape(-1)
+    pattern_cat_ids = np.empty(len(pattern_image_codes), dtype=object)
+    for ind, image_code in enumerate(pattern_image_codes):
+        pattern_cat_ids[ind] = sorted(new_category_ids[labeled[image_code]].tolist())
+    instance_labeled_cat_ids = pattern_cat_ids[pattern_inds[image_codes]]
+
+    split_codes = _get_split_codes(len(image_ids), split_fracs, seed)[image_codes]
+
+    datasets = {'partial': {}, 'complete': {}}
+    for name, is_instance in [('partial', is_partial_instance), ('complete', is_complete_instance)]:
+        for split_ind, (split, _) in enumerate(split_fracs):
+            inds = np.flatnonzero(is_instance & (split_codes == split_ind))
+            df_split = df.iloc[inds].reset_index(drop=True)
+            df_split['category_id_orig'] = df_split['category_id']
+            df_split['category_id'] = new_category_ids[category_codes[inds]]
+            if name == 'partial':
+                df_split['labeled_cat_ids'] = instance_labeled_cat_ids[inds]
+            datasets[name][split] = df_split
+
+    return datasets, category_id_map
@@ -0,0 +1,363 @@
+"""Strategies for assigning serialized examples to TFRecord shards, and the manifests describing them.
+"""
+import hashlib
+import json
+import os
+import zlib
+from functools import partial
+
+import numpy as np
+
+from partial_data.label_mask import LABELED_CLASSES_FEATURE, LABELED_MASK_FEATURE, get_labeled_class_ids
+from partial_data.tfrecord_index import RECORD_OVERHEAD
+from partial_data.tfrecord_scanner import MANIFEST_SUFFIX, parse_example
+
+
+SHARDING_STRATEGIES = ('round_robin', 'balanced')
+
+
+def get_labeled_classes_key(serialized_example):
+    """Gets a hashable key of the labeled-class mask of a serialized tf.Example.
+
+    Returns None for examples without a mask, i.e. with complete labels.
+    """
+    features = parse_example(serialized_example, feature_names=(LABELED_CLASSES_FEATURE, LABELED_MASK_FEATURE))
+    labeled_classes = get_labeled_class_ids(features)
+    if labeled_classes is None:
+        return None
+    return tuple(labeled_classes.tolist())
+
+
+class ShardAssigner:
+    """Assigns a stream of serialized examples to shards.
+
+    Parameters
+    ----------
+    num_shards: int
+        The number of shards.
+    strategy: str
+        'round_robin' assigns example i to shard i % num_shards. 'balanced'
+        greedily assigns each example to the shard with the fewest bytes so
+        far, so shards end up with near equal sizes even when example sizes
+        vary a lot.
+    stratify: bool
+        If True, examples are first spread evenly across shards within each
+        distinct labeled-class mask, so each shard carries a similar mix of
+        partial labels. Ties are broken by the strategy.
+
+    Attributes
+    ----------
+    num_examples: np.array
+        The number of examples assigned to each shard.
+    num_bytes: np.array
+        The number of record bytes (including TFRecord framing) assigned to
+        each shard.
+    """
+
+    def __init__(self, num_shards, strategy='round_robin', stratify=False):
+        if strategy not in SHARDING_STRATEGIES:
+            raise ValueError(f'Unknown sharding strategy {strategy}, must be one of {SHARDING_STRATEGIES}')
+        self.num_shards = num_shards
+        self.strategy = strategy
+        self.stratify = stratify
+        self.num_examples = np.zeros(num_shards, dtype=np.int64)
+        self.num_bytes = np.zeros(num_shards, dtype=np.int64)
+        self.stratum_counts = {}
+        self._index = 0
+
+    def assign(self, serialized_example):
+        """Picks the shard for the next example, and records it as written to that shard."""
+        if self.strategy == 'round_robin':
+            # Order shards starting from the round robin shard, so it wins ties
+            shard_order = (np.arange(self.num_shards) + self._index) % self.num_shards
+        else:
+            shard_order = np.argsort(self.num_bytes, kind='stable')
+
+        if self.stratify:
+            stratum_counts = self.stratum_counts.setdefault(
+                get_labeled_classes_key(serialized_example), np.zeros(self.num_shards, dtype=np.int64))
+            shard_index = shard_order[np.argmin(stratum_counts[shard_order])]
+            stratum_counts[shard_index] += 1
+        else:
+            shard_index = shard_order[0]
+
+        self.num_examples[shard_index] += 1
+        self.num_bytes[shard_index] += len(serialized_example) + RECORD_OVERHEAD
+        self._index += 1
+        return int(shard_index)
+
+    def get_manifest(self, output_filepaths):
+        """Summarizes the assignment of examples to shards.
+
+        Parameters
+        ----------
+        output_filepaths: list(str)
+            The filepath of each shard.
+
+        Returns
+        -------
+        manifest: dict
+            The sharding settings and the filepath, example count, and byte
+            count of each shard.
+        """
+        return {
+            'num_shards': self.num_shards,
+            'strategy': self.strategy,
+            'stratify': self.stratify,
+            'num_examples': int(self.num_examples.sum()),
+            'num_bytes': int(self.num_bytes.sum()),
+            'shards': [
+                {'filepath': filepath, 'num_examples': int(num_examples), 'num_bytes': int(num_bytes)}
+                for filepath, num_examples, num_bytes in zip(output_filepaths, self.num_examples, self.num_bytes)
+            ],
+        }
+
+
+def get_manifest_filepath(output_filebase):
+    """Gets the filepath of the manifest of a TFRecord dataset."""
+    return output_filebase + MANIFEST_SUFFIX
+
+
+def get_temp_filepath(filepath):
+    """Gets the filepath a file is written to before being committed to `filepath`.
+
+    The temporary file is hidden and in the same directory, so glob patterns
+    of the committed files do not match it, and it can be renamed atomically.
+    """
+    dirname, basename = os.path.split(filepath)
+    return os.path.join(dirname, f'.{basename}.tmp')
+
+
+def commit_file(temp_filepath, filepath):
+    """Flushes a fully written temporary file to disk and atomically renames it to `filepath`.
+
+    The directory is flushed after the rename, so the new name survives a crash too.
+    """
+    with open(temp_filepath, 'r+b') as fp:
+        os.fsync(fp.fileno())
+    os.replace(temp_filepath, filepath)
+    _fsync_directory(os.path.dirname(os.path.abspath(filepath)))
+
+
+def _fsync_directory(dirpath):
+    # Directories can not be opened, nor flushed, on Windows, where renames are not cached this way
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_manifest(manifest, output_filebase):
+    """Writes the manifest of a TFRecord dataset next to its shards.
+
+    The manifest is replaced atomically, so a crash while writing it leaves
+    the previous manifest intact.
+    """
+    manifest_filepath = get_manifest_filepath(output_filebase)
+    temp_filepath = get_temp_filepath(manifest_filepath)
+    with open(temp_filepath, 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    commit_file(temp_filepath, manifest_filepath)
+
+
+def read_manifest(output_filebase):
+    """Reads the manifest of a TFRecord dataset."""
+    with open(get_manifest_filepath(output_filebase), 'r') as fp:
+        return json.load(fp)
+
+
+def compute_file_crc32(filepath, chunk_size=2 ** 20):
+    """Computes the CRC32 checksum of a file, reading it in chunks."""
+    crc = 0
+    with open(filepath, 'rb') as fp:
+        chunk = fp.read(chunk_size)
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            chunk = fp.read(chunk_size)
+    return crc
+
+
+def _get_encoder_description(example_encoder):
+    # Describes an encoder by its name and the arguments bound with functools.partial. Arguments that are not
+    # plain values, e.g. an image cache, are described by their type, so the description is the same across runs.
+    def describe(value):
+        if value is None or isinstance(value, (bool, int, float, str, bytes)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return [describe(item) for item in value]
+        return type(value).__name__
+
+    if isinstance(example_encoder, partial):
+        return {
+            'func': _get_encoder_description(example_encoder.func),
+            'args': describe(example_encoder.args),
+            'keywords': {key: describe(value) for key, value in sorted(example_encoder.keywords.items())},
+        }
+    return f"{getattr(example_encoder, '__module__', '')}.{getattr(example_encoder, '__qualname__', '')}"
+
+
+def _to_json_value(value):
+    # Converts the numpy values of an example to Python values, which json serializes the same way on every numpy
+    # version, unlike their repr
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return {'bytes': value.hex()}
+    raise TypeError(f'Can not fingerprint a value of type {type(value).__name__}')
+
+
+def compute_build_fingerprint(examples, example_encoder):
+    """Computes a fingerprint of the inputs of a TFRecord build.
+
+    The fingerprint covers the value of every field of every example, e.g.
+    image ids, boxes, and labeled classes, and the name and bound settings of
+    the encoder, so a resumed build can check that it writes the same
+    dataset. Image files are not read.
+
+    Examples are serialized as JSON, with numpy arrays and scalars converted to
+    Python lists and numbers, so the fingerprint does not depend on the numpy
+    version, nor on the array types of the examples.
+
+    Parameters
+    ----------
+    examples: iterable(dict-like)
+        The examples of the build.
+    example_encoder: func
+        The function encoding each example, optionally a functools.partial.
+
+    Returns
+    -------
+    fingerprint: str
+        A hex digest.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(_get_encoder_description(example_encoder), sort_keys=True).encode('utf8'))
+    for example in examples:
+        example_values = {key: example[key] for key in example.keys()}
+        hasher.update(json.dumps(example_values, sort_keys=True, default=_to_json_value).encode('utf8'))
+        hasher.update(b'\n')
+    return hasher.hexdigest()
+
+
+def create_build_manifest(output_filepaths, num_examples, fingerprint=None):
+    """Creates the progress manifest of a resumable TFRecord build.
+
+    Examples are assigned to shards round robin, so the example count of each
+    shard is known before any example is encoded. Each shard is marked
+    complete, with its byte count and CRC32 checksum, once it is committed.
+
+    Parameters
+    ----------
+    output_filepaths: list(str)
+        The filepath of each shard.
+    num_examples: int
+        The total number of examples.
+    fingerprint: str
+        The fingerprint of the build inputs, see `compute_build_fingerprint`.
+
+    Returns
+    -------
+    manifest: dict
+        A manifest in the layout of `ShardAssigner.get_manifest`, with
+        'fingerprint', 'complete', and 'crc32' entries added.
+    """
+    num_shards = len(output_filepaths)
+    return {
+        'num_shards': num_shards,
+        'strategy': 'round_robin',
+        'stratify': False,
+        'num_examples': num_examples,
+        'num_bytes': 0,
+        'fingerprint': fingerprint,
+        'complete': False,
+        'shards': [
+            {
+                'filepath': filepath,
+                'num_examples': len(range(shard_index, num_examples, num_shards)),
+                'num_bytes': 0,
+                'crc32': None,
+                'complete': False,
+            }
+            for shard_index, filepath in enumerate(output_filepaths)
+        ],
+    }
+
+
+def load_build_manifest(output_filebase, output_filepaths, num_examples, fingerprint=None):
+    """Reads the progress manifest of a resumable TFRecord build, or creates it for a new build.
+
+    Raises a ValueError if an existing manifest describes a different build,
+    e.g. with another number of shards or examples, or other inputs with
+    another `fingerprint`, see `compute_build_fingerprint`.
+    """
+    if not os.path.exists(get_manifest_filepath(output_filebase)):
+        return create_build_manifest(output_filepaths, num_examples, fingerprint=fingerprint)
+
+    manifest = read_manifest(output_filebase)
+    planned_manifest = create_build_manifest(output_filepaths, num_examples, fingerprint=fingerprint)
+    planned_shards = [(shard['filepath'], shard['num_examples']) for shard in planned_manifest['shards']]
+    if 'complete' not in manifest or manifest.get('fingerprint', None) != fingerprint or planned_shards != [
+            (shard['filepath'], shard['num_examples']) for shard in manifest['shards']]:
+        raise ValueError(
+            f'The manifest {get_manifest_filepath(output_filebase)} does not match this build, '
+            f'remove it and its shards to start a new build')
+    return manifest
+
+
+def verify_shard(shard, verify_checksum=True):
+    """Checks that a shard listed in a build manifest is complete and intact.
+
+    Parameters
+    ----------
+    shard: dict
+        The entry of the shard in a manifest from `create_build_manifest`.
+    verify_checksum: bool
+        If True, also compare the CRC32 checksum of the file, which reads the
+        whole file. Otherwise only its size is compared.
+
+    Returns
+    -------
+    is_valid: bool
+        False if the shard was not committed, or its file is missing,
+        truncated, or corrupted.
+    """
+    if not shard.get('complete', False):
+        return False
+    try:
+        if os.path.getsize(shard['filepath']) != shard['num_bytes']:
+            return False
+    except OSError:
+        return False
+    return not verify_checksum or compute_file_crc32(shard['filepath']) == shard['crc32']
+
+
+def find_invalid_shards(output_filebase, verify_checksum=True):
+    """Finds the shards of a resumable TFRecord build that are unfinished, missing, truncated, or corrupted.
+
+    Useful as a check before training on a dataset.
+
+    Parameters
+    ----------
+    output_filebase: str
+        The base path of the shards, next to which the manifest was written.
+    verify_checksum: bool
+        If True, compare the CRC32 checksum of each shard, see `verify_shard`.
+
+    Returns
+    -------
+    filepaths: list(str)
+        The filepaths of the invalid shards, empty if the build is complete
+        and intact.
+    """
+    manifest = read_manifest(output_filebase)
+    if 'complete' not in manifest:
+        raise ValueError(f'{get_manifest_filepath(output_filebase)} is not the manifest of a resumable build')
+    return [
+        shard['filepath'] for shard in manifest['shards']
+        if not verify_shard(shard, verify_checksum=verify_checksum)
+    ]
@@ -4,6 +4,11 @@ import os
 import io
 import contextlib
 import hashlib
+import collections
+import itertools
+import multiprocessing
+
+import numpy as np
 
 from PIL import Image
 
@@ -15,12 +20,24 @@ try:
     from tensorflow.python_io import TFRecordWriter
     from tensorflow.gfile import GFile
     from tensorflow import FixedLenFeature, VarLenFeature, parse_single_example, Session
-    from tensorflow.data import Iterator, TFRecordDataset
+    from tensorflow.data import TFRecordDataset
 except (AttributeError, ModuleNotFoundError):
     from tensorflow.compat.v1.python_io import TFRecordWriter
     from tensorflow.compat.v1.gfile import GFile
     from tensorflow.compat.v1 import FixedLenFeature, VarLenFeature, parse_single_example, Session
-    from tensorflow.compat.v1.data import Iterator, TFRecordDataset
+    from tensorflow.compat.v1.data import TFRecordDataset
+
+from partial_data.image_utils import get_image_format, get_image_metadata_from_header
+from partial_data.instrumentation import Instrumentation, activate, get_instrumentation, timer
+from partial_data.label_mask import (LABELED_CLASSES_FEATURE, LABELED_CLASSES_FORMATS, LABELED_MASK_FEATURE,
+                                     pack_labeled_class_mask)
+from partial_data.sharding import (ShardAssigner, commit_file, compute_build_fingerprint, compute_file_crc32,
+                                   get_temp_filepath, load_build_manifest, verify_shard, write_manifest)
+from partial_data.tfrecord_index import TFRecordIndexBuilder
+from partial_data.tfrecord_scanner import SIDECAR_SUFFIXES
+
+
+RAW_IMAGE_FORMAT = 'RAW'
 
 
 def create_label_map_pbtxt(label_map, output_path):
@@ -83,6 +100,14 @@ def float_list_feature(value):
     return tf.train.Feature(float_list=tf.train.FloatList(value=value))
 
 
+def get_sharded_tfrecord_filepaths(base_path, num_shards):
+    """Gets the filepath of each TFRecord shard, e.g. '{base_path}-00000-of-00003'."""
+    return [
+        '{}-{:05d}-of-{:05d}'.format(base_path, idx, num_shards)
+        for idx in range(num_shards)
+    ]
+
+
 def open_sharded_output_tfrecords(exit_stack, base_path, num_shards):
     """Opens all TFRecord shards for writing and adds them to an exit stack.
 
@@ -104,10 +129,7 @@ def open_sharded_output_tfrecords(exit_stack, base_path, num_shards):
     tfrecords: list(tf.TFRecord)
         The list of opened TFRecords. Position k in the list corresponds to shard k.
     """
-    tf_record_output_filenames = [
-        '{}-{:05d}-of-{:05d}'.format(base_path, idx, num_shards)
-        for idx in range(num_shards)
-    ]
+    tf_record_output_filenames = get_sharded_tfrecord_filepaths(base_path, num_shards)
     tfrecords = [
         exit_stack.enter_context(TFRecordWriter(file_name))
         for file_name in tf_record_output_filenames
@@ -115,20 +137,115 @@ def open_sharded_output_tfrecords(exit_stack, base_path, num_shards):
     return tfrecords
 
 
-def encode_object_detection_tf_example(example):
+def get_image_metadata(encoded_img, width=None, height=None):
+    """Gets the size and format of an encoded image.
+
+    Known image dimensions (e.g. the COCO `width` and `height` annotation
+    columns) are reused when given. Otherwise the JPEG/PNG header is parsed,
+    and the image is only opened with PIL if the header cannot be parsed.
+
+    Parameters
+    ----------
+    encoded_img: bytes
+        An encoded image.
+    width: int
+        The known image width, if available.
+    height: int
+        The known image height, if available.
+
+    Returns
+    -------
+    width: int
+        The image width.
+    height: int
+        The image height.
+    image_format: str
+        The PIL format name of the image.
+    """
+    if width is not None and height is not None:
+        image_format = get_image_format(encoded_img)
+        if image_format is not None:
+            return int(width), int(height), image_format
+
+    metadata = get_image_metadata_from_header(encoded_img)
+    if metadata is None:
+        img = Image.open(io.BytesIO(encoded_img))
+        width, height = img.size
+        metadata = width, height, img.format
+    return metadata
+
+
+def encode_object_detection_tf_example(example, image_cache=None, labeled_classes_format='ids', num_classes=None):
     """Creates a tf.Example proto from image and annotation data.
 
     Parameters
     ----------
     example: dict-like
         A key/value map containing bounding box annotations and image
-        metadata.
+        metadata. If the map contains the image `width` and `height`, they
+        are used instead of reading them from the image. Examples without
+        `labeled_cat_ids` have all classes labeled, and examples with an
+        empty one have none labeled.
+    image_cache: partial_data.image_cache.ImageMetadataCache
+        If provided, the image hash, size, and format are looked up in this
+        cache rather than recomputed, and are added to it on a cache miss.
+        Bind it with functools.partial when passing this function to
+        `write_examples_as_tfrecord`.
+    labeled_classes_format: str
+        How the example's `labeled_cat_ids` are stored: 'ids' as a list of
+        class ids under 'image/class/labeled_classes', 'mask' as a packed
+        bitmask under 'image/class/labeled_mask', or 'both'. See
+        `partial_data.label_mask`.
+    num_classes: int
+        The width of the packed bitmask, i.e. one more than the largest class
+        id. Required if `labeled_classes_format` is 'mask' or 'both'.
 
     Returns
     -------
     tf_example: tf.Example
         The created tf.Example.
     """
+    image_filepath = example['image_filepath']
+
+    # Load image
+    with timer('encode/read_image') as read_timer:
+        with GFile(image_filepath, 'rb') as fp:
+            encoded_img = fp.read()
+        read_timer.add_bytes(len(encoded_img))
+
+    # Get image related values
+    image_metadata = None
+    if image_cache is not None:
+        with timer('encode/image_cache_get'):
+            image_metadata = image_cache.get(image_filepath)
+    if image_metadata is not None:
+        key = image_metadata['key']
+        width, height, image_format = image_metadata['width'], image_metadata['height'], image_metadata['format']
+    else:
+        with timer('encode/sha256') as hash_timer:
+            key = hashlib.sha256(encoded_img).hexdigest()
+            hash_timer.add_bytes(len(encoded_img))
+        with timer('encode/image_metadata'):
+            width, height, image_format = get_image_metadata(
+                encoded_img, width=example.get('width', None), height=example.get('height', None))
+        if image_cache is not None:
+            with timer('encode/image_cache_put'):
+                image_cache.put(image_filepath, key, width, height, image_format)
+
+    with timer('encode/build_example'):
+        return _build_object_detection_tf_example(
+            example, encoded_img, key, width, height, image_format,
+            labeled_classes_format=labeled_classes_format, num_classes=num_classes)
+
+
+def _build_object_detection_tf_example(example, encoded_img, key, width, height, image_format, box_scale=(1, 1),
+                                       labeled_classes_format='ids', num_classes=None):
+    if labeled_classes_format not in LABELED_CLASSES_FORMATS:
+        raise ValueError(
+            f'Unknown labeled classes format {labeled_classes_format}, must be one of {LABELED_CLASSES_FORMATS}')
+    if labeled_classes_format != 'ids' and num_classes is None:
+        raise ValueError(f'num_classes is required for labeled classes format {labeled_classes_format}')
+
     # Grab values from example
     image_filepath = example['image_filepath']
     image_id = example['image_id']
@@ -140,17 +257,13 @@ def encode_object_detection_tf_example(example):
     classes = example['category_id']
     class_ids_labeled = example.get('labeled_cat_ids', None)
 
-    # Load image
-    with GFile(image_filepath, 'rb') as fp:
-        encoded_img = fp.read()
-    encoded_img_io = io.BytesIO(encoded_img)
-    img = Image.open(encoded_img_io)
-    key = hashlib.sha256(encoded_img).hexdigest()
+    # Rescale normalized boxes if the image content does not fill the full image
+    if box_scale != (1, 1):
+        x_scale, y_scale = box_scale
+        xmins, xmaxs = (np.asarray(vals, dtype=np.float32) * x_scale for vals in (xmins, xmaxs))
+        ymins, ymaxs = (np.asarray(vals, dtype=np.float32) * y_scale for vals in (ymins, ymaxs))
 
-    # Get image related values
-    width, height = img.size
     filename = os.path.split(image_filepath)[-1]
-    image_format = img.format
 
     features = {
         'image/height': int64_feature(height),
@@ -169,14 +282,153 @@ def encode_object_detection_tf_example(example):
     }
 
     if class_ids_labeled is not None:
-        features['image/class/labeled_classes'] = int64_list_feature(class_ids_labeled)
+        if labeled_classes_format in ('ids', 'both'):
+            features[LABELED_CLASSES_FEATURE] = int64_list_feature(class_ids_labeled)
+        if labeled_classes_format in ('mask', 'both'):
+            features[LABELED_MASK_FEATURE] = bytes_feature(pack_labeled_class_mask(class_ids_labeled, num_classes))
+        elif len(class_ids_labeled) == 0:
+            # Tensorflow decodes an empty list of ids the same as a missing one, i.e. as all classes labeled, so
+            # examples with no labeled classes also get an all-zero mask
+            features[LABELED_MASK_FEATURE] = bytes_feature(pack_labeled_class_mask([], num_classes or 1))
 
     tf_example = tf.train.Example(features=tf.train.Features(feature=features))
 
     return tf_example
 
 
-def decode_object_detection_tf_example(example_proto):
+def encode_resized_object_detection_tf_example(example, target_size=(300, 300), image_format='JPEG', quality=95,
+                                               keep_aspect_ratio=False, labeled_classes_format='ids', num_classes=None):
+    """Creates a tf.Example proto holding a resized image and its annotation data.
+
+    Resizing images once when writing a dataset saves the training input
+    pipeline from decoding and resizing full size images on every epoch.
+
+    Parameters
+    ----------
+    example: dict-like
+        A key/value map containing bounding box annotations and image
+        metadata.
+    target_size: tuple(int, int)
+        The (width, height) of the stored image, e.g. the input size of the
+        model.
+    image_format: str
+        'JPEG' or 'PNG' to re-encode the resized image in that format, or 'RAW'
+        to store its uint8 pixel array with no encoding, so it does not need to
+        be decoded at all. RAW examples are only readable with
+        `decode_resized_object_detection_tf_example`.
+    quality: int
+        JPEG quality of the re-encoded image.
+    keep_aspect_ratio: bool
+        If True, the image is resized to fit within `target_size` keeping its
+        aspect ratio, and padded with zeros on the bottom and right. Box
+        coordinates are rescaled to stay normalized to the padded image.
+        Otherwise the image is stretched to `target_size` and box coordinates
+        are unchanged.
+    labeled_classes_format: str
+        How the example's `labeled_cat_ids` are stored, see
+        `encode_object_detection_tf_example`.
+    num_classes: int
+        The width of the packed labeled-class bitmask, see
+        `encode_object_detection_tf_example`.
+
+    Returns
+    -------
+    tf_example: tf.Example
+        The created tf.Example.
+    """
+    # Load image, letting the JPEG decoder downscale while decoding when possible
+    with timer('encode/read_image') as read_timer:
+        with GFile(example['image_filepath'], 'rb') as fp:
+            img_bytes = fp.read()
+        read_timer.add_bytes(len(img_bytes))
+    with timer('encode/decode_image'):
+        img = Image.open(io.BytesIO(img_bytes))
+        img.draft('RGB', target_size)
+        img = img.convert('RGB')
+
+    # Resize image
+    with timer('encode/resize_image'):
+        target_width, target_height = target_size
+        if keep_aspect_ratio:
+            scale = min(target_width / img.width, target_height / img.height)
+            resized_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            resized_img = Image.new('RGB', target_size)
+            resized_img.paste(img.resize(resized_size, Image.BILINEAR), (0, 0))
+            box_scale = (resized_size[0] / target_width, resized_size[1] / target_height)
+        else:
+            resized_img = img.resize(target_size, Image.BILINEAR)
+            box_scale = (1, 1)
+
+    # Encode resized image
+    with timer('encode/encode_image') as encode_timer:
+        if image_format == RAW_IMAGE_FORMAT:
+            encoded_img = np.asarray(resized_img, dtype=np.uint8).tobytes()
+        else:
+            encoded_img_io = io.BytesIO()
+            resized_img.save(encoded_img_io, format=image_format, quality=quality)
+            encoded_img = encoded_img_io.getvalue()
+        encode_timer.add_bytes(len(encoded_img))
+    with timer('encode/sha256') as hash_timer:
+        key = hashlib.sha256(encoded_img).hexdigest()
+        hash_timer.add_bytes(len(encoded_img))
+
+    with timer('encode/build_example'):
+        return _build_object_detection_tf_example(
+            example, encoded_img, key, target_width, target_height, image_format, box_scale=box_scale,
+            labeled_classes_format=labeled_classes_format, num_classes=num_classes)
+
+
+def _unpack_labeled_class_mask(packed_mask):
+    # Unpacks a bitmask created by partial_data.label_mask.pack_labeled_class_mask into a boolean tensor with one
+    # element per bit
+    mask_bytes = tf.expand_dims(tf.io.decode_raw(packed_mask, tf.uint8), 1)
+    bits = tf.bitwise.bitwise_and(mask_bytes, tf.constant([1, 2, 4, 8, 16, 32, 64, 128], dtype=tf.uint8))
+    return tf.reshape(tf.not_equal(bits, 0), [-1])
+
+
+def _decode_labeled_class_mask(packed_mask, labeled_classes, num_classes):
+    # Decodes labeled classes into a dense boolean mask of shape [num_classes], from the packed bitmask if present,
+    # then from the labeled class ids. Examples with neither have all classes labeled.
+    def unpack_mask():
+        # The all-zero mask of an example with no labeled classes may be narrower than num_classes
+        mask = _unpack_labeled_class_mask(packed_mask)[:num_classes]
+        return tf.pad(mask, [[0, num_classes - tf.size(mask)]])
+
+    def scatter_ids():
+        return tf.reduce_any(tf.equal(tf.expand_dims(labeled_classes, 1), tf.range(num_classes, dtype=tf.int64)), 0)
+
+    mask = tf.case(
+        [
+            (tf.greater(tf.strings.length(packed_mask), 0), unpack_mask),
+            (tf.greater(tf.size(labeled_classes), 0), scatter_ids),
+        ],
+        default=lambda: tf.ones([num_classes], dtype=tf.bool),
+        exclusive=False,
+    )
+    return tf.reshape(mask, [num_classes])
+
+
+def decode_object_detection_tf_example(example_proto, num_classes=None):
+    """Decodes a tf.Example created by `encode_object_detection_tf_example`.
+
+    Parameters
+    ----------
+    example_proto: tf.Tensor
+        A serialized tf.Example.
+    num_classes: int
+        If provided, the labeled classes are also decoded into a dense boolean
+        mask of shape [num_classes] under 'labeled_class_mask', from either
+        the packed bitmask or the list of labeled class ids. Examples with
+        neither have all classes labeled. Bind it with functools.partial when
+        passing this function to `iter_examples_from_tfrecord`.
+
+    Returns
+    -------
+    example: dict
+        The decoded image, box, and label values. 'labeled_classes' holds the
+        labeled class ids, taken from the packed bitmask if the example only
+        has that.
+    """
     feature_types = {
         'image/height': FixedLenFeature([], tf.int64),
         'image/width': FixedLenFeature([], tf.int64),
@@ -185,7 +437,8 @@ def decode_object_detection_tf_example(example_proto):
         'image/key/sha256': FixedLenFeature([], tf.string),
         'image/encoded': FixedLenFeature([], tf.string),
         'image/format': FixedLenFeature([], tf.string),
-        'image/class/labeled_classes': VarLenFeature(tf.int64),
+        LABELED_CLASSES_FEATURE: VarLenFeature(tf.int64),
+        LABELED_MASK_FEATURE: FixedLenFeature([], tf.string, default_value=''),
         'image/object/bbox/xmin': VarLenFeature(tf.float32),
         'image/object/bbox/ymin': VarLenFeature(tf.float32),
         'image/object/bbox/xmax': VarLenFeature(tf.float32),
@@ -196,7 +449,15 @@ def decode_object_detection_tf_example(example_proto):
 
     example = parse_single_example(example_proto, features=feature_types)
 
-    example = {
+    # Examples with only a packed bitmask get their labeled class ids from the set bits
+    packed_mask = example[LABELED_MASK_FEATURE]
+    labeled_classes = example[LABELED_CLASSES_FEATURE].values
+    labeled_classes = tf.cond(
+        tf.logical_and(tf.equal(tf.size(labeled_classes), 0), tf.greater(tf.strings.length(packed_mask), 0)),
+        lambda: tf.reshape(tf.where(_unpack_labeled_class_mask(packed_mask)), [-1]),
+        lambda: labeled_classes,
+    )
+    decoded_example = {
         'height': example['image/height'],
         'width': example['image/width'],
         'image_filename': example['image/filename'],
@@ -204,7 +465,7 @@ def decode_object_detection_tf_example(example_proto):
         'key': example['image/key/sha256'],
         'image_bytes': example['image/encoded'],
         'image_filetype': example['image/format'],
-        'labeled_classes': example['image/class/labeled_classes'].values,
+        'labeled_classes': labeled_classes,
         'wmin': example['image/object/bbox/xmin'].values,
         'hmin': example['image/object/bbox/ymin'].values,
         'wmax': example['image/object/bbox/xmax'].values,
@@ -212,11 +473,122 @@ def decode_object_detection_tf_example(example_proto):
         'label_names': example['image/object/class/text'].values,
         'label_ids': example['image/object/class/label'].values,
     }
+    if num_classes is not None:
+        decoded_example['labeled_class_mask'] = _decode_labeled_class_mask(packed_mask, labeled_classes, num_classes)
+
+    return decoded_example
+
 
+def decode_resized_object_detection_tf_example(example_proto):
+    """Decodes a tf.Example created by `encode_resized_object_detection_tf_example`.
+
+    Returns the same values as `decode_object_detection_tf_example`, plus the
+    decoded uint8 image tensor of shape [height, width, 3] under 'image'.
+    """
+    example = decode_object_detection_tf_example(example_proto)
+    image = tf.cond(
+        tf.equal(example['image_filetype'], RAW_IMAGE_FORMAT),
+        lambda: tf.io.decode_raw(example['image_bytes'], tf.uint8),
+        lambda: tf.reshape(tf.io.decode_image(example['image_bytes'], channels=3), [-1]),
+    )
+    example['image'] = tf.reshape(image, tf.stack([example['height'], example['width'], 3]))
     return example
 
 
-def write_examples_as_tfrecord(examples, output_filebase, example_encoder, num_shards=1):
+def _serialize_example(example, example_encoder):
+    with timer('encode/encode_example'):
+        tf_example = example_encoder(example)
+    with timer('encode/serialize') as serialize_timer:
+        serialized_example = tf_example.SerializeToString()
+        serialize_timer.add_bytes(len(serialized_example))
+    return serialized_example
+
+
+# The example encoder of a worker process, installed once per worker by _init_worker so it is not pickled with
+# every example, and any state it holds (e.g. an image cache connection) is reused across examples
+_worker_example_encoder = None
+
+
+def _init_worker(example_encoder):
+    global _worker_example_encoder
+    _worker_example_encoder = example_encoder
+
+
+def _serialize_example_in_worker(example):
+    return _serialize_example(example, _worker_example_encoder)
+
+
+def _serialize_example_in_worker_instrumented(example):
+    # Returns the worker's instrumentation values for this example along with it
+    worker_instrumentation = Instrumentation()
+    with activate(worker_instrumentation):
+        serialized_example = _serialize_example(example, _worker_example_encoder)
+    return serialized_example, worker_instrumentation.get_state()
+
+
+def _iter_serialized_examples(examples, example_encoder, num_workers=1, max_in_flight=None, instrumentation=None):
+    """Encodes and serializes examples, optionally across a pool of worker processes.
+
+    Serialized examples are yielded in the same order as the input examples. When
+    using multiple workers, at most `max_in_flight` examples are queued or being
+    encoded at any time, so memory use stays bounded regardless of dataset size.
+
+    Parameters
+    ----------
+    examples: iterable(dict-like)
+        Key/value maps, each map contains relevant info for a single data example.
+    example_encoder: func
+        A picklable function that encodes an input example as a tf.Example.
+        It is sent to each worker process once, when the worker starts.
+    num_workers: int
+        The number of worker processes used to encode examples. If 1, examples
+        are encoded serially in the current process.
+    max_in_flight: int
+        The maximum number of examples submitted to the worker pool whose results
+        have not yet been consumed. Defaults to 4x `num_workers`.
+    instrumentation: partial_data.instrumentation.Instrumentation
+        If provided, records the encoding stages, including those run in
+        worker processes, the time spent waiting on workers, and the number
+        of examples in flight.
+    """
+    instrumentation = get_instrumentation(instrumentation)
+    if num_workers <= 1:
+        for example in examples:
+            # Activate the instrumentation for encoding only, not while the consumer runs between examples
+            with activate(instrumentation) if instrumentation.enabled else contextlib.nullcontext():
+                serialized_example = _serialize_example(example, example_encoder)
+            yield serialized_example
+        return
+
+    def get_result(async_result):
+        with instrumentation.timer('write/wait_for_workers'):
+            result = async_result.get()
+        if not instrumentation.enabled:
+            return result
+        serialized_example, worker_state = result
+        instrumentation.merge(worker_state)
+        return serialized_example
+
+    max_in_flight = max_in_flight or 4 * num_workers
+    encode = _serialize_example_in_worker_instrumented if instrumentation.enabled else _serialize_example_in_worker
+    with multiprocessing.Pool(processes=num_workers, initializer=_init_worker, initargs=(example_encoder,)) as pool:
+        pending = collections.deque()
+        for example in examples:
+            if len(pending) >= max_in_flight:
+                yield get_result(pending.popleft())
+            pending.append(pool.apply_async(encode, (example,)))
+            instrumentation.gauge('write/in_flight', len(pending))
+        while pending:
+            yield get_result(pending.popleft())
+        # Let the workers exit normally, rather than being terminated, so they run their exit finalizers
+        pool.close()
+        pool.join()
+
+
+def write_examples_as_tfrecord(examples, output_filebase, example_encoder, num_shards=1,
+                               num_workers=1, max_in_flight=None, write_index=False, sharding='round_robin',
+                               stratify_by_labeled_classes=False, write_shard_manifest=False, instrumentation=None,
+                               resumable=False):
     """Serialize examples as a TFRecord dataset.
 
     Note: Adapted from https://github.com/tensorflow/models/blob/master/research/
@@ -224,37 +596,322 @@ def write_examples_as_tfrecord(examples, output_filebase, example_encoder, num_s
 
     Parameters
     ----------
-    examples: list(dict-like)
-        A list of key/value maps, each map contains relevant info
-        for a single data example.
+    examples: iterable(dict-like)
+        Key/value maps, each map contains relevant info for a single data
+        example. May be a generator, unless `resumable` is True.
     output_filebase: str
         The base path for all shards
     example_encoder: func
-        A function that encodes an input example as a tf.Example.
+        A function that encodes an input example as a tf.Example. Must be
+        picklable (e.g. a module level function) if `num_workers` > 1.
     num_shards: int
         The number of shards to divide the examples among. If > 1 multiple
         tfrecord files will be created with names appended with a shard index.
+    num_workers: int
+        The number of worker processes used to encode examples. The shard each
+        example is written to is independent of `num_workers`.
+    max_in_flight: int
+        The maximum number of examples being encoded by the workers at once.
+        Defaults to 4x `num_workers`.
+    write_index: bool
+        If True, write a sidecar index next to each output file, see
+        `partial_data.tfrecord_index`.
+    sharding: str
+        How examples are assigned to shards. 'round_robin' writes example `i`
+        to shard `i % num_shards`. 'balanced' writes each example to the
+        shard with the fewest bytes so far, so shards have near equal sizes.
+        See `partial_data.sharding.ShardAssigner`.
+    stratify_by_labeled_classes: bool
+        If True, spread the examples with each distinct labeled-class mask
+        evenly across shards, so every shard has a similar partial-label mix.
+    write_shard_manifest: bool
+        If True, write a json manifest with the example and byte counts of
+        each shard to `output_filebase` + '.manifest.json'.
+    instrumentation: partial_data.instrumentation.Instrumentation
+        If provided, records the time and bytes of each encoding and writing
+        stage, the number of examples in flight in the worker pool, and a
+        cProfile profile if enabled. Read the results with its `summary`.
+    resumable: bool
+        If True, shards are written one at a time, each to a temporary file
+        that is atomically renamed once complete, and progress is recorded
+        in the manifest with the size and CRC32 checksum of each committed
+        shard. Calling this again after an interrupted build verifies the
+        committed shards and only encodes the examples of unfinished or
+        invalid ones. The manifest also holds a fingerprint of the examples
+        and the encoder, and resuming with different ones raises a
+        ValueError. Requires 'round_robin' sharding without
+        stratification, so the shard of each example is known before it is
+        encoded, and `examples` must support indexing.
+
+    Returns
+    -------
+    manifest: dict
+        The sharding settings and the filepath, example count, and byte count
+        of each shard.
     """
+    if resumable:
+        if sharding != 'round_robin' or stratify_by_labeled_classes:
+            raise ValueError('Resumable builds require round_robin sharding without stratification')
+        return _write_examples_as_tfrecord_resumable(
+            examples, output_filebase, example_encoder, num_shards=num_shards, num_workers=num_workers,
+            max_in_flight=max_in_flight, write_index=write_index, instrumentation=instrumentation)
+
+    instrumentation = get_instrumentation(instrumentation)
+    serialized_examples = _iter_serialized_examples(
+        examples, example_encoder, num_workers=num_workers, max_in_flight=max_in_flight,
+        instrumentation=instrumentation)
+    shard_assigner = ShardAssigner(num_shards, strategy=sharding, stratify=stratify_by_labeled_classes)
+    index_builders = [TFRecordIndexBuilder() for _ in range(num_shards)] if write_index else None
     if num_shards == 1:
-        writer = TFRecordWriter(output_filebase)
-        for example in tqdm(examples):
-            tf_example = example_encoder(example)
-            writer.write(tf_example.SerializeToString())
-        writer.close()
+        output_filepaths = [output_filebase]
     else:
-        with contextlib.ExitStack() as tf_record_close_stack:
+        output_filepaths = get_sharded_tfrecord_filepaths(output_filebase, num_shards)
+
+    with instrumentation.profiling(), contextlib.ExitStack() as tf_record_close_stack:
+        if num_shards == 1:
+            output_tfrecords = [tf_record_close_stack.enter_context(TFRecordWriter(output_filebase))]
+        else:
             output_tfrecords = open_sharded_output_tfrecords(
                 tf_record_close_stack, output_filebase, num_shards)
-            for index, example in tqdm(enumerate(examples), total=len(examples)):
-                tf_example = example_encoder(example)
-                output_shard_index = index % num_shards
-                output_tfrecords[output_shard_index].write(tf_example.SerializeToString())
+        num_examples = len(examples) if hasattr(examples, '__len__') else None
+        for serialized_example in tqdm(serialized_examples, total=num_examples):
+            with instrumentation.timer('write/assign_shard'):
+                output_shard_index = shard_assigner.assign(serialized_example)
+            with instrumentation.timer('write/write_record') as write_timer:
+                output_tfrecords[output_shard_index].write(serialized_example)
+                write_timer.add_bytes(len(serialized_example))
+            if write_index:
+                with instrumentation.timer('write/index'):
+                    index_builders[output_shard_index].add(serialized_example)
+            instrumentation.count('write/examples')
+
+        if write_index:
+            # Indexes record the size and modification time of the finished files
+            tf_record_close_stack.close()
+            with instrumentation.timer('write/save_index'):
+                for index_builder, output_filepath in zip(index_builders, output_filepaths):
+                    index_builder.save(output_filepath)
+
+    manifest = shard_assigner.get_manifest(output_filepaths)
+    if write_shard_manifest:
+        write_manifest(manifest, output_filebase)
+    return manifest
+
+
+def _write_examples_as_tfrecord_resumable(examples, output_filebase, example_encoder, num_shards=1, num_workers=1,
+                                          max_in_flight=None, write_index=False, instrumentation=None):
+    """Writes examples shard by shard, committing each shard atomically, see `write_examples_as_tfrecord`."""
+    instrumentation = get_instrumentation(instrumentation)
+    if num_shards == 1:
+        output_filepaths = [output_filebase]
+    else:
+        output_filepaths = get_sharded_tfrecord_filepaths(output_filebase, num_shards)
+    with instrumentation.timer('write/fingerprint'):
+        fingerprint = compute_build_fingerprint(examples, example_encoder)
+    manifest = load_build_manifest(output_filebase, output_filepaths, len(examples), fingerprint=fingerprint)
+
+    with instrumentation.timer('write/verify_shards'):
+        pending_shard_indices = [
+            shard_index for shard_index, shard in enumerate(manifest['shards']) if not verify_shard(shard)
+        ]
+    for shard_index in pending_shard_indices:
+        manifest['shards'][shard_index].update({'num_bytes': 0, 'crc32': None, 'complete': False})
+    manifest['complete'] = False
+    write_manifest(manifest, output_filebase)
+
+    # Example i is in shard i % num_shards, so the examples of the pending shards are encoded in shard order by a
+    # single stream, and each shard is the next `num_examples` serialized examples
+    pending_examples = (
+        examples[example_index]
+        for shard_index in pending_shard_indices
+        for example_index in range(shard_index, len(examples), num_shards)
+    )
+    serialized_examples = _iter_serialized_examples(
+        pending_examples, example_encoder, num_workers=num_workers, max_in_flight=max_in_flight,
+        instrumentation=instrumentation)
+    num_pending_examples = sum(manifest['shards'][shard_index]['num_examples'] for shard_index in pending_shard_indices)
+
+    with instrumentation.profiling(), contextlib.closing(serialized_examples), \
+            tqdm(total=num_pending_examples) as progress_bar:
+        for shard_index in pending_shard_indices:
+            shard = manifest['shards'][shard_index]
+            temp_filepath = get_temp_filepath(shard['filepath'])
+            index_builder = TFRecordIndexBuilder() if write_index else None
+            with TFRecordWriter(temp_filepath) as output_tfrecord:
+                for serialized_example in itertools.islice(serialized_examples, shard['num_examples']):
+                    with instrumentation.timer('write/write_record') as write_timer:
+                        output_tfrecord.write(serialized_example)
+                        write_timer.add_bytes(len(serialized_example))
+                    if write_index:
+                        with instrumentation.timer('write/index'):
+                            index_builder.add(serialized_example)
+                    instrumentation.count('write/examples')
+                    progress_bar.update()
+
+            with instrumentation.timer('write/commit_shard'):
+                crc32 = compute_file_crc32(temp_filepath)
+                num_bytes = os.path.getsize(temp_filepath)
+                commit_file(temp_filepath, shard['filepath'])
+                if write_index:
+                    index_builder.save(shard['filepath'])
+            shard.update({'num_bytes': num_bytes, 'crc32': crc32, 'complete': True})
+            write_manifest(manifest, output_filebase)
+
+    manifest['num_bytes'] = sum(shard['num_bytes'] for shard in manifest['shards'])
+    manifest['complete'] = True
+    write_manifest(manifest, output_filebase)
+    return manifest
+
+
+def expand_tfrecord_filepaths(tfrecord_filepaths):
+    """Expands TFRecord filepaths and glob patterns into a sorted list of files.
+
+    Sidecar index and manifest files matched by a glob pattern are skipped.
+
+    Parameters
+    ----------
+    tfrecord_filepaths: str or list(str)
+        One or more filepaths or glob patterns, e.g.
+        'partial_train.record-?????-of-00003'.
+
+    Returns
+    -------
+    filepaths: list(str)
+        The matched filepaths.
+    """
+    if isinstance(tfrecord_filepaths, str):
+        tfrecord_filepaths = [tfrecord_filepaths]
+
+    filepaths = []
+    for filepath_pattern in tfrecord_filepaths:
+        matched_filepaths = sorted(
+            filepath for filepath in tf.io.gfile.glob(filepath_pattern)
+            if filepath == filepath_pattern or not filepath.endswith(SIDECAR_SUFFIXES)
+        )
+        if not matched_filepaths:
+            raise ValueError(f'No TFRecord files match {filepath_pattern}')
+        filepaths.extend(matched_filepaths)
+    return filepaths
+
+
+_SHAPE_SUFFIX = '__shape'
+
+
+def _add_example_shapes(example):
+    # Record the true shape of each non-scalar tensor, so padding added when batching can be removed
+    example = dict(example)
+    for name, value in list(example.items()):
+        if value.shape.ndims != 0:
+            example[name + _SHAPE_SUFFIX] = tf.shape(value)
+    return example
+
 
+def _unbatch_examples(example_batch):
+    shape_names = [name for name in example_batch if name.endswith(_SHAPE_SUFFIX)]
+    names = [name for name in example_batch if not name.endswith(_SHAPE_SUFFIX)]
+    batch_size = len(example_batch[names[0]])
+    for ind in range(batch_size):
+        example = {name: example_batch[name][ind] for name in names}
+        for shape_name in shape_names:
+            name = shape_name[:-len(_SHAPE_SUFFIX)]
+            example[name] = example[name][tuple(slice(0, dim) for dim in example_batch[shape_name][ind])]
+        yield example
 
-def read_examples_from_tfrecord(tfrecord_filepath, example_decoder):
+
+def _iter_example_batches(dataset):
+    # Yields batches of a dataset as dicts of numpy values, in eager or graph mode
+    if tf.executing_eagerly():
+        for example_batch in dataset:
+            yield {k: v.numpy() for k, v in example_batch.items()}
+    else:
+        example_batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+        with Session() as sess:
+            while True:
+                try:
+                    yield sess.run(example_batch)
+                except tf.errors.OutOfRangeError:
+                    break
+
+
+def iter_examples_from_tfrecord(tfrecord_filepaths, example_decoder, batch_size=32, num_parallel_calls=None,
+                                num_parallel_reads=None, prefetch_size=1, instrumentation=None):
+    """Lazily load examples from one or more TFRecord files.
+
+    Examples are decoded in batches with a single session run (or eager step)
+    per batch, and yielded one at a time as dicts of numpy values, so memory use
+    is bounded by the batch and prefetch sizes rather than the dataset size.
+
+    Parameters
+    ----------
+    tfrecord_filepaths: str or list(str)
+        One or more filepaths or glob patterns of serialized TFRecords, e.g. all
+        shards written by `write_examples_as_tfrecord`.
+    example_decoder: func
+        A function that decodes a serialized tf.Example into a dict of tensors.
+    batch_size: int
+        The number of examples decoded per session run.
+    num_parallel_calls: int
+        The number of examples decoded in parallel. Can be
+        tf.data.experimental.AUTOTUNE.
+    num_parallel_reads: int
+        The number of files read in parallel, with records interleaved across
+        files. If None, files are read sequentially.
+    prefetch_size: int
+        The number of batches to decode ahead of the consumer.
+    instrumentation: partial_data.instrumentation.Instrumentation
+        If provided, records the time spent waiting on each decoded batch
+        (reading and decoding run inside tf.data, so they are timed together),
+        the encoded image bytes decoded, the time spent unbatching, the
+        number of decoded examples queued for the consumer when each one is
+        yielded, and a cProfile profile if enabled. Time spent by the
+        consumer between examples is not included.
+
+    Yields
+    ------
+    example: dict
+        A decoded example.
+    """
+    filepaths = expand_tfrecord_filepaths(tfrecord_filepaths)
+    if num_parallel_reads is None or len(filepaths) == 1:
+        dataset = TFRecordDataset(filepaths)
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(filepaths).interleave(
+            TFRecordDataset, cycle_length=num_parallel_reads, block_length=1,
+            num_parallel_calls=num_parallel_reads)
+    dataset = dataset.map(lambda example_proto: _add_example_shapes(example_decoder(example_proto)),
+                          num_parallel_calls=num_parallel_calls)
+    dataset = dataset.padded_batch(batch_size, padded_shapes=tf.compat.v1.data.get_output_shapes(dataset))
+    dataset = dataset.prefetch(prefetch_size)
+
+    instrumentation = get_instrumentation(instrumentation)
+    if not instrumentation.enabled:
+        for example_batch in _iter_example_batches(dataset):
+            yield from _unbatch_examples(example_batch)
+        return
+
+    example_batches = _iter_example_batches(dataset)
+    while True:
+        with instrumentation.profiling():
+            with instrumentation.timer('read/next_batch') as batch_timer:
+                example_batch = next(example_batches, None)
+                if example_batch is not None and 'image_bytes' in example_batch:
+                    batch_timer.add_bytes(sum(len(image_bytes) for image_bytes in example_batch['image_bytes']))
+            if example_batch is None:
+                break
+            with instrumentation.timer('read/unbatch'):
+                examples = list(_unbatch_examples(example_batch))
+        instrumentation.count('read/batches')
+        instrumentation.count('read/examples', len(examples))
+        for ind, example in enumerate(examples):
+            instrumentation.gauge('read/decoded_queue_depth', len(examples) - ind)
+            yield example
+
+
+def read_examples_from_tfrecord(tfrecord_filepath, example_decoder, **kwargs):
     """Load examples from a TFRecord file into memory.
 
-    Examples are loaded as as list of dicts.
+    Examples are loaded as as list of dicts. Use `iter_examples_from_tfrecord`
+    to avoid holding all examples in memory at once.
 
     Note: Adapted from https://github.com/tensorflow/models/blob/master/research/
         object_detection/g3doc/using_your_own_dataset.md
@@ -265,22 +922,7 @@ def read_examples_from_tfrecord(tfrecord_filepath, example_decoder):
         A filepath where a serialized TFRecord is stored.
     example_decoder: func
         A function that decodes a serialized tf.Example.
+    kwargs:
+        Keyword arguments passed to `iter_examples_from_tfrecord`.
     """
-    dataset = TFRecordDataset(tfrecord_filepath)
-    dataset = dataset.map(example_decoder).make_one_shot_iterator()
-    example = dataset.get_next()
-
-    decoded_examples = []
-    try:
-        if tf.executing_eagerly():
-            while True:
-                decoded_examples.append({k: v.numpy() for k, v in example.items()})
-                example = dataset.get_next()
-        else:
-            with Session() as sess:
-                while True:
-                    decoded_examples.append(sess.run(example))
-    except tf.errors.OutOfRangeError:
-        pass
-
-    return decoded_examples
+    return list(iter_examples_from_tfrecord(tfrecord_filepath, example_decoder, **kwargs))
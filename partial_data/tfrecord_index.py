@@ -0,0 +1,237 @@
+"""Sidecar indexes for random access into TFRecord files.
+
+Each TFRecord shard can have an index file next to it, holding the byte offset,
+length, image id, and labeled-class mask of every record. Indexes make counting
+examples, looking up examples by id, and selecting subsets by id or labeled
+class cheap seeks rather than full scans. Like `partial_data.tfrecord_scanner`,
+this module does not depend on Tensorflow.
+"""
+import os
+import struct
+
+import numpy as np
+
+from partial_data.label_mask import LABELED_CLASSES_FEATURE, LABELED_MASK_FEATURE, get_labeled_class_ids
+from partial_data.tfrecord_scanner import INDEX_SUFFIX, count_records, expand_filepaths, iter_records, parse_example
+
+
+# Size of the TFRecord framing around each record: length, length CRC, and data CRC
+RECORD_OVERHEAD = 16
+INDEX_FEATURES = ('image/source_id', LABELED_CLASSES_FEATURE, LABELED_MASK_FEATURE)
+
+
+def get_index_filepath(tfrecord_filepath):
+    """Gets the filepath of the sidecar index of a TFRecord file."""
+    return tfrecord_filepath + INDEX_SUFFIX
+
+
+class TFRecordIndexBuilder:
+    """Collects index entries for records as they are written to a TFRecord file.
+
+    Records must be added in the order they are written, starting from the
+    beginning of the file.
+    """
+
+    def __init__(self):
+        self.offsets = []
+        self.lengths = []
+        self.image_ids = []
+        self.labeled_classes = []
+        self.next_offset = 0
+
+    def add(self, serialized_example):
+        """Adds the index entry of a serialized tf.Example written as the next record."""
+        features = parse_example(serialized_example, feature_names=INDEX_FEATURES)
+        source_id = features.get('image/source_id', None)
+        self.offsets.append(self.next_offset)
+        self.lengths.append(len(serialized_example))
+        self.image_ids.append(source_id[0].decode('utf8') if source_id else '')
+        self.labeled_classes.append(get_labeled_class_ids(features))
+        self.next_offset += len(serialized_example) + RECORD_OVERHEAD
+
+    def save(self, tfrecord_filepath):
+        """Saves the index next to the TFRecord file it describes.
+
+        Must be called once the TFRecord file is fully written and closed,
+        since the index records its size and modification time, see
+        `is_index_valid`.
+        """
+        # Pack each record's labeled classes into a fixed width bitmask over all class ids seen in the shard
+        has_labeled_classes = np.array([classes is not None for classes in self.labeled_classes], dtype=bool)
+        max_class_id = max(
+            [int(classes.max()) for classes in self.labeled_classes if classes is not None and len(classes)],
+            default=-1
+        )
+        labeled_class_mask = np.zeros((len(self.labeled_classes), max_class_id + 1), dtype=bool)
+        for ind, classes in enumerate(self.labeled_classes):
+            if classes is not None:
+                labeled_class_mask[ind, classes] = True
+
+        with open(get_index_filepath(tfrecord_filepath), 'wb') as fp:
+            np.savez(
+                fp,
+                offsets=np.array(self.offsets, dtype=np.int64),
+                lengths=np.array(self.lengths, dtype=np.int64),
+                image_ids=np.array(self.image_ids, dtype=str),
+                has_labeled_classes=has_labeled_classes,
+                labeled_class_mask=np.packbits(labeled_class_mask, axis=1),
+                num_classes=np.array(max_class_id + 1),
+                record_file_size=np.array(self.next_offset, dtype=np.int64),
+                record_file_mtime_ns=np.array(os.stat(tfrecord_filepath).st_mtime_ns, dtype=np.int64),
+            )
+
+
+def build_index(tfrecord_filepath):
+    """Builds and saves the sidecar index of an existing TFRecord file with a single scan."""
+    builder = TFRecordIndexBuilder()
+    with open(tfrecord_filepath, 'rb') as fp:
+        header = fp.read(12)
+        while len(header) == 12:
+            length, = struct.unpack('<Q', header[:8])
+            builder.add(fp.read(length))
+            fp.seek(4, 1)
+            header = fp.read(12)
+    builder.save(tfrecord_filepath)
+
+
+def is_index_valid(tfrecord_filepath):
+    """Checks that a TFRecord file has an index matching its current size and modification time.
+
+    Indexes go stale when their TFRecord file is rewritten, e.g. without
+    `write_index`, and indexes written before sizes were recorded are
+    treated as stale.
+    """
+    index_filepath = get_index_filepath(tfrecord_filepath)
+    if not os.path.exists(index_filepath):
+        return False
+    stat = os.stat(tfrecord_filepath)
+    with np.load(index_filepath, allow_pickle=False) as arrays:
+        if 'record_file_size' not in arrays or 'record_file_mtime_ns' not in arrays:
+            return False
+        return (int(arrays['record_file_size']) == stat.st_size
+                and int(arrays['record_file_mtime_ns']) == stat.st_mtime_ns)
+
+
+def load_index(tfrecord_filepath):
+    """Loads the sidecar index of a TFRecord file, building it first if it is missing or stale.
+
+    Returns
+    -------
+    index: dict
+        Record `offsets`, `lengths`, and `image_ids`, whether each record
+        has a labeled-class mask (`has_labeled_classes`), and the unpacked
+        boolean `labeled_class_mask` of shape [num_records, num_classes].
+    """
+    if not is_index_valid(tfrecord_filepath):
+        build_index(tfrecord_filepath)
+    with np.load(get_index_filepath(tfrecord_filepath), allow_pickle=False) as arrays:
+        num_classes = int(arrays['num_classes'])
+        return {
+            'offsets': arrays['offsets'],
+            'lengths': arrays['lengths'],
+            'image_ids': arrays['image_ids'],
+            'has_labeled_classes': arrays['has_labeled_classes'],
+            'labeled_class_mask': np.unpackbits(
+                arrays['labeled_class_mask'], axis=1, count=num_classes).astype(bool),
+        }
+
+
+def count_examples(filepaths):
+    """Counts the examples in TFRecord files, using their indexes when they are valid."""
+    num_examples = 0
+    for filepath in expand_filepaths(filepaths):
+        if is_index_valid(filepath):
+            with np.load(get_index_filepath(filepath), allow_pickle=False) as arrays:
+                num_examples += len(arrays['offsets'])
+        else:
+            num_examples += count_records(filepath)
+    return num_examples
+
+
+def select_records(filepaths, image_ids=None, labeled_class_ids=None):
+    """Selects records from indexed TFRecord files by image id and/or labeled class.
+
+    Missing or stale indexes are rebuilt, see `load_index`.
+
+    Parameters
+    ----------
+    filepaths: str or list(str)
+        One or more filepaths or glob patterns of TFRecord files.
+    image_ids: iterable
+        If provided, only select records with these image ids.
+    labeled_class_ids: iterable(int)
+        If provided, only select records where at least one of these classes
+        is labeled. Records without a labeled-class mask are treated as having
+        all classes labeled.
+
+    Returns
+    -------
+    selection: list(tuple(str, int, int))
+        The (filepath, offset, length) of each selected record.
+    """
+    image_ids = np.array([str(image_id) for image_id in image_ids], dtype=str) if image_ids is not None else None
+    labeled_class_ids = np.asarray(list(labeled_class_ids), dtype=np.int64) if labeled_class_ids is not None else None
+
+    selection = []
+    for filepath in expand_filepaths(filepaths):
+        index = load_index(filepath)
+        is_selected = np.ones(len(index['offsets']), dtype=bool)
+        if image_ids is not None:
+            is_selected &= np.isin(index['image_ids'], image_ids)
+        if labeled_class_ids is not None:
+            class_mask = index['labeled_class_mask']
+            valid_class_ids = labeled_class_ids[labeled_class_ids < class_mask.shape[1]]
+            is_selected &= class_mask[:, valid_class_ids].any(axis=1) | ~index['has_labeled_classes']
+        for ind in np.flatnonzero(is_selected):
+            selection.append((filepath, int(index['offsets'][ind]), int(index['lengths'][ind])))
+    return selection
+
+
+def iter_selected_records(selection, verify_crc=False):
+    """Reads records selected with `select_records`, seeking directly to each one.
+
+    Yields
+    ------
+    serialized_example: bytes
+        The serialized tf.Example of a selected record.
+    """
+    fp = None
+    current_filepath = None
+    try:
+        for filepath, offset, length in selection:
+            if filepath != current_filepath:
+                if fp is not None:
+                    fp.close()
+                fp = open(filepath, 'rb')
+                current_filepath = filepath
+            fp.seek(offset)
+            for _, record in iter_records(fp.read(length + RECORD_OVERHEAD), verify_crc=verify_crc):
+                yield bytes(record)
+    finally:
+        if fp is not None:
+            fp.close()
+
+
+def lookup_example(filepaths, image_id, feature_names=None):
+    """Looks up an example by image id in indexed TFRecord files.
+
+    Parameters
+    ----------
+    filepaths: str or list(str)
+        One or more filepaths or glob patterns of indexed TFRecord files.
+    image_id: str or int
+        The image id ('image/source_id') of the example.
+    feature_names: iterable(str)
+        The names of features to decode. If None, all features are decoded.
+
+    Returns
+    -------
+    features: dict or None
+        The decoded features of the example, see
+        `partial_data.tfrecord_scanner.parse_example`, or None if no example
+        has the image id.
+    """
+    selection = select_records(filepaths, image_ids=[image_id])
+    for serialized_example in iter_selected_records(selection[:1]):
+        return parse_example(serialized_example, feature_names=feature_names)
+    return None
@@ -0,0 +1,368 @@
+"""Lightweight TFRecord and tf.Example reader that does not depend on Tensorflow.
+
+Records are read directly from the TFRecord framing (length, masked CRC32C of
+the length, data, masked CRC32C of the data) of memory mapped files, and
+tf.Example protos are parsed straight into numpy arrays. Only the requested
+features are decoded, so heavy fields like 'image/encoded' are skipped without
+being copied. This is useful for quickly auditing datasets written by
+`partial_data.tfrecord.write_examples_as_tfrecord`, including from worker
+processes where importing Tensorflow is too slow.
+"""
+import glob
+import mmap
+import struct
+from collections import Counter
+
+import numpy as np
+
+from partial_data.label_mask import LABELED_CLASSES_FEATURE, LABELED_MASK_FEATURE, get_labeled_class_ids
+
+
+# Suffix of the sidecar index files written next to TFRecord files, see partial_data.tfrecord_index
+INDEX_SUFFIX = '.index.npz'
+# Suffix of the manifest written next to sharded TFRecord files, see partial_data.sharding
+MANIFEST_SUFFIX = '.manifest.json'
+# Sidecar files written next to TFRecord shards, skipped when expanding glob patterns
+SIDECAR_SUFFIXES = (INDEX_SUFFIX, MANIFEST_SUFFIX)
+DEFAULT_AUDIT_FEATURES = (
+    LABELED_CLASSES_FEATURE,
+    LABELED_MASK_FEATURE,
+    'image/object/bbox/xmin',
+    'image/object/bbox/xmax',
+    'image/object/bbox/ymin',
+    'image/object/bbox/ymax',
+    'image/object/class/label',
+)
+
+_CRC32C_POLY = 0x82F63B78
+_CRC_MASK_DELTA = 0xA282EAD8
+
+
+def _make_crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ _CRC32C_POLY if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c(data):
+    """Computes the CRC32C (Castagnoli) checksum of a bytes-like object.
+
+    Note: This is a pure Python implementation, so verifying checksums is much
+    slower than only reading the record framing.
+    """
+    crc = 0xFFFFFFFF
+    table = _CRC32C_TABLE
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    """Computes the masked CRC32C checksum used by the TFRecord format."""
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + _CRC_MASK_DELTA) & 0xFFFFFFFF
+
+
+def expand_filepaths(filepaths):
+    """Expands filepaths and glob patterns into a sorted list of files.
+
+    Sidecar index and manifest files matched by a glob pattern are skipped.
+
+    Parameters
+    ----------
+    filepaths: str or list(str)
+        One or more filepaths or glob patterns, e.g.
+        'partial_train.record-?????-of-00003'.
+
+    Returns
+    -------
+    filepaths: list(str)
+        The matched filepaths.
+    """
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+
+    expanded_filepaths = []
+    for filepath_pattern in filepaths:
+        matched_filepaths = sorted(
+            filepath for filepath in glob.glob(filepath_pattern)
+            if filepath == filepath_pattern or not filepath.endswith(SIDECAR_SUFFIXES)
+        )
+        if not matched_filepaths:
+            raise ValueError(f'No TFRecord files match {filepath_pattern}')
+        expanded_filepaths.extend(matched_filepaths)
+    return expanded_filepaths
+
+
+def iter_records(buffer, verify_crc=False):
+    """Iterates over the records in a buffer holding TFRecord data.
+
+    Parameters
+    ----------
+    buffer: bytes-like
+        The contents of a TFRecord file.
+    verify_crc: bool
+        If True, verify the checksums of each record's length and data.
+
+    Yields
+    ------
+    offset: int
+        The byte offset of the record (start of its length field) in the buffer.
+    record: memoryview
+        A view of the record data, which is not copied.
+
+    Raises
+    ------
+    ValueError: if a record is truncated or a checksum does not match
+    """
+    buffer = memoryview(buffer)
+    num_bytes = len(buffer)
+    offset = 0
+    while offset < num_bytes:
+        if offset + 12 > num_bytes:
+            raise ValueError(f'Truncated record header at byte {offset}')
+        length, length_crc = struct.unpack_from('<QI', buffer, offset)
+        data_start = offset + 12
+        data_end = data_start + length
+        if data_end + 4 > num_bytes:
+            raise ValueError(f'Truncated record data at byte {offset}')
+        record = buffer[data_start:data_end]
+        if verify_crc:
+            data_crc, = struct.unpack_from('<I', buffer, data_end)
+            if masked_crc32c(buffer[offset:offset + 8]) != length_crc:
+                raise ValueError(f'Corrupt record length at byte {offset}')
+            if masked_crc32c(record) != data_crc:
+                raise ValueError(f'Corrupt record data at byte {offset}')
+        yield offset, record
+        offset = data_end + 4
+
+
+def _read_varint(buffer, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buffer, pos, end):
+    # Yields (field number, wire type, value) for each field of a serialized proto message, where
+    # value is an int for varint fields and a (start, end) span for all other fields
+    while pos < end:
+        tag, pos = _read_varint(buffer, pos)
+        field_number, wire_type = tag >> 3, tag & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buffer, pos)
+            yield field_number, wire_type, value
+        elif wire_type == 2:
+            length, pos = _read_varint(buffer, pos)
+            yield field_number, wire_type, (pos, pos + length)
+            pos += length
+        elif wire_type == 5:
+            yield field_number, wire_type, (pos, pos + 4)
+            pos += 4
+        elif wire_type == 1:
+            yield field_number, wire_type, (pos, pos + 8)
+            pos += 8
+        else:
+            raise ValueError(f'Unsupported proto wire type {wire_type}')
+
+
+def decode_packed_varints(buffer):
+    """Decodes packed protobuf varints into an int64 array with vectorized numpy ops.
+
+    Parameters
+    ----------
+    buffer: bytes-like
+        Concatenated varint encoded values.
+
+    Returns
+    -------
+    values: np.array
+        The decoded values, as int64.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    lengths = ends - starts + 1
+    byte_positions = np.arange(len(data)) - np.repeat(starts, lengths)
+    values = (data & 0x7F).astype(np.uint64) << (7 * byte_positions).astype(np.uint64)
+    return np.add.reduceat(values, starts).view(np.int64)
+
+
+def _decode_feature(buffer, start, end):
+    for kind, _, (list_start, list_end) in _iter_fields(buffer, start, end):
+        if kind == 1:
+            # BytesList
+            return [bytes(buffer[s:e]) for _, _, (s, e) in _iter_fields(buffer, list_start, list_end)]
+        if kind == 2:
+            # FloatList, values are normally packed but may also be individual fixed32 fields
+            chunks = [
+                np.frombuffer(buffer[s:e], dtype='<f4')
+                for _, _, (s, e) in _iter_fields(buffer, list_start, list_end)
+            ]
+            return np.concatenate(chunks).astype(np.float32) if chunks else np.zeros(0, dtype=np.float32)
+        if kind == 3:
+            # Int64List, values are normally packed
+            chunks = [
+                decode_packed_varints(buffer[value[0]:value[1]]) if wire_type == 2
+                else np.array([value], dtype=np.uint64).view(np.int64)
+                for _, wire_type, value in _iter_fields(buffer, list_start, list_end)
+            ]
+            return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+    return None
+
+
+def parse_example(serialized_example, feature_names=None):
+    """Parses a serialized tf.Example into numpy arrays.
+
+    Parameters
+    ----------
+    serialized_example: bytes-like
+        A serialized tf.Example proto.
+    feature_names: iterable(str)
+        The names of features to decode. Other features are skipped without
+        being decoded or copied. If None, all features are decoded.
+
+    Returns
+    -------
+    features: dict
+        A map from feature name to its values. Int64 and float features are
+        returned as int64 and float32 numpy arrays, bytes features as lists
+        of bytes.
+    """
+    buffer = memoryview(serialized_example)
+    feature_names = set(feature_names) if feature_names is not None else None
+
+    features = {}
+    for example_field, _, (features_start, features_end) in _iter_fields(buffer, 0, len(buffer)):
+        if example_field != 1:
+            continue
+        for features_field, _, (entry_start, entry_end) in _iter_fields(buffer, features_start, features_end):
+            if features_field != 1:
+                continue
+            name = None
+            value_span = None
+            for entry_field, _, span in _iter_fields(buffer, entry_start, entry_end):
+                if entry_field == 1:
+                    name = bytes(buffer[span[0]:span[1]]).decode('utf8')
+                elif entry_field == 2:
+                    value_span = span
+            if feature_names is not None and name not in feature_names:
+                continue
+            features[name] = _decode_feature(buffer, *value_span) if value_span is not None else None
+    return features
+
+
+def iter_examples(filepaths, feature_names=None, verify_crc=False):
+    """Lazily parses tf.Examples from one or more TFRecord files without Tensorflow.
+
+    Files are memory mapped, so only the pages holding requested features are
+    read from disk.
+
+    Parameters
+    ----------
+    filepaths: str or list(str)
+        One or more filepaths or glob patterns of serialized TFRecords.
+    feature_names: iterable(str)
+        The names of features to decode. If None, all features are decoded.
+    verify_crc: bool
+        If True, verify the checksums of each record.
+
+    Yields
+    ------
+    features: dict
+        The decoded features of an example, see `parse_example`.
+    """
+    for filepath in expand_filepaths(filepaths):
+        with open(filepath, 'rb') as fp:
+            if not fp.seek(0, 2):
+                continue
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                # Views of the mapped file must be released before it can be closed
+                records = iter_records(buffer, verify_crc=verify_crc)
+                try:
+                    for _, record in records:
+                        features = parse_example(record, feature_names=feature_names)
+                        record.release()
+                        yield features
+                finally:
+                    records.close()
+
+
+def count_records(filepaths):
+    """Counts the records in one or more TFRecord files by reading only the record framing."""
+    num_records = 0
+    for filepath in expand_filepaths(filepaths):
+        with open(filepath, 'rb') as fp:
+            header = fp.read(12)
+            while len(header) == 12:
+                length, = struct.unpack('<Q', header[:8])
+                fp.seek(length + 4, 1)
+                num_records += 1
+                header = fp.read(12)
+    return num_records
+
+
+def audit_tfrecord(filepaths, verify_crc=False):
+    """Gathers summary statistics for object detection examples in TFRecord files.
+
+    Parameters
+    ----------
+    filepaths: str or list(str)
+        One or more filepaths or glob patterns of TFRecords written with
+        `partial_data.tfrecord.encode_object_detection_tf_example`.
+    verify_crc: bool
+        If True, verify the checksums of each record.
+
+    Returns
+    -------
+    summary: dict
+        Example and box counts, counts of examples missing a labeled class mask,
+        per-class box and labeled-example counts, and box size statistics.
+    """
+    num_examples = 0
+    num_unmasked_examples = 0
+    box_label_counts = Counter()
+    labeled_class_counts = Counter()
+    box_widths = []
+    box_heights = []
+    for features in iter_examples(filepaths, feature_names=DEFAULT_AUDIT_FEATURES, verify_crc=verify_crc):
+        num_examples += 1
+        labeled_classes = get_labeled_class_ids(features)
+        if labeled_classes is None:
+            num_unmasked_examples += 1
+        else:
+            labeled_class_counts.update(labeled_classes.tolist())
+        box_label_counts.update(features['image/object/class/label'].tolist())
+        box_widths.append(features['image/object/bbox/xmax'] - features['image/object/bbox/xmin'])
+        box_heights.append(features['image/object/bbox/ymax'] - features['image/object/bbox/ymin'])
+
+    box_widths = np.concatenate(box_widths) if box_widths else np.zeros(0, dtype=np.float32)
+    box_heights = np.concatenate(box_heights) if box_heights else np.zeros(0, dtype=np.float32)
+    box_areas = box_widths * box_heights
+    return {
+        'num_examples': num_examples,
+        'num_boxes': len(box_areas),
+        'num_unmasked_examples': num_unmasked_examples,
+        'box_label_counts': dict(box_label_counts),
+        'labeled_class_counts': dict(labeled_class_counts),
+        'box_width_mean': float(box_widths.mean()) if len(box_widths) else None,
+        'box_height_mean': float(box_heights.mean()) if len(box_heights) else None,
+        'box_area_quantiles': (
+            np.quantile(box_areas, [0, 0.25, 0.5, 0.75, 1]).tolist() if len(box_areas) else None
+        ),
+    }
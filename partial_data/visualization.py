@@ -3,8 +3,16 @@
 Note: Adapted from https://github.com/tensorflow/models/blob/master/research/object_detection/
     utils/visualization_utils.py
 """
+import io
+import os
+import zlib
+import multiprocessing
+from functools import lru_cache, partial
+
 import numpy as np
 
+import PIL.Image as Image
+import PIL.ImageColor as ImageColor
 import PIL.ImageDraw as ImageDraw
 import PIL.ImageFont as ImageFont
 
@@ -35,6 +43,85 @@ STANDARD_COLORS = [
     'WhiteSmoke', 'Yellow', 'YellowGreen'
 ]
 
+STANDARD_COLORS_RGB = np.array([ImageColor.getrgb(color) for color in STANDARD_COLORS], dtype=np.uint8)
+
+
+@lru_cache(maxsize=None)
+def get_font(font_filepath=None, font_size=24):
+    """Loads a font, caching it so each (font_filepath, font_size) is only loaded once.
+
+    Parameters
+    ----------
+    font_filepath: str
+        Filepath where file for desired font is located. Defaults to Arial,
+        falling back to the PIL default font if it is not available.
+    font_size: int
+        Display font size.
+    """
+    try:
+        font_filepath = font_filepath or 'arial.ttf'
+        return ImageFont.truetype(font_filepath, font_size)
+    except IOError:
+        return ImageFont.load_default()
+
+
+def get_label_color(label):
+    """Gets a color for a label that is the same on every call and in every process.
+
+    Parameters
+    ----------
+    label: hashable
+        A label, e.g. a category name or a tuple of display strings.
+
+    Returns
+    -------
+    color: str
+        One of STANDARD_COLORS.
+    """
+    return STANDARD_COLORS[_get_label_color_index(label)]
+
+
+def _get_label_color_index(label):
+    if isinstance(label, str):
+        label = label.encode('utf8')
+    elif not isinstance(label, bytes):
+        label = repr(label).encode('utf8')
+    return zlib.crc32(label) % len(STANDARD_COLORS)
+
+
+def get_label_colors(labels):
+    """Gets a fixed map of distinct colors for a set of labels, e.g. all category names of a dataset.
+
+    Each label gets its color from `get_label_color` unless an earlier label,
+    in sorted order, already has it, in which case it gets the next unused
+    color. Colors are distinct for up to len(STANDARD_COLORS) labels. A label's
+    color depends on the whole label set, so build the map once for all
+    labels, e.g. `get_label_colors(df['category_name'].unique())`, and pass it
+    to the drawing functions, rather than building it for each image.
+
+    Parameters
+    ----------
+    labels: iterable(hashable)
+        Labels, e.g. category names or ids. Repeated labels get the same
+        color.
+
+    Returns
+    -------
+    color_map: dict
+        A map from each label to one of STANDARD_COLORS.
+    """
+    color_map = {}
+    used = np.zeros(len(STANDARD_COLORS), dtype=bool)
+    for label in sorted(set(labels), key=repr):
+        ind = _get_label_color_index(label)
+        if used.all():
+            used[:] = False
+        while used[ind]:
+            ind = (ind + 1) % len(STANDARD_COLORS)
+        used[ind] = True
+        color_map[label] = STANDARD_COLORS[ind]
+    return color_map
+
 
 def draw_bounding_box_on_image(img,
                                hmin, wmin, hmax, wmax,
@@ -43,7 +130,9 @@ def draw_bounding_box_on_image(img,
                                font_size=24,
                                font_filepath=None,
                                display_str_list=(),
-                               use_normalized_coordinates=True):
+                               use_normalized_coordinates=True,
+                               draw=None,
+                               font=None):
     """Adds a bounding box to an image.
 
     Bounding box coordinates can be specified in either absolute (pixel) or
@@ -78,8 +167,13 @@ def draw_bounding_box_on_image(img,
     use_normalized_coordinates: bool
         If True, treat coordinates as normalized to image dimensions
         (should be between 0-1).  Otherwise treat coordinates as absolute pixel units.
+    draw: PIL.ImageDraw.ImageDraw
+        A drawing context for the image, to reuse when drawing many boxes.
+    font: PIL.ImageFont.ImageFont
+        The font to use for labels. Defaults to the cached font for font_filepath
+        and font_size.
     """
-    draw = ImageDraw.Draw(img)
+    draw = draw or ImageDraw.Draw(img)
     im_width, im_height = img.size
     if use_normalized_coordinates:
         (left, right, top, bottom) = (wmin * im_width, wmax * im_width, hmin * im_height, hmax * im_height)
@@ -89,11 +183,7 @@ def draw_bounding_box_on_image(img,
         draw.line([(left, top), (left, bottom), (right, bottom), (right, top), (left, top)],
                   width=thickness,
                   fill=color)
-    try:
-        font_filepath = font_filepath or 'arial.ttf'
-        font = ImageFont.truetype(font_filepath, font_size)
-    except IOError:
-        font = ImageFont.load_default()
+    font = font or get_font(font_filepath, font_size)
 
     # If the total height of the display strings added to the top of the bounding
     # box exceeds the top of the image, stack the strings below the bounding box
@@ -138,8 +228,10 @@ def draw_bounding_boxes_on_image(img,
         An Nx4 numpy array where each row is a set of bounding box coordinates
         specified as (hmin, wmin, hmax, wmax). The coordinates should be normalized
         between [0, 1].
-    color: str
-        Bounding box line color.
+    color: str or dict
+        Bounding box line color, or a map from display string tuples to
+        colors. If None, each distinct display string tuple is given a stable
+        color, which does not depend on the other boxes, see `get_label_color`.
     thickness: int
         Bounding box line thickness.
     font_size: int
@@ -156,11 +248,7 @@ def draw_bounding_boxes_on_image(img,
     """
     # Get box colors
     if color is None:
-        display_str_list_list_unq = set(display_str_list_list)
-        color_map_inds = np.random.permutation(len(STANDARD_COLORS))[:len(display_str_list_list_unq)]
-        color_map = {display_str_list: STANDARD_COLORS[ind] for display_str_list, ind in
-                     zip(display_str_list_list_unq, color_map_inds)}
-        colors = [color_map[display_str_list] for display_str_list in display_str_list_list]
+        colors = [get_label_color(display_str_list) for display_str_list in display_str_list_list]
     elif type(color) == dict:
         colors = [color[display_str_list] for display_str_list in display_str_list_list]
     else:
@@ -173,11 +261,341 @@ def draw_bounding_boxes_on_image(img,
     if len(boxes_shape) != 2 or boxes_shape[1] != 4:
         raise ValueError('Input must be of size [N, 4]')
 
-    # Add boxes to image
+    # Add boxes to image, sharing one drawing context and font
+    if not display_str_list_list:
+        box_color = get_label_color(()) if color is None or type(color) == dict else color
+        colors = [box_color] * boxes_shape[0]
+    draw = ImageDraw.Draw(img)
+    font = get_font(font_filepath, font_size)
     for i in range(boxes_shape[0]):
         display_str_list = ()
         if display_str_list_list:
             display_str_list = display_str_list_list[i]
         draw_bounding_box_on_image(img, boxes[i, 0], boxes[i, 1], boxes[i, 2], boxes[i, 3],
                                    color=colors[i], thickness=thickness, font_size=font_size,
-                                   font_filepath=font_filepath, display_str_list=display_str_list)
+                                   font_filepath=font_filepath, display_str_list=display_str_list,
+                                   draw=draw, font=font)
+
+
+def _to_str(value):
+    return value.decode('utf8') if isinstance(value, bytes) else str(value)
+
+
+def draw_example(example,
+                 color=None,
+                 thickness=4,
+                 font_size=24,
+                 font_filepath=None,
+                 max_size=None,
+                 label_colors=None):
+    """Loads the image of an example and draws its bounding boxes and labels on it.
+
+    Parameters
+    ----------
+    example: dict-like
+        Either a decoded TFRecord example (with 'image_bytes' and
+        'label_names', see `partial_data.tfrecord.decode_object_detection_tf_example`)
+        or a per-image annotation example (with 'image_filepath' and
+        'category_name', see `partial_data.examples.group_examples_by_image`).
+        Both hold normalized 'hmin', 'wmin', 'hmax', and 'wmax' box coordinates.
+    color: str or dict
+        Bounding box line color, or a map from label name tuples to colors.
+        If None, a stable color is used for each label, see `label_colors`.
+    thickness: int
+        Bounding box line thickness.
+    font_size: int
+        Display font size for labels.
+    font_filepath: str
+        Filepath where file for desired font is located.
+    max_size: tuple(int, int)
+        If provided, the image is downsized to fit within this (width, height)
+        before drawing.
+    label_colors: dict
+        A map from label name (str) to color, e.g. from `get_label_colors` for all
+        labels of a dataset, so labels have distinct colors across images.
+        Takes precedence over `color`.
+
+    Returns
+    -------
+    img: PIL.Image
+        The image with boxes drawn on it.
+    """
+    if 'image_bytes' in example:
+        img = Image.open(io.BytesIO(example['image_bytes']))
+    else:
+        img = Image.open(example['image_filepath'])
+    img = img.convert('RGB')
+    if max_size is not None:
+        img.thumbnail(max_size)
+
+    boxes = np.stack([
+        np.asarray(example['hmin'], dtype=np.float32),
+        np.asarray(example['wmin'], dtype=np.float32),
+        np.asarray(example['hmax'], dtype=np.float32),
+        np.asarray(example['wmax'], dtype=np.float32),
+    ], axis=1)
+    label_names = example['label_names'] if 'label_names' in example else example['category_name']
+    display_str_list_list = [(_to_str(label_name),) for label_name in label_names]
+    if label_colors is not None:
+        color = {display_str_list: label_colors[display_str_list[0]] for display_str_list in display_str_list_list}
+    draw_bounding_boxes_on_image(img, boxes, color=color, thickness=thickness, font_size=font_size,
+                                 font_filepath=font_filepath, display_str_list_list=display_str_list_list)
+    return img
+
+
+def make_contact_sheet(imgs, num_cols=4, cell_size=(320, 320), padding=4, background='white'):
+    """Arranges images in a grid on a single image.
+
+    Parameters
+    ----------
+    imgs: list(PIL.Image)
+        The images to arrange, in row-major order. Each image is downsized to
+        fit within a grid cell if needed, and centered in it.
+    num_cols: int
+        The number of grid columns.
+    cell_size: tuple(int, int)
+        The (width, height) of each grid cell.
+    padding: int
+        The spacing between grid cells, in pixels.
+    background: str
+        The background color.
+
+    Returns
+    -------
+    sheet: PIL.Image
+        The contact sheet.
+    """
+    cell_width, cell_height = cell_size
+    num_rows = max(1, -(-len(imgs) // num_cols))
+    sheet = Image.new(
+        'RGB',
+        (num_cols * (cell_width + padding) + padding, num_rows * (cell_height + padding) + padding),
+        background
+    )
+    for ind, img in enumerate(imgs):
+        if img.width > cell_width or img.height > cell_height:
+            img = img.copy()
+            img.thumbnail(cell_size)
+        row, col = divmod(ind, num_cols)
+        left = padding + col * (cell_width + padding) + (cell_width - img.width) // 2
+        top = padding + row * (cell_height + padding) + (cell_height - img.height) // 2
+        sheet.paste(img, (left, top))
+    return sheet
+
+
+def _render_contact_sheet(examples, output_filepath, num_cols, cell_size, draw_kwargs):
+    imgs = [draw_example(example, max_size=cell_size, **draw_kwargs) for example in examples]
+    make_contact_sheet(imgs, num_cols=num_cols, cell_size=cell_size).save(output_filepath)
+    return output_filepath
+
+
+def render_contact_sheets(examples,
+                          output_dir,
+                          num_cols=4,
+                          num_rows=4,
+                          cell_size=(320, 320),
+                          num_workers=1,
+                          file_prefix='sheet',
+                          **draw_kwargs):
+    """Draws bounding boxes on many examples and saves them as contact sheet images.
+
+    Parameters
+    ----------
+    examples: list(dict-like)
+        Examples to render, see `draw_example`.
+    output_dir: str
+        Directory to save the contact sheets to.
+    num_cols: int
+        The number of grid columns per sheet.
+    num_rows: int
+        The number of grid rows per sheet.
+    cell_size: tuple(int, int)
+        The (width, height) of each grid cell.
+    num_workers: int
+        The number of worker processes rendering sheets in parallel.
+    file_prefix: str
+        Prefix of the sheet filenames, which are suffixed with a sheet index.
+    draw_kwargs:
+        Keyword arguments passed to `draw_example`, e.g. font_filepath or
+        label_colors.
+
+    Returns
+    -------
+    output_filepaths: list(str)
+        The filepaths of the saved contact sheets.
+    """
+    examples_per_sheet = num_cols * num_rows
+    sheets = [
+        (examples[start:start + examples_per_sheet],
+         os.path.join(output_dir, f'{file_prefix}_{sheet_ind:05d}.jpg'))
+        for sheet_ind, start in enumerate(range(0, len(examples), examples_per_sheet))
+    ]
+    render = partial(_render_contact_sheet, num_cols=num_cols, cell_size=cell_size, draw_kwargs=draw_kwargs)
+    if num_workers <= 1:
+        return [render(*sheet) for sheet in sheets]
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        return pool.starmap(render, sheets)
+
+
+def _fill_box_outlines(img_array, top, left, bottom, right, box_colors, thickness):
+    # Fills the outlines of boxes with inclusive pixel coordinates, extending inward from the box edges. Boxes are
+    # drawn in order, so later boxes are on top
+    im_height, im_width = img_array.shape[:2]
+
+    # Rasterize the edge strips of all boxes at once. Each strip is a rectangle, whose rows are runs of consecutive
+    # flat pixel indices, so the indices of all strips are a cumulative sum of steps that jump at each run start
+    inner_top = np.minimum(top + thickness, bottom + 1)
+    inner_bottom = np.maximum(bottom + 1 - thickness, top)
+    inner_left = np.minimum(left + thickness, right + 1)
+    inner_right = np.maximum(right + 1 - thickness, left)
+    strip_tops = np.concatenate([top, inner_bottom, top, top])
+    strip_lefts = np.concatenate([left, left, left, inner_right])
+    strip_widths = np.maximum(np.concatenate([right + 1, right + 1, inner_left, right + 1]) - strip_lefts, 0)
+    strip_heights = np.maximum(np.concatenate([inner_top, bottom + 1, bottom + 1, bottom + 1]) - strip_tops, 0)
+    # Strips of boxes with max < min coordinates are empty
+    strip_heights[strip_widths == 0] = 0
+    if not strip_heights.any():
+        return
+    run_strips = np.repeat(np.arange(len(strip_heights)), strip_heights)
+    run_rows = strip_tops[run_strips] + np.arange(len(run_strips)) - np.repeat(
+        np.cumsum(strip_heights) - strip_heights, strip_heights)
+    run_starts = run_rows * im_width + strip_lefts[run_strips]
+    run_widths = strip_widths[run_strips]
+    pixel_steps = np.ones(run_widths.sum(), dtype=np.int64)
+    run_offsets = np.cumsum(run_widths) - run_widths
+    pixel_steps[run_offsets[0]] = run_starts[0]
+    pixel_steps[run_offsets[1:]] = run_starts[1:] - run_starts[:-1] - run_widths[:-1] + 1
+    pixel_inds = np.cumsum(pixel_steps)
+
+    # Each pixel takes the color of the last box drawn over it. Pixels are written as single void items
+    last_box = np.full(im_height * im_width, -1, dtype=np.int32)
+    np.maximum.at(last_box, pixel_inds, np.repeat((run_strips % len(top)).astype(np.int32), run_widths))
+    pixel_dtype = np.dtype((np.void, img_array.shape[-1] * img_array.itemsize))
+    pixels = img_array.view(pixel_dtype)[..., 0]
+    pixels.flat[pixel_inds] = np.ascontiguousarray(box_colors, dtype=img_array.dtype).view(pixel_dtype)[
+        last_box[pixel_inds], 0]
+
+
+def draw_boxes_on_array(img_array,
+                        boxes,
+                        classes=None,
+                        scores=None,
+                        score_threshold=0.0,
+                        max_labeled_boxes=10,
+                        thickness=4,
+                        font_size=24,
+                        font_filepath=None,
+                        category_names=None,
+                        use_normalized_coordinates=True):
+    """Draws many bounding boxes on an image array at once.
+
+    Box coordinates are filtered, sorted, and converted to pixels with
+    vectorized numpy ops, and the edge strips of all outlines are written into
+    the array with one scatter, rather than drawn one line at a time with PIL.
+    Labels are only drawn for the highest scoring boxes. This is intended for drawing
+    detection outputs, e.g. from infer_detections.py, which can hold 100 boxes
+    per image.
+
+    Parameters
+    ----------
+    img_array: np.array
+        An HxWx3 uint8 image array, which is modified in place.
+    boxes: np.array
+        An Nx4 numpy array where each row is a set of bounding box coordinates
+        specified as (hmin, wmin, hmax, wmax).
+    classes: np.array
+        The integer class id of each box, used to pick box colors and label
+        text. If None, all boxes have class 0.
+    scores: np.array
+        The score of each box. If None, all boxes are drawn and none are
+        labeled with a score.
+    score_threshold: float
+        Boxes with a score below this are not drawn.
+    max_labeled_boxes: int
+        Labels are only drawn for this many of the highest scoring boxes.
+    thickness: int
+        Bounding box line thickness, in pixels, extending inward from the box
+        edges.
+    font_size: int
+        Display font size for labels.
+    font_filepath: str
+        Filepath where file for desired font is located.
+    category_names: dict
+        A map from class id to display name. Class ids are shown if not given.
+    use_normalized_coordinates: bool
+        If True, treat coordinates as normalized to image dimensions
+        (should be between 0-1).  Otherwise treat coordinates as absolute pixel units.
+
+    Returns
+    -------
+    img_array: np.array
+        The input image array, with boxes drawn on it.
+
+    Raises
+    ------
+    ValueError: if boxes is not a [N, 4] array
+    """
+    boxes = np.asarray(boxes, dtype=np.float32)
+    if boxes.ndim != 2 or boxes.shape[1] != 4:
+        raise ValueError('Input must be of size [N, 4]')
+    num_boxes = len(boxes)
+    classes = np.zeros(num_boxes, dtype=np.int64) if classes is None else np.asarray(classes, dtype=np.int64)
+
+    # Filter boxes and sort by ascending score, so the highest scoring boxes are drawn on top
+    if scores is not None:
+        scores = np.asarray(scores, dtype=np.float32)
+        keep_inds = np.flatnonzero(scores >= score_threshold)
+        keep_inds = keep_inds[np.argsort(scores[keep_inds], kind='stable')]
+    else:
+        keep_inds = np.arange(num_boxes)
+    boxes, classes = boxes[keep_inds], classes[keep_inds]
+    if not len(boxes):
+        return img_array
+
+    # Convert to clipped, inclusive pixel coordinates
+    im_height, im_width = img_array.shape[:2]
+    if use_normalized_coordinates:
+        boxes = boxes * np.array([im_height, im_width, im_height, im_width], dtype=np.float32)
+    boxes = np.round(boxes).astype(np.int64)
+    top = boxes[:, 0].clip(0, im_height - 1)
+    left = boxes[:, 1].clip(0, im_width - 1)
+    bottom = boxes[:, 2].clip(0, im_height - 1)
+    right = boxes[:, 3].clip(0, im_width - 1)
+
+    box_colors = STANDARD_COLORS_RGB[classes % len(STANDARD_COLORS_RGB)]
+    _fill_box_outlines(img_array, top, left, bottom, right, box_colors, thickness)
+
+    # Draw labels for the top scoring boxes, which are last in the drawing order. Each label is drawn on a copy of
+    # the image patch around it, which is written back, rather than on a copy of the whole image
+    if max_labeled_boxes > 0:
+        label_inds = np.arange(len(boxes))[-max_labeled_boxes:]
+        font = get_font(font_filepath, font_size)
+        for ind in label_inds:
+            class_id = classes[ind]
+            display_str = category_names.get(class_id, str(class_id)) if category_names else str(class_id)
+            if scores is not None:
+                display_str = f'{display_str}: {int(100 * scores[keep_inds[ind]])}%'
+            text_width, text_height = font.getsize(display_str)
+            margin = np.ceil(0.05 * text_height)
+            text_bottom = top[ind] if top[ind] > text_height + 2 * margin else bottom[ind] + text_height + 2 * margin
+            # Pad the patch, as glyphs can extend past the text size
+            padding = text_height
+            patch_top = max(int(text_bottom - text_height - 2 * margin) - padding, 0)
+            patch_bottom = min(int(text_bottom) + padding, im_height)
+            patch_left = max(int(left[ind]) - padding, 0)
+            patch_right = min(int(left[ind] + text_width + margin) + padding, im_width)
+            if patch_top >= patch_bottom or patch_left >= patch_right:
+                continue
+            patch = Image.fromarray(img_array[patch_top:patch_bottom, patch_left:patch_right])
+            draw = ImageDraw.Draw(patch)
+            patch_text_left = left[ind] - patch_left
+            patch_text_bottom = text_bottom - patch_top
+            draw.rectangle(
+                [(patch_text_left, patch_text_bottom - text_height - 2 * margin),
+                 (patch_text_left + text_width, patch_text_bottom)],
+                fill=tuple(box_colors[ind].tolist()))
+            draw.text((patch_text_left + margin, patch_text_bottom - text_height - margin), display_str,
+                      fill='black', font=font)
+            img_array[patch_top:patch_bottom, patch_left:patch_right] = np.asarray(patch)
+
+    return img_array
@@ -0,0 +1,29 @@
+import pytest
+
+from PIL import Image
+
+
+@pytest.fixture
+def make_example(tmp_path):
+    """Returns a function that creates an object detection example with a synthetic JPEG image.
+
+    The example has one 'cat' box, and any keyword arguments are added to or
+    replace its fields. Each image id gets its own image file in `tmp_path`,
+    named '{image_id}.jpg', colored by the image id.
+    """
+    def make_example(image_id=1, image_size=(64, 48), **fields):
+        image_filepath = str(tmp_path / f'{image_id}.jpg')
+        Image.new('RGB', image_size, (image_id * 20 % 256, 64, 32)).save(image_filepath)
+        example = {
+            'image_filepath': image_filepath,
+            'image_id': image_id,
+            'wmin': [0.1],
+            'wmax': [0.5],
+            'hmin': [0.2],
+            'hmax': [0.6],
+            'category_name': ['cat'],
+            'category_id': [1],
+        }
+        example.update(fields)
+        return example
+    return make_example
@@ -0,0 +1,106 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic_coco import make_synthetic_coco
+from partial_data.coco import (BBOX_COLUMNS, get_bbox_array, load_coco_annotations_as_dataframe,
+                               load_dataframe_cache)
+
+
+def load_coco_annotations_with_pandas(annotations_filepath, local_image_dir):
+    # The original loader, which merges dataframes built from the decoded json and indexes the bbox lists
+    with open(annotations_filepath, 'r') as fp:
+        instances = json.load(fp)
+
+    df_ann = (
+        pd.DataFrame(instances['annotations'])
+        .drop(columns=['segmentation', 'area'])
+        .rename(columns={'id': 'instance_id'})
+    )
+    df_cat = (
+        pd.DataFrame(instances['categories'])
+        .drop(columns=['supercategory'])
+        .rename(columns={'id': 'category_id', 'name': 'category_name'})
+    )
+    df_cat['category_name_orig'] = df_cat['category_name']
+    df_cat['category_name'] = df_cat['category_name'].str.lower().str.replace(' ', '_')
+    df_image = pd.DataFrame(instances['images']).rename(columns={'id': 'image_id'})
+    df_image['image_filepath'] = df_image['file_name'].apply(lambda x: os.path.join(local_image_dir, x))
+    df_image.drop(columns=['license', 'file_name', 'date_captured', 'flickr_url'], inplace=True)
+
+    df_comb = pd.merge(df_ann, df_cat, on='category_id', how='left')
+    df_comb = pd.merge(df_comb, df_image, on='image_id', how='left')
+    df_comb['wmin'] = df_comb['bbox'].str[0] / df_comb['width']
+    df_comb['hmin'] = df_comb['bbox'].str[1] / df_comb['height']
+    df_comb['wmax'] = (df_comb['bbox'].str[0] + df_comb['bbox'].str[2]) / df_comb['width']
+    df_comb['hmax'] = (df_comb['bbox'].str[1] + df_comb['bbox'].str[3]) / df_comb['height']
+    return df_comb
+
+
+@pytest.fixture(scope='module')
+def annotations_filepath(tmp_path_factory):
+    annotations_filepath, _ = make_synthetic_coco(
+        str(tmp_path_factory.mktemp('coco')), num_images=30, image_size=(64, 48), num_categories=12)
+    return annotations_filepath
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_matches_pandas_loader(annotations_filepath, streaming):
+    expected_df = load_coco_annotations_with_pandas(annotations_filepath, 'images')
+    df = load_coco_annotations_as_dataframe(annotations_filepath, 'images', streaming=streaming, bbox_lists=True)
+    pd.testing.assert_frame_equal(df.drop(columns=list(BBOX_COLUMNS)), expected_df, check_like=True)
+
+    bboxes = get_bbox_array(df)
+    assert bboxes.dtype == np.float32 and bboxes.shape == (len(df), 4)
+    np.testing.assert_array_equal(bboxes, np.array(expected_df['bbox'].tolist(), dtype=np.float32))
+
+    # The list column is opt-in
+    df = load_coco_annotations_as_dataframe(annotations_filepath, 'images', streaming=streaming)
+    assert 'bbox' not in df.columns
+    np.testing.assert_array_equal(get_bbox_array(df), bboxes)
+
+
+def test_categorical_columns(annotations_filepath):
+    df = load_coco_annotations_as_dataframe(annotations_filepath, 'images')
+    categorical_df = load_coco_annotations_as_dataframe(annotations_filepath, 'images', categorical=True)
+    for col in ('category_name', 'category_name_orig', 'coco_url', 'image_filepath'):
+        assert isinstance(categorical_df[col].dtype, pd.CategoricalDtype)
+        assert categorical_df[col].astype(object).tolist() == df[col].tolist()
+
+
+@pytest.mark.parametrize('options', [{}, {'categorical': True}, {'bbox_lists': True}])
+def test_cache_round_trip(tmp_path, annotations_filepath, options):
+    cache_filepath = str(tmp_path / 'instances.npz')
+    df = load_coco_annotations_as_dataframe(annotations_filepath, 'images', cache_filepath=cache_filepath, **options)
+    assert os.path.exists(cache_filepath)
+    cached_df = load_coco_annotations_as_dataframe(
+        annotations_filepath, 'images', cache_filepath=cache_filepath, **options)
+    pd.testing.assert_frame_equal(cached_df, df)
+    # The cache is only used with the same options
+    other_options = {'categorical': not options.get('categorical', False)}
+    assert load_dataframe_cache(cache_filepath, metadata={'other': True}) is None
+    assert isinstance(
+        load_coco_annotations_as_dataframe(
+            annotations_filepath, 'images', cache_filepath=cache_filepath, **other_options)['coco_url'].dtype,
+        pd.CategoricalDtype) == other_options['categorical']
+
+
+def test_undefined_ids(tmp_path):
+    annotations_filepath = str(tmp_path / 'instances.json')
+    for images in ([], [{'id': 2, 'file_name': '2.jpg', 'width': 10, 'height': 10}]):
+        with open(annotations_filepath, 'w') as fp:
+            json.dump({
+                'images': images,
+                'categories': [{'id': 1, 'name': 'cat'}],
+                'annotations': [{'id': 1, 'image_id': 1, 'category_id': 1, 'bbox': [0, 0, 1, 1]}],
+            }, fp)
+        with pytest.raises(ValueError):
+            load_coco_annotations_as_dataframe(annotations_filepath, 'images')
+
+    with open(annotations_filepath, 'w') as fp:
+        json.dump({'images': [], 'categories': [], 'annotations': []}, fp)
+    df = load_coco_annotations_as_dataframe(annotations_filepath, 'images')
+    assert len(df) == 0 and get_bbox_array(df).shape == (0, 4)
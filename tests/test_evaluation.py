@@ -0,0 +1,190 @@
+import contextlib
+import csv
+import io
+
+import numpy as np
+import pytest
+
+from partial_data.evaluation import (METRIC_NAMES, compute_iou_matrix, evaluate_detections, main,
+                                     parse_detection_example)
+
+
+NUM_IMAGES = 20
+NUM_CLASSES = 4
+IMAGE_SIZE = 400
+
+
+def make_boxes(rng, num_boxes):
+    # (ymin, xmin, ymax, xmax) pixel boxes spanning the small, medium, and large area ranges
+    sizes = rng.uniform(4, 200, size=(num_boxes, 2))
+    corners = rng.uniform(0, IMAGE_SIZE - sizes)
+    return np.concatenate([corners, corners + sizes], axis=1)
+
+
+def make_images(seed):
+    rng = np.random.RandomState(seed)
+    images = []
+    for _ in range(NUM_IMAGES):
+        groundtruth_boxes = make_boxes(rng, rng.randint(0, 8))
+        num_groundtruth = len(groundtruth_boxes)
+        # Jittered copies of the ground truth, duplicates, and unrelated boxes
+        detection_boxes = np.concatenate([
+            groundtruth_boxes + rng.normal(0, 8, size=groundtruth_boxes.shape),
+            groundtruth_boxes[:2] + rng.normal(0, 3, size=groundtruth_boxes[:2].shape),
+            make_boxes(rng, rng.randint(0, 5)),
+        ])
+        groundtruth_classes = rng.randint(1, NUM_CLASSES + 1, size=num_groundtruth)
+        detection_classes = np.concatenate([
+            groundtruth_classes, groundtruth_classes[:2], rng.randint(1, NUM_CLASSES + 1, size=len(detection_boxes)),
+        ])[:len(detection_boxes)]
+        # Flip some detection classes
+        flip = rng.uniform(size=len(detection_classes)) < 0.1
+        detection_classes[flip] = rng.randint(1, NUM_CLASSES + 1, size=np.count_nonzero(flip))
+        images.append({
+            'groundtruth_boxes': groundtruth_boxes,
+            'groundtruth_classes': groundtruth_classes,
+            'groundtruth_is_crowd': rng.uniform(size=num_groundtruth) < 0.1,
+            'groundtruth_areas': np.prod(groundtruth_boxes[:, 2:] - groundtruth_boxes[:, :2], axis=1),
+            'detection_boxes': detection_boxes,
+            'detection_classes': detection_classes,
+            'detection_scores': rng.uniform(size=len(detection_boxes)),
+            'detection_areas': np.prod(detection_boxes[:, 2:] - detection_boxes[:, :2], axis=1),
+        })
+    return images
+
+
+def evaluate_with_pycocotools(images):
+    coco = pytest.importorskip('pycocotools.coco')
+    cocoeval = pytest.importorskip('pycocotools.cocoeval')
+
+    def to_xywh(box):
+        return [box[1], box[0], box[3] - box[1], box[2] - box[0]]
+
+    dataset = {
+        'images': [{'id': image_id, 'height': IMAGE_SIZE, 'width': IMAGE_SIZE} for image_id in range(len(images))],
+        'categories': [{'id': category_id} for category_id in range(1, NUM_CLASSES + 1)],
+        'annotations': [],
+    }
+    detections = []
+    for image_id, image in enumerate(images):
+        for box, category_id, is_crowd, area in zip(image['groundtruth_boxes'], image['groundtruth_classes'],
+                                                    image['groundtruth_is_crowd'], image['groundtruth_areas']):
+            dataset['annotations'].append({
+                'id': len(dataset['annotations']) + 1, 'image_id': image_id, 'category_id': int(category_id),
+                'bbox': to_xywh(box), 'area': float(area), 'iscrowd': int(is_crowd),
+            })
+        for box, category_id, score in zip(image['detection_boxes'], image['detection_classes'],
+                                           image['detection_scores']):
+            detections.append({
+                'image_id': image_id, 'category_id': int(category_id), 'bbox': to_xywh(box), 'score': float(score),
+            })
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        groundtruth = coco.COCO()
+        groundtruth.dataset = dataset
+        groundtruth.createIndex()
+        evaluator = cocoeval.COCOeval(groundtruth, groundtruth.loadRes(detections), 'bbox')
+        evaluator.evaluate()
+        evaluator.accumulate()
+        evaluator.summarize()
+    return evaluator.stats
+
+
+def test_compute_iou_matrix():
+    boxes1 = np.array([[0, 0, 10, 10], [5, 5, 15, 15]])
+    boxes2 = np.array([[0, 0, 10, 10], [0, 0, 5, 5], [20, 20, 30, 30]])
+    np.testing.assert_allclose(compute_iou_matrix(boxes1, boxes2), [[1, 0.25, 0], [25 / 175, 0, 0]])
+    # The overlap with a crowd box is relative to the area of the other box
+    np.testing.assert_allclose(compute_iou_matrix(boxes1, boxes2[1:2], is_crowd=[True]), [[0.25], [0]])
+    assert compute_iou_matrix(np.zeros((0, 4)), boxes2).shape == (0, 3)
+
+
+def test_perfect_detections():
+    images = make_images(0)
+    for image in images:
+        image['groundtruth_is_crowd'][:] = False
+        for name in ('boxes', 'classes', 'areas'):
+            image['detection_' + name] = image['groundtruth_' + name]
+        image['detection_scores'] = np.ones(len(image['groundtruth_boxes']))
+    metrics = evaluate_detections(images)
+    for name in ('DetectionBoxes_Precision/mAP', 'DetectionBoxes_Precision/mAP@.50IOU',
+                 'DetectionBoxes_Recall/AR@100'):
+        assert metrics[name] == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_evaluate_detections_matches_pycocotools(seed):
+    images = make_images(seed)
+    metrics, per_category_ap = evaluate_detections(images, return_per_category=True)
+    assert list(metrics) == list(METRIC_NAMES)
+    np.testing.assert_allclose(list(metrics.values()), evaluate_with_pycocotools(images), atol=1e-12)
+    assert sorted(per_category_ap) == sorted(set(np.concatenate([image['groundtruth_classes'] for image in images])))
+
+
+def test_evaluate_detections_in_parallel():
+    images = make_images(3)
+    assert evaluate_detections(images, num_workers=2) == evaluate_detections(images)
+
+
+def get_features(labeled_classes=None):
+    features = {
+        'image/height': np.array([100]),
+        'image/width': np.array([200]),
+        'image/object/bbox/ymin': np.array([0.1], dtype=np.float32),
+        'image/object/bbox/xmin': np.array([0.1], dtype=np.float32),
+        'image/object/bbox/ymax': np.array([0.5], dtype=np.float32),
+        'image/object/bbox/xmax': np.array([0.3], dtype=np.float32),
+        'image/object/class/label': np.array([1]),
+        'image/detection/bbox/ymin': np.array([0.1, 0.2], dtype=np.float32),
+        'image/detection/bbox/xmin': np.array([0.1, 0.2], dtype=np.float32),
+        'image/detection/bbox/ymax': np.array([0.5, 0.4], dtype=np.float32),
+        'image/detection/bbox/xmax': np.array([0.3, 0.4], dtype=np.float32),
+        'image/detection/label': np.array([1, 2]),
+        'image/detection/score': np.array([0.9, 0.8], dtype=np.float32),
+    }
+    if labeled_classes is not None:
+        features['image/class/labeled_classes'] = np.array(labeled_classes)
+    return features
+
+
+def test_parse_detection_example():
+    image = parse_detection_example(get_features(labeled_classes=[1]))
+    np.testing.assert_allclose(image['groundtruth_boxes'], [[0.1, 0.1, 0.5, 0.3]])
+    np.testing.assert_array_equal(image['detection_classes'], [1, 2])
+    assert not image['groundtruth_is_crowd'].any()
+    np.testing.assert_allclose(image['groundtruth_areas'], [0.08])
+
+    image = parse_detection_example(get_features(labeled_classes=[1]), ignore_unlabeled_classes=True,
+                                    absolute_box_areas=True)
+    np.testing.assert_array_equal(image['detection_classes'], [1])
+    np.testing.assert_allclose(image['groundtruth_areas'], [0.08 * 100 * 200])
+    # Images without a labeled classes feature keep all detections
+    image = parse_detection_example(get_features(), ignore_unlabeled_classes=True)
+    np.testing.assert_array_equal(image['detection_classes'], [1, 2])
+
+
+def test_main(tmp_path):
+    tf = pytest.importorskip('tensorflow')
+
+    def to_feature(values):
+        if values.dtype.kind == 'f':
+            return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+    tfrecord_filepath = str(tmp_path / 'test_detections.tfrecord-00000-of-00001')
+    with tf.io.TFRecordWriter(tfrecord_filepath) as writer:
+        for labeled_classes in ([1], None):
+            features = {name: to_feature(values) for name, values in get_features(labeled_classes).items()}
+            writer.write(tf.train.Example(features=tf.train.Features(feature=features)).SerializeToString())
+
+    eval_dir = tmp_path / 'evaluate'
+    with contextlib.redirect_stdout(io.StringIO()):
+        main(['--input', str(tmp_path / 'test_detections.tfrecord-*'), '--eval-dir', str(eval_dir),
+              '--ignore-unlabeled-classes'])
+    with open(eval_dir / 'metrics.csv', newline='') as fp:
+        rows = list(csv.reader(fp))
+    assert [row[0] for row in rows] == list(METRIC_NAMES)
+    metrics = {name: float(value) for name, value in rows}
+    # Class 2 has no ground truth, so its detections do not count, and all boxes are in the small area range
+    assert metrics['DetectionBoxes_Precision/mAP'] == pytest.approx(1.0)
+    assert metrics['DetectionBoxes_Precision/mAP (medium)'] == -1.0
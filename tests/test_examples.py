@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic_coco import make_synthetic_coco
+from partial_data.coco import load_coco_annotations_as_dataframe
+from partial_data.examples import DEFAULT_FIRST_COLS, DEFAULT_LIST_COLS, group_examples_by_image
+
+
+def group_examples_with_pandas(df):
+    # The groupby aggregation that group_examples_by_image replaces
+    agg = {col: list for col in DEFAULT_LIST_COLS}
+    agg.update({col: 'first' for col in DEFAULT_FIRST_COLS if col in df.columns})
+    return df.groupby('image_id').agg(agg).reset_index().to_dict('records')
+
+
+@pytest.fixture(scope='module')
+def df(tmp_path_factory):
+    annotations_filepath, _ = make_synthetic_coco(
+        str(tmp_path_factory.mktemp('coco')), num_images=25, image_size=(64, 48), num_categories=8)
+    df = load_coco_annotations_as_dataframe(annotations_filepath, 'images')
+    # Shuffle the instances, so images are not contiguous
+    df = df.sample(frac=1, random_state=0).reset_index(drop=True)
+    df['labeled_cat_ids'] = [[1, image_id % 8] for image_id in df['image_id']]
+    return df
+
+
+def test_matches_groupby(df):
+    examples = group_examples_by_image(df)
+    expected_examples = group_examples_with_pandas(df)
+    assert len(examples) == len(expected_examples) == df['image_id'].nunique()
+    for example, expected_example in zip(examples, expected_examples):
+        assert sorted(example) == sorted(expected_example)
+        assert isinstance(example['image_id'], int)
+        for col, value in example.items():
+            if col in DEFAULT_LIST_COLS:
+                assert isinstance(value, np.ndarray)
+                assert value.tolist() == expected_example[col]
+            else:
+                assert value == expected_example[col]
+
+
+def test_sequence_indexing(df):
+    examples = group_examples_by_image(df, list_cols=['category_id'], first_cols=['width', 'missing'])
+    assert sorted(examples[0]) == ['category_id', 'image_id', 'width']
+    assert examples[-1]['image_id'] == examples[len(examples) - 1]['image_id']
+    assert [example['image_id'] for example in examples[1:6:2]] == [
+        examples[ind]['image_id'] for ind in (1, 3, 5)]
+    with pytest.raises(IndexError):
+        examples[len(examples)]
+    with pytest.raises(IndexError):
+        examples[-len(examples) - 1]
+
+    # Per-instance values are views of the sorted columns
+    assert examples[0]['category_id'].base is examples.list_arrays['category_id']
+    num_instances = sum(len(example['category_id']) for example in examples)
+    assert num_instances == len(df)
+
+
+def test_empty_dataframe():
+    df = pd.DataFrame({col: [] for col in ('image_id',) + DEFAULT_LIST_COLS})
+    examples = group_examples_by_image(df)
+    assert len(examples) == 0 and list(examples) == []
@@ -0,0 +1,137 @@
+import os
+import pickle
+import sqlite3
+from functools import partial
+
+import pytest
+
+from partial_data.image_cache import ImageMetadataCache
+from partial_data.instrumentation import Instrumentation, activate
+
+
+@pytest.fixture
+def image_filepaths(tmp_path):
+    image_filepaths = []
+    for ind in range(5):
+        image_filepath = str(tmp_path / f'{ind}.jpg')
+        with open(image_filepath, 'wb') as fp:
+            fp.write(bytes([ind]) * (ind + 1))
+        image_filepaths.append(image_filepath)
+    return image_filepaths
+
+
+def put(cache, image_filepath, key='key'):
+    cache.put(image_filepath, key, 64, 48, 'JPEG')
+
+
+def get_rows(cache_filepath):
+    conn = sqlite3.connect(cache_filepath)
+    try:
+        return {os.path.basename(row[0]): row[1:] for row in conn.execute(
+            'SELECT filepath, key, last_used FROM image_metadata')}
+    finally:
+        conn.close()
+
+
+def test_hits_and_misses(tmp_path, image_filepaths):
+    instrumentation = Instrumentation()
+    with ImageMetadataCache(str(tmp_path / 'cache.db')) as cache, activate(instrumentation):
+        assert cache.get(image_filepaths[0]) is None
+        put(cache, image_filepaths[0])
+        assert cache.get(image_filepaths[0]) == {'key': 'key', 'width': 64, 'height': 48, 'format': 'JPEG'}
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+    assert instrumentation.counters == {'image_cache/hits': 1, 'image_cache/misses': 1}
+
+    # Entries persist, and are invalidated when the image changes
+    with ImageMetadataCache(str(tmp_path / 'cache.db')) as cache:
+        assert cache.get(image_filepaths[0])['key'] == 'key'
+        with open(image_filepaths[0], 'ab') as fp:
+            fp.write(b'changed')
+        assert cache.get(image_filepaths[0]) is None
+        put(cache, image_filepaths[0], key='changed')
+        assert cache.get(image_filepaths[0])['key'] == 'changed'
+    assert len(get_rows(str(tmp_path / 'cache.db'))) == 1
+
+
+def test_hits_are_written_in_batches(tmp_path, image_filepaths):
+    cache_filepath = str(tmp_path / 'cache.db')
+    with ImageMetadataCache(cache_filepath, touch_batch_size=3) as cache:
+        for image_filepath in image_filepaths:
+            put(cache, image_filepath)
+        last_used = {name: row[1] for name, row in get_rows(cache_filepath).items()}
+
+        for image_filepath in image_filepaths[:2]:
+            cache.get(image_filepath)
+        assert {name: row[1] for name, row in get_rows(cache_filepath).items()} == last_used
+        cache.get(image_filepaths[2])
+        touched_last_used = {name: row[1] for name, row in get_rows(cache_filepath).items()}
+        assert [touched_last_used[name] > last_used[name] for name in sorted(last_used)] == [
+            True, True, True, False, False]
+
+        cache.get(image_filepaths[3])
+    # Pending hits are written on close
+    assert get_rows(cache_filepath)['3.jpg'][1] > last_used['3.jpg']
+
+
+def test_eviction(tmp_path, image_filepaths):
+    with ImageMetadataCache(str(tmp_path / 'cache.db'), max_entries=4) as cache:
+        for image_filepath in image_filepaths[:4]:
+            put(cache, image_filepath)
+        # Updating an entry does not count as a new one
+        for _ in range(3):
+            put(cache, image_filepaths[0], key='updated')
+        assert cache.stats()['evictions'] == 0
+
+        # The least recently used entry is evicted, down to 90% of the limit
+        cache.get(image_filepaths[0])
+        put(cache, image_filepaths[4])
+        assert cache.stats()['evictions'] == 2
+    assert sorted(get_rows(str(tmp_path / 'cache.db'))) == ['0.jpg', '3.jpg', '4.jpg']
+
+
+def test_entries_of_other_connections_are_counted(tmp_path, image_filepaths):
+    cache_filepath = str(tmp_path / 'cache.db')
+    with ImageMetadataCache(cache_filepath) as cache:
+        for image_filepath in image_filepaths[:4]:
+            put(cache, image_filepath)
+    with ImageMetadataCache(cache_filepath, max_entries=4) as cache:
+        put(cache, image_filepaths[4])
+        assert cache.stats()['evictions'] == 2
+
+
+def test_pickling(tmp_path, image_filepaths):
+    cache = ImageMetadataCache(str(tmp_path / 'cache.db'), max_entries=10)
+    put(cache, image_filepaths[0])
+    cache.get(image_filepaths[0])
+
+    unpickled_cache = pickle.loads(pickle.dumps(cache))
+    assert unpickled_cache.max_entries == 10
+    assert unpickled_cache.get(image_filepaths[0])['key'] == 'key'
+    put(unpickled_cache, image_filepaths[1])
+    assert cache.get(image_filepaths[1])['key'] == 'key'
+    assert unpickled_cache.stats()['hits'] == 2
+    assert cache.stats()['hits'] == 2
+    unpickled_cache.close()
+    cache.close()
+    cache.close()
+
+
+def test_cache_in_worker_processes(tmp_path, make_example):
+    pytest.importorskip('tensorflow')
+    from partial_data.tfrecord import encode_object_detection_tf_example, write_examples_as_tfrecord
+
+    examples = [make_example(image_id) for image_id in range(12)]
+    encoder = partial(encode_object_detection_tf_example, image_cache=ImageMetadataCache(str(tmp_path / 'cache.db')))
+    counters = []
+    rows = []
+    for run in range(2):
+        instrumentation = Instrumentation()
+        write_examples_as_tfrecord(examples, str(tmp_path / f'{run}.record'), encoder, num_workers=2,
+                                   instrumentation=instrumentation)
+        counters.append(instrumentation.counters)
+        rows.append(get_rows(str(tmp_path / 'cache.db')))
+    assert counters[0]['image_cache/misses'] == 12 and 'image_cache/hits' not in counters[0]
+    assert counters[1]['image_cache/hits'] == 12 and 'image_cache/misses' not in counters[1]
+    # The workers wrote the last used times of their hits when they exited
+    assert len(rows[1]) == 12
+    assert all(rows[1][name][1] > rows[0][name][1] for name in rows[0])
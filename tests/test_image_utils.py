@@ -0,0 +1,151 @@
+import collections
+import http.server
+import io
+import os
+import threading
+
+import pytest
+
+from PIL import Image
+
+from partial_data.image_utils import ImageDownloader, get_image_format, get_image_metadata_from_header
+
+
+def encode_image(image, **save_kwargs):
+    with io.BytesIO() as fp:
+        image.save(fp, **save_kwargs)
+        return fp.getvalue()
+
+
+def get_pil_metadata(encoded_img):
+    image = Image.open(io.BytesIO(encoded_img))
+    return image.width, image.height, image.format
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'L', 'CMYK'])
+@pytest.mark.parametrize('save_kwargs', [
+    {},
+    # Progressive JPEGs have a SOF2 frame
+    {'progressive': True},
+    {'optimize': True},
+    # An EXIF APP1 segment and an ICC profile APP2 segment before the frame
+    {'exif': b'Exif\x00\x00' + b'\x00' * 64, 'icc_profile': b'\x00' * 300},
+    {'quality': 20, 'subsampling': 0},
+])
+def test_jpeg_header_matches_pil(mode, save_kwargs):
+    encoded_img = encode_image(Image.new(mode, (123, 45)), format='JPEG', **save_kwargs)
+    assert get_image_metadata_from_header(encoded_img) == get_pil_metadata(encoded_img) == (123, 45, 'JPEG')
+
+
+@pytest.mark.parametrize('sof_marker', [0xC1, 0xC3, 0xC9, 0xCF])
+def test_jpeg_start_of_frame_variants(sof_marker):
+    encoded_img = encode_image(Image.new('RGB', (70, 30)), format='JPEG')
+    sof_offset = encoded_img.index(b'\xff\xc0')
+    encoded_img = encoded_img[:sof_offset + 1] + bytes([sof_marker]) + encoded_img[sof_offset + 2:]
+    assert get_image_metadata_from_header(encoded_img) == (70, 30, 'JPEG')
+
+
+def test_jpeg_fill_bytes_and_truncation():
+    encoded_img = encode_image(Image.new('RGB', (70, 30)), format='JPEG')
+    sof_offset = encoded_img.index(b'\xff\xc0')
+    # Any number of 0xFF fill bytes may precede a marker
+    padded_img = encoded_img[:sof_offset] + b'\xff\xff\xff' + encoded_img[sof_offset:]
+    assert get_image_metadata_from_header(padded_img) == (70, 30, 'JPEG')
+    assert get_image_metadata_from_header(encoded_img[:sof_offset + 6]) is None
+    assert get_image_metadata_from_header(encoded_img[:2]) is None
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L', 'P', '1', 'I;16'])
+def test_png_header_matches_pil(mode):
+    encoded_img = encode_image(Image.new(mode, (17, 301)), format='PNG')
+    assert get_image_metadata_from_header(encoded_img) == get_pil_metadata(encoded_img) == (17, 301, 'PNG')
+    assert get_image_metadata_from_header(encoded_img[:20]) is None
+
+
+def test_unsupported_formats():
+    for image_format in ('GIF', 'BMP'):
+        encoded_img = encode_image(Image.new('RGB', (8, 8)), format=image_format)
+        assert get_image_format(encoded_img) is None
+        assert get_image_metadata_from_header(encoded_img) is None
+    assert get_image_metadata_from_header(b'') is None
+
+
+def test_get_image_metadata_falls_back_to_pil():
+    pytest.importorskip('tensorflow')
+    from partial_data.tfrecord import get_image_metadata
+
+    encoded_img = encode_image(Image.new('RGB', (31, 7)), format='GIF')
+    assert get_image_metadata(encoded_img) == (31, 7, 'GIF')
+    # Known dimensions are reused for recognized formats only
+    encoded_img = encode_image(Image.new('RGB', (31, 7)), format='PNG')
+    assert get_image_metadata(encoded_img, width=62, height=14) == (62, 14, 'PNG')
+
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Serves /ok/*, fails /flaky/* with a 503 on the first request, /missing/* with a 404, and cuts /truncated/*
+    # responses short
+    body = b'image data' * 1000
+
+    def do_GET(self):
+        self.server.num_requests[self.path] += 1
+        kind = self.path.split('/')[1]
+        if kind == 'missing' or (kind == 'flaky' and self.server.num_requests[self.path] == 1):
+            self.send_error(404 if kind == 'missing' else 503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body[:100] if kind == 'truncated' else self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def image_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ImageRequestHandler)
+    server.num_requests = collections.Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_image_downloader(tmp_path, image_server):
+    base_url = 'http://127.0.0.1:{}'.format(image_server.server_address[1])
+    output_dir = str(tmp_path / 'images')
+    os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'existing.jpg'), 'wb') as fp:
+        fp.write(b'existing')
+    image_urls = [f'{base_url}/{kind}/{kind}.jpg' for kind in ('ok', 'flaky', 'missing', 'truncated', 'existing')]
+
+    downloader = ImageDownloader(num_parallel=3, timeout=5, max_retries=2, backoff_factor=0)
+    stats = downloader.download_images(image_urls, output_dir)
+    assert (stats['num_downloaded'], stats['num_skipped'], stats['num_failed']) == (2, 1, 2)
+    assert stats['bytes'] == 2 * len(ImageRequestHandler.body)
+    assert stats['failures'] == {image_urls[2]: 'HTTP 404', image_urls[3]: 'ChunkedEncodingError'}
+    # 503s are retried, 404s are not, and existing images are not requested
+    assert image_server.num_requests == {'/ok/ok.jpg': 1, '/flaky/flaky.jpg': 2, '/missing/missing.jpg': 1,
+                                         '/truncated/truncated.jpg': 3}
+
+    # Images are renamed into place once complete, so failed downloads leave nothing behind
+    assert sorted(os.listdir(output_dir)) == ['existing.jpg', 'flaky.jpg', 'ok.jpg']
+    for name in ('ok.jpg', 'flaky.jpg'):
+        with open(os.path.join(output_dir, name), 'rb') as fp:
+            assert fp.read() == ImageRequestHandler.body
+    with open(os.path.join(output_dir, 'existing.jpg'), 'rb') as fp:
+        assert fp.read() == b'existing'
+
+
+def test_image_downloader_local_errors(tmp_path, image_server):
+    base_url = 'http://127.0.0.1:{}'.format(image_server.server_address[1])
+    image_urls = [f'{base_url}/ok/{ind}.jpg' for ind in range(3)]
+
+    # Write errors fail each image without retrying, and do not abort the other downloads
+    downloader = ImageDownloader(num_parallel=2, timeout=5, max_retries=2, backoff_factor=0)
+    stats = downloader.download_images(image_urls, str(tmp_path / 'missing'))
+    assert (stats['num_downloaded'], stats['num_failed']) == (0, 3)
+    assert stats['failures'] == {image_url: 'FileNotFoundError' for image_url in image_urls}
+    assert sum(image_server.num_requests.values()) == 3
@@ -0,0 +1,130 @@
+import json
+
+import pytest
+
+from partial_data.instrumentation import (NULL_INSTRUMENTATION, Instrumentation, activate, count, gauge,
+                                          get_active_instrumentation, timer)
+
+
+def test_stages_counters_and_gauges():
+    instrumentation = Instrumentation()
+    for num_bytes in (100, 300):
+        with instrumentation.timer('stage') as stage_timer:
+            stage_timer.add_bytes(num_bytes)
+    instrumentation.add_time('other', 2.0, num_bytes=2 ** 20, count=4)
+    instrumentation.count('examples')
+    instrumentation.count('examples', 2)
+    for value in (3, 1, 2):
+        instrumentation.gauge('queue', value)
+
+    summary = instrumentation.summary()
+    assert summary['stages']['stage']['count'] == 2 and summary['stages']['stage']['bytes'] == 400
+    assert summary['stages']['other'] == {'count': 4, 'seconds': 2.0, 'mean_ms': 500.0, 'bytes': 2 ** 20,
+                                          'mb_per_sec': 0.5}
+    assert summary['counters'] == {'examples': 3}
+    assert summary['gauges'] == {'queue': {'count': 3, 'mean': 2.0, 'max': 3, 'last': 2}}
+    assert summary['profile'] is None
+
+
+def test_merge():
+    instrumentation = Instrumentation()
+    instrumentation.add_time('stage', 1.0, num_bytes=10)
+    instrumentation.gauge('queue', 5)
+    other_instrumentation = Instrumentation()
+    other_instrumentation.add_time('stage', 3.0, num_bytes=30, count=2)
+    other_instrumentation.count('examples', 7)
+    other_instrumentation.gauge('queue', 1)
+    other_instrumentation.gauge('other_queue', 4)
+
+    instrumentation.merge(other_instrumentation.get_state())
+    assert instrumentation.stages == {'stage': {'count': 3, 'seconds': 4.0, 'bytes': 40}}
+    assert instrumentation.counters == {'examples': 7}
+    assert instrumentation.gauges == {'queue': {'count': 2, 'sum': 6, 'max': 5, 'last': 1},
+                                      'other_queue': {'count': 1, 'sum': 4, 'max': 4, 'last': 4}}
+
+
+def test_activate():
+    assert get_active_instrumentation() is NULL_INSTRUMENTATION
+    # Module level functions are no-ops without an active instrumentation
+    with timer('stage') as stage_timer:
+        stage_timer.add_bytes(1)
+    count('examples')
+    gauge('queue', 1)
+
+    outer_instrumentation = Instrumentation()
+    inner_instrumentation = Instrumentation()
+    with activate(outer_instrumentation):
+        count('examples')
+        with activate(inner_instrumentation):
+            with timer('stage'):
+                count('examples', 2)
+            gauge('queue', 1)
+        count('examples')
+        with activate(None):
+            count('examples')
+    assert get_active_instrumentation() is NULL_INSTRUMENTATION
+    assert outer_instrumentation.counters == {'examples': 2}
+    assert inner_instrumentation.counters == {'examples': 2}
+    assert list(inner_instrumentation.stages) == ['stage'] and list(inner_instrumentation.gauges) == ['queue']
+
+
+def test_profiling_and_saving(tmp_path):
+    instrumentation = Instrumentation(profile=True)
+    with instrumentation.profiling():
+        sorted(range(1000), key=lambda x: -x)
+    summary = instrumentation.summary(num_profile_functions=3)
+    assert 0 < len(summary['profile']) <= 3
+    assert instrumentation.get_profile_stats() is not None
+    instrumentation.save_profile(str(tmp_path / 'profile.prof'))
+
+    instrumentation.count('examples')
+    instrumentation.save_summary(str(tmp_path / 'summary.json'))
+    with open(tmp_path / 'summary.json', 'r') as fp:
+        assert json.load(fp)['counters'] == {'examples': 1}
+
+    # Profiling is a no-op when disabled
+    instrumentation = Instrumentation()
+    with instrumentation.profiling():
+        pass
+    assert instrumentation.get_profile_stats() is None
+
+
+def test_serial_writing_only_instruments_encoding(tmp_path, make_example):
+    pytest.importorskip('tensorflow')
+    from partial_data.tfrecord import _iter_serialized_examples, encode_object_detection_tf_example
+
+    def encoder(example):
+        count('encoded')
+        return encode_object_detection_tf_example(example)
+
+    examples = [make_example(image_id) for image_id in range(3)]
+    consumer_instrumentation = Instrumentation()
+    writer_instrumentation = Instrumentation()
+    with activate(consumer_instrumentation):
+        for _ in _iter_serialized_examples(examples, encoder, instrumentation=writer_instrumentation):
+            # The consumer runs with its own instrumentation active between examples
+            assert get_active_instrumentation() is consumer_instrumentation
+            count('consumed')
+    assert writer_instrumentation.counters == {'encoded': 3}
+    assert writer_instrumentation.stages['encode/encode_example']['count'] == 3
+    assert consumer_instrumentation.counters == {'consumed': 3}
+
+
+def test_reading_records_queue_depth(tmp_path, make_example):
+    pytest.importorskip('tensorflow')
+    from partial_data.tfrecord import (decode_object_detection_tf_example, encode_object_detection_tf_example,
+                                       iter_examples_from_tfrecord, write_examples_as_tfrecord)
+
+    output_filebase = str(tmp_path / 'data.record')
+    write_examples_as_tfrecord([make_example(image_id) for image_id in range(10)], output_filebase,
+                               encode_object_detection_tf_example)
+    instrumentation = Instrumentation()
+    examples = list(iter_examples_from_tfrecord(output_filebase, decode_object_detection_tf_example, batch_size=4,
+                                                instrumentation=instrumentation))
+    assert len(examples) == 10
+    assert instrumentation.counters == {'read/batches': 3, 'read/examples': 10}
+    # Batches of 4, 4, and 2 examples are queued for the consumer
+    assert instrumentation.gauges['read/decoded_queue_depth'] == {'count': 10, 'sum': 10 + 10 + 3, 'max': 4,
+                                                                  'last': 1}
+    assert instrumentation.stages['read/next_batch']['count'] == 4
+    assert instrumentation.stages['read/next_batch']['bytes'] > 0
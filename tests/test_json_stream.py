@@ -0,0 +1,102 @@
+import io
+import json
+
+import pandas as pd
+import pytest
+
+from partial_data.coco import (coco_instances_to_columns, get_bbox_array, load_coco_annotations_as_dataframe,
+                               stream_coco_columns)
+from partial_data.json_stream import JsonStreamParser
+
+
+DOCUMENT = {
+    'info': {'description': 'café ☃', 'year': 2017, 'nested': [[], {}, [1.5e-3, -2]]},
+    'empty': [],
+    'items': [{'id': 12345678901, 'value': 0.125}, 'text, with "quotes"', None, True, [1, [2, [3]]], -7.5e10],
+    'last': 1234567,
+}
+
+INSTANCES = {
+    'info': {'description': 'test'},
+    'images': [
+        {'id': 3, 'file_name': '3.jpg', 'coco_url': 'http://images/3.jpg', 'height': 100, 'width': 200},
+        {'id': 1, 'file_name': '1.jpg', 'coco_url': 'http://images/1.jpg', 'height': 50, 'width': 40},
+    ],
+    'annotations': [
+        {'id': 10, 'image_id': 1, 'category_id': 18, 'iscrowd': 0, 'bbox': [4.0, 5.0, 10.0, 20.5],
+         'segmentation': [[1.0, 2.0, 3.0, 4.0]], 'area': 200.0},
+        {'id': 11, 'image_id': 3, 'category_id': 1, 'iscrowd': 1, 'bbox': [0, 0, 200, 100],
+         'segmentation': {'counts': [1, 2], 'size': [100, 200]}, 'area': 20000},
+        {'id': 12, 'image_id': 3, 'category_id': 18, 'iscrowd': 0, 'bbox': [50.25, 10.5, 25.0, 30.0],
+         'segmentation': [], 'area': 750.0},
+    ],
+    'categories': [
+        {'id': 1, 'name': 'person', 'supercategory': 'person'},
+        {'id': 18, 'name': 'Hot Dog', 'supercategory': 'food'},
+    ],
+}
+
+
+def iter_document(text, chunk_size, array_keys):
+    return list(JsonStreamParser(io.StringIO(text), chunk_size=chunk_size).iter_items(array_keys=array_keys))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 2 ** 20])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_iter_items_matches_json_load(chunk_size, indent):
+    text = json.dumps(DOCUMENT, indent=indent)
+    expected_items = []
+    for key, value in json.loads(text).items():
+        if key in ('items', 'empty'):
+            expected_items.extend((key, item) for item in value)
+        else:
+            expected_items.append((key, value))
+    assert iter_document(text, chunk_size, array_keys=['items', 'empty']) == expected_items
+    assert iter_document(text, chunk_size, array_keys=[]) == list(json.loads(text).items())
+
+
+@pytest.mark.parametrize('text', ['{}', ' { } ', '{"a": [1, 2]}'])
+def test_iter_items_small_documents(text):
+    assert dict(iter_document(text, 1, array_keys=[])) == json.loads(text)
+
+
+@pytest.mark.parametrize('text', ['', '[1, 2]', '{"a": 1', '{"a": [1, 2}', '{"a" 1}'])
+def test_iter_items_invalid_documents(text):
+    with pytest.raises(ValueError):
+        iter_document(text, 2, array_keys=['a'])
+
+
+@pytest.mark.parametrize('chunk_size', [5, 2 ** 20])
+def test_stream_coco_columns_matches_json_load(tmp_path, chunk_size):
+    annotations_filepath = str(tmp_path / 'instances.json')
+    with open(annotations_filepath, 'w') as fp:
+        json.dump(INSTANCES, fp)
+
+    columns = stream_coco_columns(annotations_filepath, chunk_size=chunk_size)
+    assert columns == coco_instances_to_columns(INSTANCES)
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_load_coco_annotations_as_dataframe(tmp_path, categorical):
+    annotations_filepath = str(tmp_path / 'instances.json')
+    with open(annotations_filepath, 'w') as fp:
+        json.dump(INSTANCES, fp)
+    cache_filepath = str(tmp_path / 'instances.npz')
+
+    df = load_coco_annotations_as_dataframe(annotations_filepath, 'images', categorical=categorical)
+    assert df['instance_id'].tolist() == [10, 11, 12]
+    assert df['category_name'].tolist() == ['hot_dog', 'person', 'hot_dog']
+    assert df['image_filepath'].tolist() == ['images/1.jpg', 'images/3.jpg', 'images/3.jpg']
+    assert get_bbox_array(df)[0].tolist() == [4.0, 5.0, 10.0, 20.5]
+    assert df['wmax'].tolist()[2] == pytest.approx(75.25 / 200)
+    assert isinstance(df['category_name'].dtype, pd.CategoricalDtype) == categorical
+
+    streamed_df = load_coco_annotations_as_dataframe(
+        annotations_filepath, 'images', streaming=True, categorical=categorical)
+    pd.testing.assert_frame_equal(streamed_df, df)
+
+    # The first call saves the cache, the second one loads it
+    for _ in range(2):
+        cached_df = load_coco_annotations_as_dataframe(
+            annotations_filepath, 'images', cache_filepath=cache_filepath, categorical=categorical)
+        pd.testing.assert_frame_equal(cached_df, df)
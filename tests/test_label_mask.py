@@ -0,0 +1,81 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from partial_data.label_mask import (LABELED_CLASSES_FORMATS, get_labeled_class_ids, pack_labeled_class_mask,
+                                     unpack_labeled_class_mask)
+from partial_data.tfrecord_scanner import parse_example
+
+
+NUM_CLASSES = 11
+
+
+def test_pack_unpack_labeled_class_mask():
+    packed_mask = pack_labeled_class_mask([0, 3, 10], NUM_CLASSES)
+    assert len(packed_mask) == 2
+    mask = unpack_labeled_class_mask(packed_mask, NUM_CLASSES)
+    np.testing.assert_array_equal(np.flatnonzero(mask), [0, 3, 10])
+
+    with pytest.raises(ValueError):
+        pack_labeled_class_mask([NUM_CLASSES], NUM_CLASSES)
+
+
+def test_get_labeled_class_ids_is_sorted():
+    features = {'image/class/labeled_classes': np.array([7, 2, 7, 5], dtype=np.int64)}
+    np.testing.assert_array_equal(get_labeled_class_ids(features), [2, 5, 7])
+    assert get_labeled_class_ids({}) is None
+
+
+@pytest.fixture
+def example(make_example):
+    return make_example(category_id=[3])
+
+
+@pytest.mark.parametrize('labeled_classes_format', LABELED_CLASSES_FORMATS)
+@pytest.mark.parametrize('labeled_cat_ids', [None, [], [3], [9, 1, 3]])
+def test_labeled_classes_round_trip(example, labeled_classes_format, labeled_cat_ids):
+    tf = pytest.importorskip('tensorflow')
+    from partial_data.tfrecord import decode_object_detection_tf_example, encode_object_detection_tf_example
+
+    if labeled_cat_ids is not None:
+        example['labeled_cat_ids'] = labeled_cat_ids
+    serialized_example = encode_object_detection_tf_example(
+        example, labeled_classes_format=labeled_classes_format, num_classes=NUM_CLASSES).SerializeToString()
+
+    expected_mask = np.ones(NUM_CLASSES, dtype=bool)
+    if labeled_cat_ids is not None:
+        expected_mask[:] = False
+        expected_mask[labeled_cat_ids] = True
+
+    decoded_example = decode_object_detection_tf_example(tf.constant(serialized_example), num_classes=NUM_CLASSES)
+    np.testing.assert_array_equal(decoded_example['labeled_class_mask'].numpy(), expected_mask)
+
+    class_ids = get_labeled_class_ids(parse_example(serialized_example))
+    if labeled_cat_ids is None:
+        assert class_ids is None
+    else:
+        np.testing.assert_array_equal(class_ids, sorted(labeled_cat_ids))
+
+
+@pytest.mark.parametrize('labeled_classes_format', LABELED_CLASSES_FORMATS)
+def test_no_labeled_classes_round_trip(tmp_path, example, labeled_classes_format):
+    pytest.importorskip('tensorflow')
+    from partial_data.tfrecord import (decode_object_detection_tf_example, encode_object_detection_tf_example,
+                                       iter_examples_from_tfrecord, write_examples_as_tfrecord)
+
+    # Examples with no labeled classes decode differently from examples with all classes labeled
+    examples = [dict(example, image_id=1, labeled_cat_ids=[]), dict(example, image_id=2)]
+    output_filebase = str(tmp_path / 'data.record')
+    write_examples_as_tfrecord(
+        examples, output_filebase,
+        partial(encode_object_detection_tf_example, labeled_classes_format=labeled_classes_format,
+                num_classes=NUM_CLASSES if labeled_classes_format != 'ids' else None))
+    for num_classes in (None, 4, 20):
+        decoded_examples = list(iter_examples_from_tfrecord(
+            output_filebase, partial(decode_object_detection_tf_example, num_classes=num_classes), batch_size=2))
+        assert [decoded_example['labeled_classes'].tolist() for decoded_example in decoded_examples] == [[], []]
+        if num_classes is not None:
+            assert not decoded_examples[0]['labeled_class_mask'].any()
+            assert decoded_examples[1]['labeled_class_mask'].all()
+            assert decoded_examples[0]['labeled_class_mask'].shape == (num_classes,)
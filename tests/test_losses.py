@@ -0,0 +1,141 @@
+import numpy as np
+import pytest
+
+from benchmarks.loss_benchmark import naive_masked_sigmoid_cross_entropy
+
+
+tf = pytest.importorskip('tensorflow')
+from partial_data.losses import (get_label_proportion_weights, masked_sigmoid_cross_entropy,  # noqa: E402
+                                 masked_sigmoid_focal_loss, masked_softmax_cross_entropy, masked_softmax_focal_loss)
+
+
+BATCH_SIZE = 4
+NUM_ANCHORS = 6
+NUM_CLASSES = 10
+
+
+@pytest.fixture
+def inputs():
+    rng = np.random.RandomState(0)
+    logits = rng.normal(scale=3, size=(BATCH_SIZE, NUM_ANCHORS, NUM_CLASSES)).astype(np.float32)
+    targets = np.eye(NUM_CLASSES, dtype=np.float32)[rng.randint(0, NUM_CLASSES, (BATCH_SIZE, NUM_ANCHORS))]
+    # All, one, some, and no classes labeled
+    labeled_class_mask = np.zeros((BATCH_SIZE, NUM_CLASSES), dtype=bool)
+    labeled_class_mask[0] = True
+    labeled_class_mask[1, 3] = True
+    labeled_class_mask[2, [0, 2, 5, 7]] = True
+    return logits, targets, labeled_class_mask
+
+
+def sigmoid_cross_entropy(logits, targets):
+    return np.maximum(logits, 0) - logits * targets + np.log1p(np.exp(-np.abs(logits)))
+
+
+def get_gradients(loss_fn, logits, *args, **kwargs):
+    logits = tf.constant(logits)
+    with tf.GradientTape() as tape:
+        tape.watch(logits)
+        loss = tf.reduce_sum(loss_fn(logits, *args, **kwargs))
+    return tape.gradient(loss, logits).numpy()
+
+
+def test_label_proportion_weights():
+    # Proportions of 1, 0.5, 0.1, and 0
+    labeled_class_mask = np.zeros((4, NUM_CLASSES), dtype=bool)
+    labeled_class_mask[0] = True
+    labeled_class_mask[1, :5] = True
+    labeled_class_mask[2, 0] = True
+
+    weights = get_label_proportion_weights(labeled_class_mask).numpy()
+    np.testing.assert_allclose(weights, [1, 1 + 4 * 0.5 / 0.9, 5, 0], rtol=1e-6)
+    for gamma in (-1.0, 0.5, 2.0):
+        weights = get_label_proportion_weights(labeled_class_mask, gamma=gamma).numpy()
+        np.testing.assert_allclose(weights[[0, 2, 3]], [1, 5, 0], rtol=1e-5)
+        assert np.isfinite(weights).all()
+    weights = get_label_proportion_weights(labeled_class_mask, anchor_proportion=0.5, anchor_weight=2).numpy()
+    np.testing.assert_allclose(weights[:2], [1, 2], rtol=1e-6)
+
+    np.testing.assert_allclose(get_label_proportion_weights(labeled_class_mask, 'num_labeled').numpy(),
+                               [1, 2, 10, 0])
+    np.testing.assert_allclose(get_label_proportion_weights(labeled_class_mask, 'none').numpy(), [1, 1, 1, 1])
+    with pytest.raises(ValueError):
+        get_label_proportion_weights(labeled_class_mask, 'unknown')
+
+
+@pytest.mark.parametrize('normalization', ['none', 'num_labeled', 'proportion'])
+def test_masked_sigmoid_cross_entropy(inputs, normalization):
+    logits, targets, labeled_class_mask = inputs
+    anchor_weights = np.random.RandomState(1).uniform(size=(BATCH_SIZE, NUM_ANCHORS)).astype(np.float32)
+    loss = masked_sigmoid_cross_entropy(logits, targets, labeled_class_mask, anchor_weights=anchor_weights,
+                                        normalization=normalization).numpy()
+    assert loss.shape == (BATCH_SIZE, NUM_ANCHORS, NUM_CLASSES)
+
+    example_weights = get_label_proportion_weights(labeled_class_mask, normalization).numpy()
+    expected_loss = (sigmoid_cross_entropy(logits, targets) * labeled_class_mask[:, None, :]
+                     * example_weights[:, None, None] * anchor_weights[:, :, None])
+    np.testing.assert_allclose(loss, expected_loss, rtol=1e-5, atol=1e-6)
+
+    # Unlabeled classes get no gradient
+    gradients = get_gradients(masked_sigmoid_cross_entropy, logits, targets, labeled_class_mask)
+    assert not gradients[~np.broadcast_to(labeled_class_mask[:, None, :], logits.shape)].any()
+    assert gradients[np.broadcast_to(labeled_class_mask[:, None, :], logits.shape)].all()
+
+
+@pytest.mark.parametrize('normalization', ['none', 'num_labeled'])
+def test_masked_sigmoid_cross_entropy_matches_gather(inputs, normalization):
+    logits, targets, labeled_class_mask = inputs
+    loss = masked_sigmoid_cross_entropy(logits, targets, labeled_class_mask, normalization=normalization)
+    expected_loss = naive_masked_sigmoid_cross_entropy(
+        tf.constant(logits), tf.constant(targets), tf.constant(labeled_class_mask), normalization=normalization)
+    np.testing.assert_allclose(tf.reduce_sum(loss, axis=[1, 2]).numpy(), expected_loss.numpy(), rtol=1e-5)
+
+
+def test_masked_sigmoid_focal_loss(inputs):
+    logits, targets, labeled_class_mask = inputs
+    probs = 1 / (1 + np.exp(-logits))
+    p_t = targets * probs + (1 - targets) * (1 - probs)
+    alpha_t = targets * 0.25 + (1 - targets) * 0.75
+    expected_loss = sigmoid_cross_entropy(logits, targets) * (1 - p_t) ** 2 * alpha_t * labeled_class_mask[:, None]
+    loss = masked_sigmoid_focal_loss(logits, targets, labeled_class_mask).numpy()
+    np.testing.assert_allclose(loss, expected_loss, rtol=1e-4, atol=1e-6)
+
+    # Without focusing and class weighting it is the cross-entropy
+    np.testing.assert_allclose(
+        masked_sigmoid_focal_loss(logits, targets, labeled_class_mask, gamma=0.0, alpha=None).numpy(),
+        masked_sigmoid_cross_entropy(logits, targets, labeled_class_mask).numpy(), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('normalization', ['none', 'proportion'])
+def test_masked_softmax_cross_entropy(inputs, normalization):
+    logits, targets, labeled_class_mask = inputs
+    # Targets on unlabeled classes are ignored
+    targets = targets * labeled_class_mask[:, None, :]
+    loss = masked_softmax_cross_entropy(logits, targets, labeled_class_mask, normalization=normalization).numpy()
+    assert loss.shape == (BATCH_SIZE, NUM_ANCHORS)
+
+    # The softmax of each example is over its labeled logit columns
+    example_weights = get_label_proportion_weights(labeled_class_mask, normalization).numpy()
+    for ind in range(BATCH_SIZE):
+        labeled_logits = logits[ind][:, labeled_class_mask[ind]]
+        labeled_targets = targets[ind][:, labeled_class_mask[ind]]
+        if not labeled_logits.shape[1]:
+            np.testing.assert_array_equal(loss[ind], 0)
+            continue
+        log_probs = labeled_logits - np.log(np.exp(labeled_logits).sum(axis=1, keepdims=True))
+        expected_loss = -(labeled_targets * log_probs).sum(axis=1) * example_weights[ind]
+        np.testing.assert_allclose(loss[ind], expected_loss, rtol=1e-5, atol=1e-6)
+
+    gradients = get_gradients(masked_softmax_cross_entropy, logits, targets, labeled_class_mask)
+    assert not gradients[~np.broadcast_to(labeled_class_mask[:, None, :], logits.shape)].any()
+
+
+def test_masked_softmax_focal_loss(inputs):
+    logits, targets, labeled_class_mask = inputs
+    np.testing.assert_allclose(
+        masked_softmax_focal_loss(logits, targets, labeled_class_mask, gamma=0.0).numpy(),
+        masked_softmax_cross_entropy(logits, targets, labeled_class_mask).numpy(), rtol=1e-5, atol=1e-6)
+    # Focusing down-weights every anchor
+    loss = masked_softmax_focal_loss(logits, targets, labeled_class_mask).numpy()
+    assert (loss <= masked_softmax_cross_entropy(logits, targets, labeled_class_mask).numpy() + 1e-6).all()
+    gradients = get_gradients(masked_softmax_focal_loss, logits, targets, labeled_class_mask)
+    assert not gradients[~np.broadcast_to(labeled_class_mask[:, None, :], logits.shape)].any()
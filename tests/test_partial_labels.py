@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_coco import make_synthetic_coco
+from partial_data.coco import load_coco_annotations_as_dataframe
+from partial_data.partial_labels import assign_images_to_subsets, generate_partial_datasets
+
+
+DATASET1_CATS = {'category_1', 'category_2', 'category_3', 'category_4'}
+DATASET2_CATS = {'category_5', 'category_6', 'category_7', 'category_3', 'category_4'}
+
+
+def generate_partial_datasets_as_notebook(df_train, dataset1_cats, dataset2_cats, seed=0):
+    # The dataset generation of object_detection/datasets/partial_v2/generate_annotation_dataset.ipynb, returning the
+    # image ids of each subset and the instance ids of each dataset split
+    dataset3_cats = dataset1_cats | dataset2_cats
+
+    np.random.seed(seed)
+    image_ids = df_train['image_id'].unique()
+    image_id_dataset_mask = np.random.randint(0, 2, len(image_ids)).astype(bool)
+    image_ids_dataset1 = set(image_ids[image_id_dataset_mask].tolist())
+    image_ids_dataset2 = set(image_ids[~image_id_dataset_mask].tolist())
+    is_dataset1_instance = df_train['image_id'].isin(image_ids_dataset1) & df_train['category_name'].isin(dataset1_cats)
+    is_dataset2_instance = df_train['image_id'].isin(image_ids_dataset2) & df_train['category_name'].isin(dataset2_cats)
+    is_dataset12_instance = is_dataset1_instance | is_dataset2_instance
+    image_ids_dataset12 = set(df_train.loc[is_dataset12_instance, 'image_id'].tolist())
+    is_dataset3_instance = (
+        df_train['image_id'].isin(image_ids_dataset12) & df_train['category_name'].isin(dataset3_cats))
+    df_dataset12 = df_train[is_dataset12_instance]
+    df_dataset3 = df_train[is_dataset3_instance]
+
+    np.random.seed(seed)
+    num_train = round(len(image_ids) * 0.7)
+    num_val = round(len(image_ids) * 0.1)
+    image_ids_shuffle = np.random.permutation(image_ids)
+    split_image_ids = {
+        'train': set(image_ids_shuffle[:num_train].tolist()),
+        'val': set(image_ids_shuffle[num_train:num_train + num_val].tolist()),
+        'test': set(image_ids_shuffle[num_train + num_val:].tolist()),
+    }
+    datasets = {
+        name: {split: df[df['image_id'].isin(ids)]['instance_id'].tolist() for split, ids in split_image_ids.items()}
+        for name, df in [('partial', df_dataset12), ('complete', df_dataset3)]
+    }
+    return image_ids_dataset1, image_ids_dataset2, datasets
+
+
+@pytest.fixture(scope='module')
+def df(tmp_path_factory):
+    annotations_filepath, _ = make_synthetic_coco(
+        str(tmp_path_factory.mktemp('coco')), num_images=60, image_size=(64, 48), num_categories=10)
+    # Images are in id order, so the notebook's image order, by first appearance, is the sorted order
+    return load_coco_annotations_as_dataframe(annotations_filepath, 'images')
+
+
+def test_matches_notebook(df):
+    image_ids_dataset1, image_ids_dataset2, expected_datasets = generate_partial_datasets_as_notebook(
+        df, DATASET1_CATS, DATASET2_CATS)
+
+    # The notebook puts images with a random 1 in the first dataset
+    subset_image_ids = assign_images_to_subsets(df['image_id'], num_subsets=2, seed=0)
+    assert set(subset_image_ids[1].tolist()) == image_ids_dataset1
+    assert set(subset_image_ids[0].tolist()) == image_ids_dataset2
+
+    specs = [{'image_ids': subset_image_ids[1], 'cats': DATASET1_CATS},
+             {'image_ids': subset_image_ids[0], 'cats': DATASET2_CATS}]
+    datasets, category_id_map = generate_partial_datasets(df, specs, seed=0)
+    for name, splits in expected_datasets.items():
+        assert list(datasets[name]) == ['train', 'val', 'test']
+        for split, instance_ids in splits.items():
+            assert datasets[name][split]['instance_id'].tolist() == instance_ids
+
+    # Categories are renumbered in name order, rather than in the notebook's set order
+    assert category_id_map == {name: ind for ind, name in enumerate(sorted(DATASET1_CATS | DATASET2_CATS), 1)}
+    df_partial = datasets['partial']['train']
+    assert (df_partial['category_id'] == df_partial['category_name'].map(category_id_map)).all()
+    assert df_partial['category_id_orig'].tolist() == df.set_index('instance_id').loc[
+        df_partial['instance_id'], 'category_id'].tolist()
+
+    # Each image's labeled categories are those of its subset
+    expected_labeled_cat_ids = {
+        1: sorted(category_id_map[name] for name in DATASET1_CATS),
+        0: sorted(category_id_map[name] for name in DATASET2_CATS),
+    }
+    for image_id, labeled_cat_ids in zip(df_partial['image_id'], df_partial['labeled_cat_ids']):
+        assert labeled_cat_ids == expected_labeled_cat_ids[int(image_id in image_ids_dataset1)]
+    assert 'labeled_cat_ids' not in datasets['complete']['train'].columns
+
+
+def test_overlapping_subsets(df):
+    # Images in several subsets have the union of their categories labeled
+    image_ids = np.unique(df['image_id'])
+    specs = [{'image_ids': image_ids[:40], 'cats': {'category_1'}},
+             {'image_ids': image_ids[20:], 'cats': {'category_2'}}]
+    datasets, category_id_map = generate_partial_datasets(df, specs, split_fracs={'all': 1.0})
+    assert category_id_map == {'category_1': 1, 'category_2': 2}
+    df_partial = datasets['partial']['all']
+    for image_id, category_name, labeled_cat_ids in df_partial[['image_id', 'category_name', 'labeled_cat_ids']].values:
+        expected_labeled_cat_ids = [1] * (image_id in image_ids[:40]) + [2] * (image_id in image_ids[20:])
+        assert labeled_cat_ids == expected_labeled_cat_ids
+        assert category_id_map[category_name] in labeled_cat_ids
+    assert len(datasets['complete']['all']) >= len(df_partial)
+
+
+def test_invalid_specs(df):
+    with pytest.raises(ValueError):
+        generate_partial_datasets(df, [{'image_ids': [1], 'cats': {'missing'}}])
+    with pytest.raises(ValueError):
+        generate_partial_datasets(df, [{'image_ids': [-1], 'cats': {'category_1'}}])
@@ -0,0 +1,150 @@
+import filecmp
+import os
+import stat
+import sys
+
+import numpy as np
+import pytest
+
+from partial_data.sharding import commit_file, compute_build_fingerprint, find_invalid_shards, read_manifest
+from partial_data.tfrecord_scanner import count_records
+
+
+tf = pytest.importorskip('tensorflow')
+from partial_data.tfrecord import encode_object_detection_tf_example, write_examples_as_tfrecord  # noqa: E402
+
+
+NUM_SHARDS = 3
+NUM_EXAMPLES = 12
+CRASH_AT_IMAGE_ID = None
+
+
+class Preempted(Exception):
+    pass
+
+
+def crashing_encoder(example):
+    if example['image_id'] == CRASH_AT_IMAGE_ID:
+        raise Preempted()
+    return encode_object_detection_tf_example(example)
+
+
+@pytest.fixture
+def examples(make_example):
+    return [
+        make_example(image_id, image_size=(32, 24), labeled_cat_ids=[1, 2]) for image_id in range(NUM_EXAMPLES)
+    ]
+
+
+@pytest.fixture
+def crash_at(monkeypatch):
+    def set_crash_at(image_id):
+        monkeypatch.setattr(sys.modules[__name__], 'CRASH_AT_IMAGE_ID', image_id)
+    return set_crash_at
+
+
+def get_shard_filepaths(output_filebase):
+    return [f'{output_filebase}-{ind:05d}-of-{NUM_SHARDS:05d}' for ind in range(NUM_SHARDS)]
+
+
+def test_resume_after_crash(tmp_path, examples, crash_at):
+    reference_filebase = str(tmp_path / 'reference.record')
+    write_examples_as_tfrecord(examples, reference_filebase, encode_object_detection_tf_example, num_shards=NUM_SHARDS)
+
+    output_filebase = str(tmp_path / 'resumable.record')
+    # Example 8 is in the last shard, so the first two shards are committed before the crash
+    crash_at(8)
+    with pytest.raises(Preempted):
+        write_examples_as_tfrecord(examples, output_filebase, crashing_encoder, num_shards=NUM_SHARDS, resumable=True)
+    manifest = read_manifest(output_filebase)
+    assert [shard['complete'] for shard in manifest['shards']] == [True, True, False]
+    assert find_invalid_shards(output_filebase) == get_shard_filepaths(output_filebase)[2:]
+    assert not os.path.exists(get_shard_filepaths(output_filebase)[2])
+
+    crash_at(None)
+    manifest = write_examples_as_tfrecord(
+        examples, output_filebase, crashing_encoder, num_shards=NUM_SHARDS, resumable=True)
+    assert manifest['complete']
+    assert find_invalid_shards(output_filebase) == []
+    assert count_records(output_filebase + '-*') == NUM_EXAMPLES
+    # Only committed files are left, identical to those of a regular build
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        [os.path.basename(filepath) for filepath in get_shard_filepaths(reference_filebase)]
+        + [os.path.basename(filepath) for filepath in get_shard_filepaths(output_filebase)]
+        + ['resumable.record.manifest.json'] + [f'{image_id}.jpg' for image_id in range(NUM_EXAMPLES)])
+    for reference_filepath, filepath in zip(get_shard_filepaths(reference_filebase),
+                                            get_shard_filepaths(output_filebase)):
+        assert filecmp.cmp(reference_filepath, filepath, shallow=False)
+
+
+def test_resume_rewrites_only_invalid_shards(tmp_path, examples, crash_at):
+    output_filebase = str(tmp_path / 'resumable.record')
+    write_examples_as_tfrecord(examples, output_filebase, crashing_encoder, num_shards=NUM_SHARDS, resumable=True)
+    shard_filepaths = get_shard_filepaths(output_filebase)
+    with open(shard_filepaths[0], 'r+b') as fp:
+        fp.truncate(100)
+    with open(shard_filepaths[1], 'r+b') as fp:
+        fp.seek(50)
+        byte = fp.read(1)
+        fp.seek(50)
+        fp.write(bytes([byte[0] ^ 1]))
+    assert find_invalid_shards(output_filebase) == shard_filepaths[:2]
+    assert find_invalid_shards(output_filebase, verify_checksum=False) == shard_filepaths[:1]
+
+    # Any example of the intact last shard would fail to encode
+    crash_at(2)
+    manifest = write_examples_as_tfrecord(
+        examples, output_filebase, crashing_encoder, num_shards=NUM_SHARDS, resumable=True)
+    assert manifest['complete']
+    assert find_invalid_shards(output_filebase) == []
+
+
+def test_resume_with_different_inputs_fails(tmp_path, examples):
+    output_filebase = str(tmp_path / 'resumable.record')
+    write_examples_as_tfrecord(examples, output_filebase, crashing_encoder, num_shards=NUM_SHARDS, resumable=True)
+
+    other_examples = [dict(example, labeled_cat_ids=[1]) for example in examples]
+    assert compute_build_fingerprint(other_examples, crashing_encoder) != compute_build_fingerprint(
+        examples, crashing_encoder)
+    with pytest.raises(ValueError):
+        write_examples_as_tfrecord(
+            other_examples, output_filebase, crashing_encoder, num_shards=NUM_SHARDS, resumable=True)
+    with pytest.raises(ValueError):
+        write_examples_as_tfrecord(
+            examples, output_filebase, encode_object_detection_tf_example, num_shards=NUM_SHARDS, resumable=True)
+    with pytest.raises(ValueError):
+        write_examples_as_tfrecord(examples[:-1], output_filebase, crashing_encoder, num_shards=NUM_SHARDS,
+                                   resumable=True)
+
+
+def test_fingerprint_is_canonical(examples):
+    fingerprint = compute_build_fingerprint(examples, crashing_encoder)
+    # The same values as numpy arrays and scalars, in another key order
+    numpy_examples = [
+        {key: np.asarray(value) if isinstance(value, list) else value for key, value in reversed(list(example.items()))}
+        for example in examples
+    ]
+    for example in numpy_examples:
+        example['image_id'] = np.int64(example['image_id'])
+    assert compute_build_fingerprint(numpy_examples, crashing_encoder) == fingerprint
+
+    # Example boundaries are part of the fingerprint
+    assert compute_build_fingerprint(examples[:1] * 2, crashing_encoder) != compute_build_fingerprint(
+        examples[:2], crashing_encoder)
+    assert compute_build_fingerprint([{'key': b'value'}], crashing_encoder) != compute_build_fingerprint(
+        [{'key': 'value'}], crashing_encoder)
+    with pytest.raises(TypeError):
+        compute_build_fingerprint([{'key': object()}], crashing_encoder)
+
+
+def test_commit_file_flushes_directory(tmp_path, monkeypatch):
+    temp_filepath = tmp_path / 'file.tmp'
+    temp_filepath.write_bytes(b'data')
+    fsynced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: fsynced.append(stat.S_ISDIR(os.fstat(fd).st_mode)) or fsync(fd))
+    commit_file(str(temp_filepath), str(tmp_path / 'file'))
+    assert (tmp_path / 'file').read_bytes() == b'data' and not temp_filepath.exists()
+    if hasattr(os, 'O_DIRECTORY'):
+        # The file is flushed before the rename, and its directory after it
+        assert fsynced == [False, True]
@@ -0,0 +1,166 @@
+import os
+from functools import partial
+
+import numpy as np
+import pytest
+
+from partial_data.tfrecord_scanner import iter_examples
+
+
+tf = pytest.importorskip('tensorflow')
+from partial_data.tfrecord import (  # noqa: E402
+    decode_object_detection_tf_example, decode_resized_object_detection_tf_example, encode_object_detection_tf_example,
+    encode_resized_object_detection_tf_example, expand_tfrecord_filepaths, iter_examples_from_tfrecord,
+    read_examples_from_tfrecord, write_examples_as_tfrecord)
+
+
+class UnpickleCountingEncoder:
+    # Records the process and the number of times an encoder was unpickled in it in each example's source id
+    num_unpickled = 0
+
+    def __init__(self):
+        self.labeled_classes_format = 'ids'
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        type(self).num_unpickled += 1
+
+    def __call__(self, example):
+        source_id = f'{example["image_id"]}:{os.getpid()}:{type(self).num_unpickled}'
+        return encode_object_detection_tf_example(
+            dict(example, image_id=source_id), labeled_classes_format=self.labeled_classes_format)
+
+
+def test_workers_unpickle_the_encoder_once(tmp_path, make_example):
+    examples = [make_example(image_id) for image_id in range(20)]
+    output_filebase = str(tmp_path / 'data.record')
+    write_examples_as_tfrecord(examples, output_filebase, UnpickleCountingEncoder(), num_workers=2, max_in_flight=3)
+
+    source_ids = [
+        features['image/source_id'][0].decode('utf8').split(':')
+        for features in iter_examples(output_filebase, feature_names=['image/source_id'])
+    ]
+    # Examples are written in order, and each worker got the encoder once when it started, by unpickling it or,
+    # with the fork start method, inheriting it
+    assert [int(image_id) for image_id, _, _ in source_ids] == list(range(20))
+    assert {num_unpickled for _, _, num_unpickled in source_ids} <= {'0', '1'}
+    assert 1 <= len({pid for _, pid, _ in source_ids}) <= 2
+
+
+def test_parallel_and_serial_outputs_match(tmp_path, make_example):
+    examples = [make_example(image_id, labeled_cat_ids=[1, image_id + 2]) for image_id in range(10)]
+    filebases = [str(tmp_path / f'{num_workers}.record') for num_workers in (1, 3)]
+    for num_workers, output_filebase in zip((1, 3), filebases):
+        write_examples_as_tfrecord(examples, output_filebase, encode_object_detection_tf_example, num_shards=2,
+                                   num_workers=num_workers)
+    for shard_suffix in ('-00000-of-00002', '-00001-of-00002'):
+        with open(filebases[0] + shard_suffix, 'rb') as fp_serial, open(filebases[1] + shard_suffix, 'rb') as fp:
+            assert fp_serial.read() == fp.read()
+
+
+@pytest.fixture
+def detection_tfrecords(tmp_path, make_example):
+    # Examples with different numbers of boxes, so decoded batches are padded
+    examples = [
+        make_example(
+            image_id,
+            wmin=[0.1] * (image_id % 4),
+            wmax=[0.5] * (image_id % 4),
+            hmin=[0.2] * (image_id % 4),
+            hmax=[0.6] * (image_id % 4),
+            category_name=['cat', 'dog', 'bird'][:image_id % 4],
+            category_id=list(range(image_id % 4)),
+            **({'labeled_cat_ids': [1, image_id + 2]} if image_id % 3 else {}),
+        )
+        for image_id in range(11)
+    ]
+    output_filebase = str(tmp_path / 'data.record')
+    write_examples_as_tfrecord(examples, output_filebase, encode_object_detection_tf_example, num_shards=3)
+    return output_filebase + '-*'
+
+
+def read_sequentially(tfrecord_pattern, example_decoder):
+    # Decodes one example at a time, without batching
+    dataset = tf.data.TFRecordDataset(expand_tfrecord_filepaths(tfrecord_pattern)).map(example_decoder)
+    return [{name: value.numpy() for name, value in example.items()} for example in dataset]
+
+
+def assert_examples_equal(examples, expected_examples):
+    assert len(examples) == len(expected_examples)
+    for example, expected_example in zip(examples, expected_examples):
+        assert sorted(example) == sorted(expected_example)
+        for name, value in example.items():
+            np.testing.assert_array_equal(value, expected_example[name])
+            assert np.shape(value) == np.shape(expected_example[name])
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 32])
+@pytest.mark.parametrize('num_classes', [None, 16])
+def test_batched_reading_matches_sequential(detection_tfrecords, batch_size, num_classes):
+    example_decoder = partial(decode_object_detection_tf_example, num_classes=num_classes)
+    expected_examples = read_sequentially(detection_tfrecords, example_decoder)
+    assert len(expected_examples) == 11
+
+    examples = iter_examples_from_tfrecord(detection_tfrecords, example_decoder, batch_size=batch_size)
+    assert not isinstance(examples, list)
+    assert_examples_equal(list(examples), expected_examples)
+    assert_examples_equal(
+        read_examples_from_tfrecord(detection_tfrecords, example_decoder, batch_size=batch_size,
+                                    num_parallel_calls=2, prefetch_size=2),
+        expected_examples)
+
+
+def test_interleaved_reading(detection_tfrecords):
+    expected_examples = read_sequentially(detection_tfrecords, decode_object_detection_tf_example)
+    examples = read_examples_from_tfrecord(detection_tfrecords, decode_object_detection_tf_example, batch_size=4,
+                                           num_parallel_reads=3)
+    # Records are interleaved across files, so the order differs
+    assert_examples_equal(sorted(examples, key=lambda example: int(example['image_id'])),
+                          sorted(expected_examples, key=lambda example: int(example['image_id'])))
+
+
+def test_missing_tfrecords(tmp_path):
+    with pytest.raises(ValueError):
+        read_examples_from_tfrecord(str(tmp_path / 'missing.record-*'), decode_object_detection_tf_example)
+
+
+def decode_resized(tf_example):
+    example = decode_resized_object_detection_tf_example(tf_example.SerializeToString())
+    return {name: value.numpy() for name, value in example.items()}
+
+
+@pytest.mark.parametrize('image_format', ['RAW', 'PNG', 'JPEG'])
+def test_resized_example_stretches_image(make_example, image_format):
+    example = make_example(image_size=(64, 48), wmin=[0.1, 0.5], wmax=[0.5, 1.0], hmin=[0.2, 0.0], hmax=[0.6, 0.5],
+                           category_name=['cat', 'dog'], category_id=[1, 2])
+    decoded = decode_resized(encode_resized_object_detection_tf_example(
+        example, target_size=(20, 30), image_format=image_format))
+    assert (decoded['width'], decoded['height']) == (20, 30)
+    assert decoded['image'].shape == (30, 20, 3)
+    assert decoded['image_filetype'].decode('utf8') == image_format
+    for col in ('wmin', 'wmax', 'hmin', 'hmax'):
+        np.testing.assert_allclose(decoded[col], example[col])
+    # The image is a single color, which survives resizing
+    np.testing.assert_allclose(decoded['image'].reshape(-1, 3).mean(axis=0), (20, 64, 32), atol=3)
+
+
+@pytest.mark.parametrize('image_size, resized_size', [((64, 48), (32, 24)), ((24, 48), (16, 32)), ((32, 32), (32, 32))])
+def test_resized_example_keeps_aspect_ratio(make_example, image_size, resized_size):
+    example = make_example(image_size=image_size, wmin=[0.1, 0.5], wmax=[0.5, 1.0], hmin=[0.2, 0.0],
+                           hmax=[0.6, 0.5], category_name=['cat', 'dog'], category_id=[1, 2])
+    decoded = decode_resized(encode_resized_object_detection_tf_example(
+        example, target_size=(32, 32), image_format='RAW', keep_aspect_ratio=True))
+    assert (decoded['width'], decoded['height']) == (32, 32)
+
+    # The resized image is in the top left, and the bottom and right are padded with zeros
+    resized_width, resized_height = resized_size
+    image = decoded['image'].astype(np.int64)
+    assert np.abs(image[:resized_height, :resized_width] - (20, 64, 32)).max() <= 2
+    assert not image[resized_height:].any() and not image[:, resized_width:].any()
+
+    # Boxes are normalized to the padded image, so they cover the same content
+    np.testing.assert_allclose(decoded['wmin'] * 32, np.array(example['wmin']) * resized_width, rtol=1e-6)
+    np.testing.assert_allclose(decoded['wmax'] * 32, np.array(example['wmax']) * resized_width, rtol=1e-6)
+    np.testing.assert_allclose(decoded['hmin'] * 32, np.array(example['hmin']) * resized_height, rtol=1e-6)
+    np.testing.assert_allclose(decoded['hmax'] * 32, np.array(example['hmax']) * resized_height, rtol=1e-6)
+    assert decoded['label_names'].tolist() == [b'cat', b'dog']
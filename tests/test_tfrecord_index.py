@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pytest
+
+from partial_data.tfrecord_index import (build_index, count_examples, get_index_filepath, is_index_valid,
+                                         lookup_example, select_records)
+
+
+tf = pytest.importorskip('tensorflow')
+from partial_data.tfrecord import encode_object_detection_tf_example, write_examples_as_tfrecord  # noqa: E402
+
+
+@pytest.fixture
+def make_examples(make_example):
+    def make_examples(num_examples):
+        return [
+            # Every third example is fully labeled
+            make_example(image_id, image_size=(32, 24),
+                         **({'labeled_cat_ids': [1, 2 + image_id % 2]} if image_id % 3 else {}))
+            for image_id in range(num_examples)
+        ]
+    return make_examples
+
+
+def test_select_and_lookup(tmp_path, make_examples):
+    output_filebase = str(tmp_path / 'data.record')
+    write_examples_as_tfrecord(make_examples(10), output_filebase, encode_object_detection_tf_example,
+                               num_shards=2, write_index=True)
+    pattern = output_filebase + '-*'
+    assert count_examples(pattern) == 10
+
+    for image_id in range(10):
+        assert lookup_example(pattern, image_id)['image/source_id'] == [str(image_id).encode('utf8')]
+    assert lookup_example(pattern, 99) is None
+
+    # Class 3 is labeled in odd examples not divisible by 3, and fully labeled examples have every class
+    selection = select_records(pattern, labeled_class_ids=[3])
+    assert len(selection) == len([image_id for image_id in range(10) if image_id % 3 == 0 or image_id % 2])
+
+
+def test_stale_index_is_not_used(tmp_path, make_examples):
+    output_filebase = str(tmp_path / 'data.record')
+    examples = make_examples(10)
+    write_examples_as_tfrecord(examples, output_filebase, encode_object_detection_tf_example, write_index=True)
+    assert is_index_valid(output_filebase)
+
+    # Rewriting the records without an index leaves the previous index behind
+    write_examples_as_tfrecord(examples[:4], output_filebase, encode_object_detection_tf_example)
+    assert os.path.exists(get_index_filepath(output_filebase))
+    assert not is_index_valid(output_filebase)
+    assert count_examples(output_filebase) == 4
+    assert len(select_records(output_filebase)) == 4
+    assert is_index_valid(output_filebase)
+
+
+def test_build_index_matches_written_index(tmp_path, make_examples):
+    output_filebase = str(tmp_path / 'data.record')
+    write_examples_as_tfrecord(make_examples(7), output_filebase, encode_object_detection_tf_example,
+                               write_index=True)
+    with np.load(get_index_filepath(output_filebase)) as arrays:
+        written_index = dict(arrays)
+    build_index(output_filebase)
+    with np.load(get_index_filepath(output_filebase)) as arrays:
+        for name, values in arrays.items():
+            np.testing.assert_array_equal(values, written_index[name])
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from partial_data.tfrecord_scanner import (audit_tfrecord, count_records, crc32c, decode_packed_varints,
+                                           expand_filepaths, iter_examples, iter_records, parse_example)
+
+
+tf = pytest.importorskip('tensorflow')
+from partial_data.tfrecord import encode_object_detection_tf_example, write_examples_as_tfrecord  # noqa: E402
+
+
+NUM_EXAMPLES = 6
+
+
+def get_tf_features(serialized_example):
+    # Reference decoding of all features with the protobuf library
+    example = tf.train.Example.FromString(bytes(serialized_example))
+    features = {}
+    for name, feature in example.features.feature.items():
+        kind = feature.WhichOneof('kind')
+        values = list(getattr(feature, kind).value) if kind is not None else None
+        features[name] = values
+    return features
+
+
+def assert_features_equal(features, tf_features):
+    assert sorted(features) == sorted(tf_features)
+    for name, values in features.items():
+        if isinstance(values, np.ndarray):
+            np.testing.assert_array_equal(values, np.array(tf_features[name], dtype=values.dtype))
+        else:
+            assert values == tf_features[name]
+
+
+@pytest.fixture
+def tfrecord_filebase(tmp_path, make_example):
+    examples = [
+        make_example(
+            image_id,
+            image_size=(32, 24),
+            wmin=[0.1] * image_id,
+            wmax=[0.5] * image_id,
+            hmin=[0.2] * image_id,
+            hmax=[0.7] * image_id,
+            category_name=['cat'] * image_id,
+            category_id=[200 + image_id] * image_id,
+            **({'labeled_cat_ids': [300, 1, 200 + image_id]} if image_id % 2 else {}),
+        )
+        for image_id in range(NUM_EXAMPLES)
+    ]
+    output_filebase = str(tmp_path / 'data.record')
+    write_examples_as_tfrecord(examples, output_filebase, encode_object_detection_tf_example, num_shards=2)
+    return output_filebase
+
+
+def test_crc32c():
+    # Check value of the CRC-32C (Castagnoli) polynomial
+    assert crc32c(b'123456789') == 0xE3069283
+
+
+def test_decode_packed_varints():
+    values = np.array([0, 1, 127, 128, 300, 2 ** 40, -1, -2 ** 63], dtype=np.int64)
+    serialized_example = tf.train.Example(features=tf.train.Features(feature={
+        'values': tf.train.Feature(int64_list=tf.train.Int64List(value=values)),
+    })).SerializeToString()
+    np.testing.assert_array_equal(parse_example(serialized_example)['values'], values)
+    assert decode_packed_varints(b'').dtype == np.int64
+
+
+def test_parse_example_matches_tf(tfrecord_filebase):
+    pattern = tfrecord_filebase + '-*'
+    serialized_examples = [record.numpy() for record in tf.data.TFRecordDataset(expand_filepaths(pattern))]
+    assert len(serialized_examples) == count_records(pattern) == NUM_EXAMPLES
+
+    for features, serialized_example in zip(iter_examples(pattern, verify_crc=True), serialized_examples):
+        assert_features_equal(features, get_tf_features(serialized_example))
+
+    feature_names = ['image/source_id', 'image/object/bbox/xmin', 'image/class/labeled_classes']
+    for features, serialized_example in zip(iter_examples(pattern, feature_names=feature_names), serialized_examples):
+        tf_features = get_tf_features(serialized_example)
+        assert_features_equal(features, {name: tf_features[name] for name in feature_names if name in tf_features})
+
+
+def test_iter_records_detects_corruption(tfrecord_filebase):
+    filepath = tfrecord_filebase + '-00000-of-00002'
+    with open(filepath, 'rb') as fp:
+        data = bytearray(fp.read())
+    offsets = [offset for offset, _ in iter_records(data, verify_crc=True)]
+    assert offsets[0] == 0 and len(offsets) == NUM_EXAMPLES // 2
+
+    with pytest.raises(ValueError, match='Truncated'):
+        list(iter_records(data[:-1]))
+
+    data[20] ^= 1
+    # Without verification the corrupt data is not noticed
+    assert len(list(iter_records(data))) == NUM_EXAMPLES // 2
+    with pytest.raises(ValueError, match='Corrupt record data'):
+        list(iter_records(data, verify_crc=True))
+
+
+def test_audit_tfrecord(tfrecord_filebase):
+    summary = audit_tfrecord(tfrecord_filebase + '-*', verify_crc=True)
+    assert summary['num_examples'] == NUM_EXAMPLES
+    assert summary['num_boxes'] == sum(range(NUM_EXAMPLES))
+    assert summary['num_unmasked_examples'] == NUM_EXAMPLES // 2
+    assert summary['box_label_counts'] == {200 + image_id: image_id for image_id in range(1, NUM_EXAMPLES)}
+    assert summary['labeled_class_counts'][1] == NUM_EXAMPLES // 2
+    assert summary['box_width_mean'] == pytest.approx(0.4)
+    assert summary['box_height_mean'] == pytest.approx(0.5)
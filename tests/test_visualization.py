@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from partial_data.visualization import (STANDARD_COLORS, STANDARD_COLORS_RGB, draw_boxes_on_array, draw_example,
+                                        get_font, get_label_color, get_label_colors)
+
+
+# Text sizes are measured with the font getsize method, which Pillow 10 removed
+requires_font_getsize = pytest.mark.skipif(
+    not hasattr(ImageFont.ImageFont, 'getsize'), reason='requires a Pillow version with font getsize')
+
+
+CATEGORY_NAMES = [f'category_{ind}' for ind in range(80)]
+
+
+def test_label_colors_are_fixed():
+    label_colors = get_label_colors(CATEGORY_NAMES)
+    assert len(set(label_colors.values())) == len(CATEGORY_NAMES)
+    assert set(label_colors.values()) <= set(STANDARD_COLORS)
+    # The map does not depend on the order of the labels
+    assert get_label_colors(CATEGORY_NAMES[::-1] + CATEGORY_NAMES[:3]) == label_colors
+    assert get_label_colors([1, 2, 2]) == get_label_colors([2, 1])
+    # Default colors only depend on the label
+    assert get_label_color(('category_1',)) == get_label_color(('category_1',))
+
+
+@requires_font_getsize
+def test_draw_example_colors(tmp_path):
+    image_filepath = str(tmp_path / 'image.png')
+    Image.new('RGB', (100, 100), 'black').save(image_filepath)
+
+    def get_box_color(category_names, label_colors=None):
+        # Draws one box per category, at the same place for the first category, and gets the color of its outline
+        num_boxes = len(category_names)
+        example = {'image_filepath': image_filepath, 'category_name': category_names,
+                   'hmin': [0.5] * num_boxes, 'wmin': [0.1] + [0.6] * (num_boxes - 1),
+                   'hmax': [0.9] * num_boxes, 'wmax': [0.3] + [0.9] * (num_boxes - 1)}
+        img = draw_example(example, label_colors=label_colors)
+        return img.getpixel((10, 70))
+
+    # A category's color does not depend on the other categories in the image, even if another one has the same
+    # default color
+    assert get_label_color(('a33',)) == get_label_color(('cat',))
+    colors = {get_box_color(['cat'] + others) for others in ([], ['dog'], ['a33', 'bird'], ['cat'])}
+    assert colors == {ImageColor.getrgb(get_label_color(('cat',)))}
+
+    label_colors = {'cat': 'Red', 'dog': 'Blue'}
+    assert get_box_color(['cat', 'dog'], label_colors) == (255, 0, 0)
+    assert get_box_color(['dog'], label_colors) == (0, 0, 255)
+    assert get_box_color([b'cat'], label_colors) == (255, 0, 0)
+
+
+def draw_boxes_on_array_per_box(img_array, boxes, classes, scores, score_threshold=0.0, max_labeled_boxes=10,
+                                 thickness=4, category_names=None):
+    # The per-box drawing path: fills the edge strips of one box at a time, and draws labels on a copy of the image
+    keep_inds = np.flatnonzero(scores >= score_threshold)
+    keep_inds = keep_inds[np.argsort(scores[keep_inds], kind='stable')]
+    im_height, im_width = img_array.shape[:2]
+    pixel_boxes = np.round(boxes[keep_inds] * np.array([im_height, im_width, im_height, im_width],
+                                                       dtype=np.float32)).astype(np.int64)
+    pixel_boxes = pixel_boxes.clip(0, [im_height - 1, im_width - 1, im_height - 1, im_width - 1])
+    colors = STANDARD_COLORS_RGB[classes[keep_inds] % len(STANDARD_COLORS_RGB)]
+    for (top, left, bottom, right), color in zip(pixel_boxes.tolist(), colors):
+        img_array[top:min(top + thickness, bottom + 1), left:right + 1] = color
+        img_array[max(bottom + 1 - thickness, top):bottom + 1, left:right + 1] = color
+        img_array[top:bottom + 1, left:min(left + thickness, right + 1)] = color
+        img_array[top:bottom + 1, max(right + 1 - thickness, left):right + 1] = color
+
+    if max_labeled_boxes > 0:
+        img = Image.fromarray(img_array)
+        draw = ImageDraw.Draw(img)
+        font = get_font(None, 24)
+        for ind in range(len(keep_inds))[-max_labeled_boxes:]:
+            top, left, bottom, _ = pixel_boxes[ind]
+            class_id = classes[keep_inds[ind]]
+            display_str = category_names.get(class_id, str(class_id)) if category_names else str(class_id)
+            display_str = f'{display_str}: {int(100 * scores[keep_inds[ind]])}%'
+            text_width, text_height = font.getsize(display_str)
+            margin = np.ceil(0.05 * text_height)
+            text_bottom = top if top > text_height + 2 * margin else bottom + text_height + 2 * margin
+            draw.rectangle([(left, text_bottom - text_height - 2 * margin), (left + text_width, text_bottom)],
+                           fill=tuple(colors[ind].tolist()))
+            draw.text((left + margin, text_bottom - text_height - margin), display_str, fill='black', font=font)
+        img_array[...] = np.asarray(img)
+    return img_array
+
+
+def make_detections(num_boxes, seed=0):
+    rng = np.random.RandomState(seed)
+    # Include boxes past the image edges, thin boxes, and boxes with max < min coordinates
+    mins = rng.uniform(-0.1, 0.9, size=(num_boxes, 2))
+    maxs = mins + rng.uniform(-0.05, 0.5, size=(num_boxes, 2))
+    boxes = np.concatenate([mins, maxs], axis=1).astype(np.float32)
+    classes = rng.randint(0, 200, size=num_boxes)
+    scores = rng.uniform(size=num_boxes).astype(np.float32)
+    return boxes, classes, scores
+
+
+@pytest.mark.parametrize('thickness', [1, 4, 40])
+@pytest.mark.parametrize('score_threshold', [0.0, 0.5, 1.1])
+def test_draw_boxes_on_array_outlines(thickness, score_threshold):
+    boxes, classes, scores = make_detections(100)
+    img_array = np.random.RandomState(1).randint(0, 256, size=(120, 160, 3), dtype=np.uint8)
+    expected_img_array = draw_boxes_on_array_per_box(
+        img_array.copy(), boxes, classes, scores, score_threshold=score_threshold, max_labeled_boxes=0,
+        thickness=thickness)
+    output = draw_boxes_on_array(img_array, boxes, classes, scores, score_threshold=score_threshold,
+                                 max_labeled_boxes=0, thickness=thickness)
+    assert output is img_array
+    np.testing.assert_array_equal(img_array, expected_img_array)
+
+
+@requires_font_getsize
+@pytest.mark.parametrize('max_labeled_boxes', [1, 10, 100])
+def test_draw_boxes_on_array_labels(max_labeled_boxes):
+    boxes, classes, scores = make_detections(100, seed=2)
+    img_array = np.zeros((240, 320, 3), dtype=np.uint8)
+    category_names = {class_id: f'category {class_id}' for class_id in range(0, 200, 2)}
+    expected_img_array = draw_boxes_on_array_per_box(
+        img_array.copy(), boxes, classes, scores, max_labeled_boxes=max_labeled_boxes, category_names=category_names)
+    draw_boxes_on_array(img_array, boxes, classes, scores, max_labeled_boxes=max_labeled_boxes,
+                        category_names=category_names)
+    np.testing.assert_array_equal(img_array, expected_img_array)
+
+
+def test_draw_boxes_on_array_without_boxes():
+    img_array = np.zeros((10, 10, 3), dtype=np.uint8)
+    assert not draw_boxes_on_array(img_array, np.zeros((0, 4)), max_labeled_boxes=0).any()
+    with pytest.raises(ValueError):
+        draw_boxes_on_array(img_array, np.zeros((3, 2)))